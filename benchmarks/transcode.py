@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import math
+import time
+import struct
+import platform
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from building_server import transcode  # noqa: E402
+
+
+def footprint(x, y, walls, radius, concave):
+    """
+    Returns the walls corners of a building footprint, counter clockwise
+    A concave footprint is a star alternating radius and radius / 2
+    """
+    points = []
+    for i in range(0, walls):
+        angle = 2 * math.pi * i / walls
+        r = radius / 2. if concave and i % 2 else radius
+        points.append((x + r * math.cos(angle), y + r * math.sin(angle)))
+    return points
+
+
+def building(x, y, walls, height, concave=False, degenerate=False):
+    """
+    Returns the polygons (lists of rings) of an extruded building
+    A degenerate building has an extra zero area ring with a repeated point
+    """
+    base = footprint(x, y, walls, 10., concave)
+    floor = [(p[0], p[1], 0.) for p in reversed(base)]
+    roof = [(p[0], p[1], height) for p in base]
+    polygons = [[floor], [roof]]
+    for i in range(0, walls):
+        (a, b) = (base[i], base[(i + 1) % walls])
+        polygons.append([[(a[0], a[1], 0.), (b[0], b[1], 0.),
+                          (b[0], b[1], height), (a[0], a[1], height)]])
+    if degenerate:
+        p = roof[0]
+        polygons.append([[p, p, (p[0] + 1, p[1], p[2])]])
+    return polygons
+
+
+def wkb_multipolygon(polygons):
+    """
+    Encodes polygons as a little endian MultiPolygonZ WKB
+    """
+    wkb = [struct.pack('<BII', 1, transcode.WKB_MULTIPOLYGONZ, len(polygons))]
+    for polygon in polygons:
+        wkb.append(struct.pack('<BII', 1, transcode.WKB_POLYGONZ,
+                               len(polygon)))
+        for ring in polygon:
+            ring = list(ring) + [ring[0]]
+            wkb.append(struct.pack('<I', len(ring)))
+            wkb.append(np.array(ring, dtype='<f8').tobytes())
+    return b''.join(wkb)
+
+
+def tile(features, walls, concave, degenerate, seed=0):
+    """
+    Returns toglTF rows for a synthetic tile of features buildings
+    concave and degenerate are the fractions of such buildings
+    """
+    rng = np.random.RandomState(seed)
+    rows = []
+    side = int(math.ceil(math.sqrt(features)))
+    for i in range(0, features):
+        (x, y) = (30. * (i % side), 30. * (i // side))
+        height = float(rng.uniform(5, 50))
+        polygons = building(x, y, walls, height,
+                            rng.random_sample() < concave,
+                            rng.random_sample() < degenerate)
+        box3D = 'BOX3D({0} {1} 0,{2} {3} {4})'.format(x - 10, y - 10, x + 10,
+                                                       y + 10, height)
+        rows.append((wkb_multipolygon(polygons), box3D))
+    return rows
+
+
+def measure(function, repeat):
+    """
+    Runs function repeat times
+    Returns the timings and the result of the last run
+    """
+    timings = []
+    for i in range(0, repeat):
+        t0 = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - t0)
+    return (timings, result)
+
+
+def stages(rows, repeat):
+    """
+    Times each transcoding stage on rows and the whole toglTF
+    Each stage runs on the output of the previous one
+    """
+    results = {}
+
+    def run(name, function):
+        (timings, result) = measure(function, repeat)
+        results[name] = timings
+        return result
+
+    origin = transcode.parseBox3D(rows[0][1])[0]
+    parsed = run('parse', lambda: [transcode.parse(r[0]) for r in rows])
+
+    def triangulate():
+        nodes = []
+        for (points, rings, polygons) in parsed:
+            outer = polygons[:-1][np.diff(polygons) == 1]
+            nodes.append(transcode.triangulateRings(points, rings[outer],
+                                                    rings[outer + 1]))
+        return nodes
+    nodes = run('triangulate', triangulate)
+    triangles = np.concatenate(nodes)
+
+    normals = run('computeNormals', lambda: transcode.computeNormals(triangles))
+    run('indexation', lambda: transcode.indexation(
+        transcode.moveOrigin(triangles, origin), normals,
+        [len(n) for n in nodes]))
+
+    (binVertices, binIndices, binNormals, binBatchIds, nVertices, nIndices, bb,
+     indexTypes, meshes) = transcode.buildPrimitives(rows, origin, False)
+    run('outputJSON', lambda: transcode.outputJSON(
+        binVertices, binIndices, binNormals, nVertices, nIndices, bb, False,
+        "test.bin", indexTypes, meshes))
+    run('outputbglTF', lambda: transcode.outputbglTF(
+        binVertices, binIndices, binNormals, nVertices, nIndices, bb,
+        indexTypes, meshes))
+    run('toglTF', lambda: transcode.toglTF(rows, True, origin))
+
+    return results
+
+
+def report(results, rows):
+    """
+    Returns the median time and throughput of each stage
+    """
+    nbytes = sum(len(r[0]) for r in rows)
+    summary = {}
+    for (name, timings) in results.items():
+        median = float(np.median(timings))
+        summary[name] = {
+            'median': median,
+            'min': min(timings),
+            'features_per_s': len(rows) / median,
+            'bytes_per_s': nbytes / median
+        }
+    return summary
+
+
+def compare(current, previous):
+    for (name, stage) in current.items():
+        if name in previous:
+            ratio = previous[name]['median'] / stage['median']
+            print('{0:16s} {1:6.2f}x'.format(name, ratio))
+
+
+if __name__ == '__main__':
+
+    descr = 'Benchmark the transcoding stages on synthetic buildings'
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument('--features', type=int, default=200,
+                        help='number of buildings in the tile')
+    parser.add_argument('--walls', type=int, default=8,
+                        help='number of walls of each building')
+    parser.add_argument('--concave', type=float, default=0.5,
+                        help='fraction of buildings with a concave roof')
+    parser.add_argument('--degenerate', type=float, default=0.1,
+                        help='fraction of buildings with a degenerate ring')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs of each stage')
+    parser.add_argument('--output', type=str,
+                        help='JSON file to save the results in')
+    parser.add_argument('--compare', type=str,
+                        help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    rows = tile(args.features, args.walls, args.concave, args.degenerate)
+    current = report(stages(rows, args.repeat), rows)
+
+    for (name, stage) in current.items():
+        print('{0:16s} {1:10.6f} s {2:12.0f} features/s {3:14.0f} bytes/s'
+              .format(name, stage['median'], stage['features_per_s'],
+                      stage['bytes_per_s']))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print('speedup against {0}'.format(args.compare))
+            compare(current, json.load(f)['stages'])
+
+    if args.output:
+        results = {
+            'parameters': vars(args),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'inputBytes': sum(len(r[0]) for r in rows),
+            'stages': current
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
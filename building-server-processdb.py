@@ -6,8 +6,11 @@ import time
 import sys
 import argparse
 import yaml
+import numpy as np
 
+from building_server.cache import ResponseCache
 from building_server.database import Session
+from building_server.transcode import packMesh
 from building_server import utils
 
 
@@ -59,15 +62,18 @@ def initDB(city, conf, scoref):
             scores = Session.score_for_polygon(city, poly, scoref)
             qt += time.time() - qt0
 
-            geoms = []
-            for score in scores:
-                box3D = utils.Box3D(score['box3d'])
-                centroid = box3D.centroid()
+            # bboxes and centroids of all the features are computed at once
+            boxes = utils.Box3D.parse([score['box3d'] for score in scores])
+            centroids = utils.Box3D.centroids(boxes)
+            selected = np.flatnonzero(
+                (centroids >= tileExtent[0]).all(axis=1)
+                & (centroids < tileExtent[1]).all(axis=1))
 
-                if inside(tileExtent, centroid):
-                    corners = box3D.corners()
-                    geoms.append((score['gid'], centroid, score['score'],
-                                 corners[0], corners[1]))
+            geoms = []
+            for (k, box, centroid) in zip(selected, boxes[selected].tolist(),
+                                          centroids[selected].tolist()):
+                geoms.append((scores[k]['gid'], tuple(centroid),
+                              scores[k]['score'], box[0:3], box[3:6]))
 
             if len(geoms) == 0:
                 continue
@@ -124,6 +130,24 @@ def initDB(city, conf, scoref):
     print("Bounding box table creation time : {0}".format(time.time() - t3))
 
 
+def buildMeshes(city):
+    # triangulate each feature once, tile by tile
+    t0 = time.time()
+    Session.create_mesh_table(city)
+
+    count = 0
+    for tile in Session.quadtiles(city):
+        meshes = []
+        for geom in Session.tile_geom_binary(city, tile, prebuilt=False):
+            meshes.append((geom['gid'], geom['box3d'],
+                           packMesh(geom['binary'], geom['box3d'])))
+        Session.insert_into_mesh_table(city, meshes)
+        count += len(meshes)
+
+    print("Mesh table creation time ({0} features) : {1}"
+          .format(count, time.time() - t0))
+
+
 def divide(extent, geometries, depth, xOffset, yOffset, tileSize,
            featuresPerTile, index, bboxIndex):
     superBbox = superbbox()
@@ -184,6 +208,9 @@ if __name__ == '__main__':
     parser.add_argument('--score', metavar='score', type=str, help=score_help,
                         default="ST_Area(Box2D(geom))")
 
+    meshes_help = 'do not prebuild the glTF meshes of the features'
+    parser.add_argument('--no-meshes', action='store_true', help=meshes_help)
+
     args = parser.parse_args()
 
     # load configuration
@@ -225,12 +252,20 @@ if __name__ == '__main__':
     app = type('', (), {})()
     app.config = ymlconf_db
     Session.init_app(app)
+    ResponseCache.init_app(app)
     utils.CitiesConfig.init(str(args.cfg))
 
     # reinitialize the database
     Session.drop_column(args.city, "quadtile")
     Session.drop_column(args.city, "weight")
     Session.drop_bbox_table(args.city)
+    Session.drop_mesh_table(args.city)
 
     # fill the database
     initDB(args.city, cityconf, args.score)
+    if not args.no_meshes:
+        buildMeshes(args.city)
+
+    # cached responses of the city are outdated
+    Session.stamp_version(args.city, time.strftime('%Y%m%dT%H%M%S'))
+    ResponseCache.invalidate(args.city)
@@ -9,7 +9,11 @@ from flask import Flask, Blueprint
 from yaml import load as yload
 
 from building_server.app import api
+from building_server.cache import HTTPCache, ResponseCache
+from building_server.compression import Compression
 from building_server.database import Session
+from building_server.server import prebuild
+from building_server.transcode import TranscodePool
 from building_server.utils import CitiesConfig
 
 # building server version
@@ -122,6 +126,13 @@ def create_app(env='Defaults'):
     api.init_app(blueprint)
     app.register_blueprint(blueprint)
     Session.init_app(app)
+    app.teardown_appcontext(Session.release)
+    TranscodePool.init_app(app)
+    ResponseCache.init_app(app)
+    Compression.init_app(app)
+    HTTPCache.init_app(app)
     CitiesConfig.init(str(cfgfile))
+    if app.config.get('PREBUILD_AT_STARTUP', False):
+        prebuild()
 
     return app
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from flask import request
-from flask_restplus import Api, Resource, fields, reqparse
+from flask_restplus import Api, Resource, fields, inputs, reqparse
 
 from .server import GetGeometry
+from .server import GetGeometries
 from .server import GetCities
 from .server import GetCity
 from .server import GetAttribute
@@ -30,6 +31,10 @@ getgeom_parser.add_argument('city', type=str, required=True)
 getgeom_parser.add_argument('tile', type=str, required=True)
 getgeom_parser.add_argument('format', type=str, required=False)
 getgeom_parser.add_argument('attributes', type=str, required=False)
+getgeom_parser.add_argument('merge', type=inputs.boolean, required=False,
+                            default=False)
+getgeom_parser.add_argument('quantize', type=inputs.boolean, required=False,
+                            default=False)
 
 
 @api.route("/getGeometry")
@@ -41,6 +46,27 @@ class APIGetGeometry(Resource):
         return GetGeometry().run(args)
 
 
+# getGeometries
+getgeoms_parser = reqparse.RequestParser()
+getgeoms_parser.add_argument('city', type=str, required=True)
+getgeoms_parser.add_argument('tiles', type=str, required=True)
+getgeoms_parser.add_argument('format', type=str, required=False)
+getgeoms_parser.add_argument('attributes', type=str, required=False)
+getgeoms_parser.add_argument('merge', type=inputs.boolean, required=False,
+                             default=False)
+getgeoms_parser.add_argument('quantize', type=inputs.boolean, required=False,
+                             default=False)
+
+
+@api.route("/getGeometries")
+class APIGetGeometries(Resource):
+
+    @api.expect(getgeoms_parser, validate=True)
+    def get(self):
+        args = getgeoms_parser.parse_args()
+        return GetGeometries().run(args)
+
+
 # getCities
 @api.route("/getCities")
 class APIGetCities(Resource):
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from building_server import create_app
+from building_server.asyncserver import Application
+
+app = Application(create_app())
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import weakref
+from psycopg2 import connect, OperationalError, InterfaceError
+from psycopg2.errors import UndefinedTable
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import PoolError
+
+from .database import Session
+
+
+async def wait(conn):
+    """Waits for the asynchronous connection to complete its operation
+    without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+
+        ready = loop.create_future()
+
+        def wakeup():
+            if not ready.done():
+                ready.set_result(None)
+
+        fd = conn.fileno()
+        if state == POLL_READ:
+            (add, remove) = (loop.add_reader, loop.remove_reader)
+        elif state == POLL_WRITE:
+            (add, remove) = (loop.add_writer, loop.remove_writer)
+        else:
+            raise OperationalError("bad poll state {0}".format(state))
+
+        add(fd, wakeup)
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class AsyncConnectionPool(object):
+    """
+    Pool of asynchronous connections shared by the coroutines of an event
+    loop
+
+    A connection is used by one coroutine at a time. Unlike threads,
+    coroutines waiting for the db cost no more than their sockets so the
+    pool can be much larger than a ConnectionPool.
+    """
+
+    def __init__(self, dsn, maxconn=100, timeout=10):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.free = []
+        self.used = 0
+        self.slots = None
+        self.counters = dict.fromkeys(
+            ['checkouts', 'waits', 'connects', 'retries'], 0)
+
+    def stats(self):
+        """Returns the usage counters of the pool and its current size
+        """
+        stats = dict(self.counters)
+        stats.update(free=len(self.free), used=self.used,
+                     size=len(self.free) + self.used)
+        return stats
+
+    async def getconn(self):
+        """Checks out a connection, waiting for one to be released if
+        maxconn connections are already in use
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.maxconn)
+        if self.slots.locked():
+            self.counters['waits'] += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolError("no connection available after {0}s"
+                            .format(self.timeout))
+        self.used += 1
+        self.counters['checkouts'] += 1
+
+        while self.free:
+            conn = self.free.pop()
+            if not conn.closed:
+                return conn
+
+        try:
+            return await self.connect()
+        except BaseException:
+            # including the cancellation of the request
+            self.used -= 1
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """Gives a connection back to the pool, close it if it is broken
+        """
+        if close or conn.closed:
+            conn.close()
+        else:
+            self.free.append(conn)
+        self.used -= 1
+        self.slots.release()
+
+    async def connect(self):
+        # asynchronous connections are always in autocommit mode
+        conn = connect(self.dsn, cursor_factory=NamedTupleCursor, async_=True)
+        await wait(conn)
+        self.counters['connects'] += 1
+        return conn
+
+    def closeall(self):
+        for conn in self.free:
+            conn.close()
+        self.free = []
+
+
+class AsyncSession(object):
+    """
+    Coroutine counterpart of Session for the queries of the endpoints
+
+    Queries are the ones of Session, run through prepared statements on
+    asynchronous connections. Binary COPY is not available in asynchronous
+    mode so PG_BINARY_FETCH does not apply. The bbox index of Session is
+    shared, its loading being run in a thread.
+    """
+    pool = None
+    # names of the statements prepared on each connection
+    prepared = weakref.WeakKeyDictionary()
+
+    @classmethod
+    async def tile_content_binary(cls, city, tile, children, prebuilt=True):
+        """Same as Session.tile_content_binary
+        """
+        index = await cls.bbox_index(city)
+
+        async def query(mesh):
+            (name, key, sql) = Session._tile_content_binary_sql(
+                mesh, False, index is None)
+            rows = await cls.query_prepared(name, city, sql,
+                                            ['varchar', 'varchar[]'],
+                                            [tile, list(children)])
+            return Session._tile_content(rows, 'box3d', key)
+
+        return Session._tile_metadata(
+            index, tile, children,
+            await cls._with_meshes(city, prebuilt, query))
+
+    @classmethod
+    async def tile_content_geojson(cls, city, tile, children):
+        """Same as Session.tile_content_geojson
+        """
+        index = await cls.bbox_index(city)
+        (name, sql) = Session._tile_content_geojson_sql(index is None)
+
+        rows = await cls.query_prepared(name, city, sql,
+                                        ['varchar', 'varchar[]'],
+                                        [tile, list(children)])
+        return Session._tile_metadata(index, tile, children,
+                                      Session._tile_content(rows, None,
+                                                            'geom'))
+
+    @classmethod
+    async def tiles_content_binary(cls, city, children, prebuilt=True):
+        """Same as Session.tiles_content_binary
+        """
+        async def query(mesh):
+            (name, key, sql) = Session._tile_content_binary_sql(
+                mesh, False, False, True)
+            rows = await cls.query_prepared(name, city, sql, ['varchar[]'],
+                                            [list(children)])
+            return (rows, key)
+
+        (rows, key) = await cls._with_meshes(city, prebuilt, query)
+        bboxes = await cls.bbox_for_quadtiles(
+            city, Session._tiles_quadtiles(children))
+        return Session._tiles_content(children, rows, bboxes, 'box3d', key)
+
+    @classmethod
+    async def tiles_content_geojson(cls, city, children):
+        """Same as Session.tiles_content_geojson
+        """
+        (name, sql) = Session._tile_content_geojson_sql(False, True)
+
+        rows = await cls.query_prepared(name, city, sql, ['varchar[]'],
+                                        [list(children)])
+        bboxes = await cls.bbox_for_quadtiles(
+            city, Session._tiles_quadtiles(children))
+        return Session._tiles_content(children, rows, bboxes, None, 'geom')
+
+    @classmethod
+    async def bbox_for_quadtiles(cls, city, quadtiles):
+        """Same as Session.bbox_for_quadtiles
+        """
+        index = await cls.bbox_index(city)
+        if index is not None:
+            return index.bbox_for_quadtiles(quadtiles)
+
+        return await cls.query_prepared('bbox_for_quadtiles', city,
+                                        Session.BBOX_FOR_QUADTILES_SQL,
+                                        ['varchar[]'], [list(quadtiles)])
+
+    @classmethod
+    async def tiles_for_level(cls, city, level):
+        """Same as Session.tiles_for_level
+        """
+        index = await cls.bbox_index(city)
+        if index is not None:
+            return index.tiles_for_level(level)
+
+        return await cls.query_asdict(
+            *Session._tiles_for_level_sql(city, level))
+
+    @classmethod
+    async def attributes_for_gids(cls, city, gids, attributes):
+        """Same as Session.attributes_for_gids
+        """
+        sql = Session._attributes_sql(city, attributes)
+        res = await cls.query_asdict(sql, [list(gids)])
+
+        return Session._attributes(res, attributes)
+
+    @classmethod
+    async def has_mesh_table(cls, city):
+        """Same as Session.has_mesh_table
+        """
+        version = await cls.dataset_version(city)
+        cached = Session.mesh_tables.get(city)
+        if cached is None or cached[0] != version:
+            res = await cls.query_asdict(Session._mesh_table_sql(city))
+            cached = (version, res[0]['found'])
+            Session.mesh_tables[city] = cached
+
+        return cached[1]
+
+    @classmethod
+    async def _with_meshes(cls, city, prebuilt, query):
+        # same as Session._with_meshes
+        mesh = prebuilt and await cls.has_mesh_table(city)
+        try:
+            return await query(mesh)
+        except UndefinedTable:
+            if not mesh:
+                raise
+            Session.mesh_tables.pop(city, None)
+            return await query(False)
+
+    @classmethod
+    async def bbox_index(cls, city):
+        """Same as Session.bbox_index, the check for changes of the table
+        being run in a thread when it is due
+        """
+        if Session.index_check is None:
+            return None
+
+        index = Session.indexes.get(city)
+        if (index is not None
+                and time.monotonic() - index.checked < Session.index_check):
+            return index
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, cls._in_thread,
+                                          Session.bbox_index, city)
+
+    @classmethod
+    async def bbox_version(cls, city):
+        """Same as Session.bbox_version
+        """
+        res = await cls.query_asdict(Session._bbox_version_sql(city))
+
+        version = None
+        if res:
+            version = tuple(res[0].values())
+
+        return version
+
+    @classmethod
+    async def dataset_version(cls, city):
+        """Same as Session.dataset_version, the version being read in a
+        thread when it is due
+        """
+        if Session.version_check is None:
+            return None
+
+        cached = Session.versions.get(city)
+        if (cached is not None
+                and time.monotonic() - cached[1] < Session.version_check):
+            return cached[0]
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, cls._in_thread,
+                                          Session.dataset_version, city)
+
+    @staticmethod
+    def _in_thread(function, *args):
+        try:
+            return function(*args)
+        finally:
+            Session.release()
+
+    @classmethod
+    async def query_prepared(cls, name, city, sql, types, parameters):
+        """Same as Session.query_prepared
+        """
+        (execute, prepare) = Session._statement(name, city, sql, types)
+        return await cls.query_asdict(execute, parameters, prepare)
+
+    @classmethod
+    async def query_asdict(cls, query, parameters=None, prepare=None):
+        """Runs a query and returns its rows as OrderedDict
+
+        prepare is an optional (name, sql) PREPARE statement run before the
+        query on the connections which did not run it yet. Queries are run
+        again once on a new connection if the connection was lost.
+        """
+        for attempt in range(0, 2):
+            conn = await cls.pool.getconn()
+            # the connection is closed unless the query ran or failed on
+            # the server, a cancelled query still running on it
+            close = True
+            try:
+                cur = conn.cursor()
+                if prepare:
+                    await cls._prepare(conn, cur, *prepare)
+                cur.execute(query, parameters)
+                await wait(conn)
+                rows = []
+                if cur.description:
+                    rows = [row._asdict() for row in cur]
+                close = False
+                return rows
+            except (OperationalError, InterfaceError):
+                if attempt:
+                    raise
+                cls.pool.counters['retries'] += 1
+            except Exception:
+                close = False
+                raise
+            finally:
+                cls.pool.putconn(conn, close=close)
+
+    @classmethod
+    async def _prepare(cls, conn, cur, statement, sql):
+        prepared = cls.prepared.setdefault(conn, set())
+        new = statement not in prepared
+        if new:
+            cur.execute(sql)
+            await wait(conn)
+            prepared.add(statement)
+        Session._count_execution(statement, new)
+
+    @classmethod
+    def stats(cls):
+        """Same as Session.stats
+        """
+        return cls.pool.stats()
+
+    @classmethod
+    def init_app(cls, app):
+        cls.pool = AsyncConnectionPool(
+            "postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_NAME}"
+            .format(**app.config),
+            maxconn=app.config.get('PG_ASYNC_POOL_MAX', 100),
+            timeout=app.config.get('PG_POOL_TIMEOUT', 10))
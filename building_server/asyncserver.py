@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import asyncio
+from types import GeneratorType
+from urllib.parse import parse_qs
+from flask import abort
+from flask_restplus import inputs
+from werkzeug.exceptions import (HTTPException, BadRequest, NotFound,
+                                 MethodNotAllowed)
+from .asyncdatabase import AsyncSession
+from .cache import PrebuiltResponses
+from .server import (GetGeometry, GetGeometries, GetCities, GetCity,
+                     GetAttribute, lookup, negotiate, not_modified,
+                     response_headers, store)
+from .utils import CitiesConfig
+
+
+def run_in_executor(function, *args):
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, function, *args)
+
+
+async def attributes_for_gids(city, gids, attributes):
+    try:
+        return await AsyncSession.attributes_for_gids(city, gids, attributes)
+    except ValueError as e:
+        abort(400, str(e))
+
+
+class AsyncGetGeometry(GetGeometry):
+
+    async def _build(self, args):
+        city = args['city']
+        tile = args['tile']
+        children = self._children_quadtiles(tile)
+
+        values = {}
+        if self._format(args) == "geojson":
+            content = await AsyncSession.tile_content_geojson(city, tile,
+                                                              children)
+            values = await self._feature_values(city, args, [content])
+            return self._render(args, content, values)
+
+        # transcoding is CPU bound, it is kept out of the event loop
+        content = await AsyncSession.tile_content_binary(city, tile, children)
+        return await run_in_executor(self._render, args, content, values)
+
+    async def _feature_values(self, city, args, contents):
+        attributes = self._attributes(args)
+        if not attributes:
+            return {}
+        gids = [geom['gid'] for content in contents for geom in content[1]]
+        return await attributes_for_gids(city, gids, attributes)
+
+
+class AsyncGetGeometries(GetGeometries, AsyncGetGeometry):
+
+    async def _build(self, args):
+        city = args['city']
+        tiles = self._tile_list(args)
+        version = await AsyncSession.dataset_version(city)
+        keys = self._tile_keys(args, tiles, version)
+        (bodies, missing) = self._cached(keys)
+
+        contents = {}
+        values = {}
+        if missing:
+            children = {tile: self._children_quadtiles(tile)
+                        for tile in missing}
+            if self._format(args) == "geojson":
+                contents = await AsyncSession.tiles_content_geojson(city,
+                                                                    children)
+                values = await self._feature_values(city, args,
+                                                    contents.values())
+            else:
+                contents = await AsyncSession.tiles_content_binary(city,
+                                                                   children)
+
+        # parts are transcoded while the response is sent, in the executor
+        return (self._parts(args, tiles, keys, bodies, contents, values),
+                'application/octet-stream')
+
+
+class AsyncGetCities(GetCities):
+
+    async def _revision(self, args):
+        return GetCities._revision(self, args)
+
+    async def _build(self, args):
+        return GetCities._build(self, args)
+
+
+class AsyncGetCity(GetCity):
+
+    async def _revision(self, args):
+        index = await AsyncSession.bbox_index(args['city'])
+        if index is None:
+            return await AsyncSession.bbox_version(args['city'])
+        return index.version
+
+    async def _build(self, args):
+        tiles = await AsyncSession.tiles_for_level(args['city'], 0)
+        return (self._tiles(tiles), 'text/plain')
+
+
+class AsyncGetAttribute(GetAttribute):
+
+    async def _build(self, args):
+        (gids, attributes) = self._arguments(args)
+        values = await attributes_for_gids(args['city'], gids, attributes)
+        return (self._values(gids, attributes, values), 'text/plain')
+
+
+class Application(object):
+    """
+    ASGI application serving the endpoints of the Flask application
+
+    Requests waiting for the db only hold a coroutine, so that a single
+    process serves many concurrent requests. The Flask application is only
+    used for its configuration.
+    """
+
+    # endpoints and their (name, type, required, default) arguments, as
+    # parsed by app.py
+    ROUTES = {
+        '/getGeometry': (AsyncGetGeometry, [
+            ('city', str, True, None),
+            ('tile', str, True, None),
+            ('format', str, False, None),
+            ('attributes', str, False, None),
+            ('merge', inputs.boolean, False, False),
+            ('quantize', inputs.boolean, False, False)]),
+        '/getGeometries': (AsyncGetGeometries, [
+            ('city', str, True, None),
+            ('tiles', str, True, None),
+            ('format', str, False, None),
+            ('attributes', str, False, None),
+            ('merge', inputs.boolean, False, False),
+            ('quantize', inputs.boolean, False, False)]),
+        '/getCities': (AsyncGetCities, []),
+        '/getCity': (AsyncGetCity, [
+            ('city', str, True, None)]),
+        '/getAttribute': (AsyncGetAttribute, [
+            ('city', str, True, None),
+            ('gid', str, True, None),
+            ('attribute', str, True, None)])
+    }
+
+    def __init__(self, app):
+        self.prefix = app.config.get('URL_PREFIX', '')
+        AsyncSession.init_app(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        try:
+            (endpoint, arguments) = self.route(scope)
+            args = self.parse(scope['query_string'], arguments)
+            await self.run(send, scope, endpoint(), args)
+        except HTTPException as e:
+            body = json.dumps({'message': e.description})
+            await self.respond(send, e.code, body, 'application/json')
+
+    async def run(self, send, scope, endpoint, args):
+        # same as server.respond
+        headers = dict(scope['headers'])
+        accept = headers.get(b'accept-encoding', b'').decode('latin-1')
+        ifNoneMatch = headers.get(b'if-none-match', b'').decode('latin-1')
+
+        key = endpoint._key(args)
+        version = None
+        if key is not None and key[1] is None:
+            version = CitiesConfig.version
+        elif key is not None:
+            version = await AsyncSession.dataset_version(key[1])
+        (cacheKey, encoding, etag) = negotiate(key, version, accept)
+
+        if not_modified(etag, ifNoneMatch):
+            await self.respond(send, 304, b'', None, None, endpoint.ENDPOINT,
+                               etag)
+            return
+
+        # compression and the disk cache are kept out of the event loop
+        if endpoint.PREBUILT:
+            revision = (version, await endpoint._revision(args))
+            cached = PrebuiltResponses.get(key, revision, encoding)
+            if cached is None:
+                (body, contentType) = await endpoint._build(args)
+                cached = await run_in_executor(PrebuiltResponses.put, key,
+                                               revision, body, contentType,
+                                               encoding)
+        else:
+            cached = await run_in_executor(lookup, cacheKey, encoding)
+            if cached is None:
+                (body, contentType) = await endpoint._build(args)
+                cached = await run_in_executor(store, cacheKey, body,
+                                               contentType, encoding)
+        await self.respond(send, 200, *cached, endpoint.ENDPOINT, etag)
+
+    def route(self, scope):
+        path = scope['path']
+        if not path.startswith(self.prefix):
+            raise NotFound()
+        route = self.ROUTES.get(path[len(self.prefix):])
+        if route is None:
+            raise NotFound()
+        if scope['method'] != 'GET':
+            raise MethodNotAllowed(['GET'])
+        return route
+
+    def parse(self, query, arguments):
+        values = parse_qs(query.decode('utf-8'), keep_blank_values=True)
+        args = {}
+        for (name, kind, required, default) in arguments:
+            if name not in values:
+                if required:
+                    raise BadRequest("Missing required parameter {0}"
+                                     .format(name))
+                args[name] = default
+                continue
+
+            try:
+                args[name] = kind(values[name][0])
+            except ValueError as e:
+                raise BadRequest("{0}: {1}".format(name, e))
+        return args
+
+    async def respond(self, send, status, body, contentType, encoding=None,
+                      endpoint=None, etag=None):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for (name, value) in response_headers(
+                       endpoint, contentType, encoding, etag)]
+
+        if hasattr(body, 'fileno'):
+            # a file from the disk cache is sent in chunks
+            with body:
+                size = os.fstat(body.fileno()).st_size
+                headers.append((b'content-length', str(size).encode()))
+                await send({'type': 'http.response.start', 'status': status,
+                            'headers': headers})
+                chunk = await run_in_executor(body.read, 1 << 16)
+                while chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                    chunk = await run_in_executor(body.read, 1 << 16)
+                await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if isinstance(body, GeneratorType):
+            # a body built as an iterator is streamed, its chunks being
+            # produced in the executor as they may need transcoding
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': headers})
+            while True:
+                chunk = await run_in_executor(next, body, None)
+                if chunk is None:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        body = bytes(body)
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                AsyncSession.pool.closeall()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
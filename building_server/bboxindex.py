@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .utils import Box3D
+
+
+class BboxIndex(object):
+    """
+    Quadtile hierarchy of a city, as stored in its <table>_bbox table
+
+    Bboxes are kept both as the 'BOX3D(...)' strings of the database, so
+    that responses are unchanged, and as a (n, 6) float array of
+    xmin, ymin, zmin, xmax, ymax, zmax rows.
+    """
+
+    def __init__(self, rows, version=None):
+        """
+        rows is a list of (quadtile, bbox) with bbox as a 'BOX3D(...)' string
+        """
+        self.version = version
+        self.checked = None
+        self.quadtiles = [row[0] for row in rows]
+        self.texts = [row[1] for row in rows]
+        self.rows = {q: i for (i, q) in enumerate(self.quadtiles)}
+        self.levels = np.array([int(q.split('/', 1)[0])
+                                for q in self.quadtiles], dtype=np.int32)
+
+        self.corners = Box3D.parse(self.texts)
+
+    def offset(self, tile):
+        """Returns the lower corner of the tile or None
+        """
+        i = self.rows.get(tile)
+        if i is None:
+            return None
+        return self.corners[i, 0:3].tolist()
+
+    def bbox_for_quadtiles(self, quadtiles):
+        """Returns a {'quadtile', 'bbox'} dict for each existing quadtile
+        """
+        return [{'quadtile': q, 'bbox': self.texts[self.rows[q]]}
+                for q in quadtiles if q in self.rows]
+
+    def tiles_for_level(self, level):
+        """Returns a {'quadtile', 'bbox'} dict for each tile of the level
+        """
+        return [{'quadtile': self.quadtiles[i], 'bbox': self.texts[i]}
+                for i in np.flatnonzero(self.levels == level)]
+
+    def children(self, tile):
+        """Returns the quadtiles of the existing children of the tile
+        """
+        [z, y, x] = map(int, tile.split("/"))
+        quadtiles = ["{0}/{1}/{2}".format(z + 1, 2 * y + j, 2 * x + i)
+                     for i in range(0, 2) for j in range(0, 2)]
+        return [q for q in quadtiles if q in self.rows]
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .compression import Compression
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache bounded by the total size of its
+    values
+
+    Keys are tuples whose second item is the city, so that all the entries of
+    a city can be invalidated at once. Values are (body, ...) tuples and
+    their size is the length of the body.
+    """
+
+    def __init__(self, maxbytes, ttl=None):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (value, size, expiry)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['hits', 'misses', 'evictions', 'expirations'], 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                self.counters['expirations'] += 1
+                entry = None
+
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = len(value[0])
+        if size > self.maxbytes:
+            return
+
+        expiry = float('inf')
+        if self.ttl:
+            expiry = time.monotonic() + self.ttl
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expiry)
+            self.size += size
+
+            while self.size > self.maxbytes:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def invalidate(self, city):
+        with self.lock:
+            for key in [k for k in self.entries if k[1] == city]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), bytes=self.size)
+        return stats
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[1]
+
+
+class DiskCache(object):
+    """
+    Content addressed cache on disk shared by all the processes of a host
+
+    Bodies are stored once in objects/<sha1 of the body> and each key has an
+    index file, index/<city>/<sha1 of the key>, holding the hash of its body
+    and its content type. Files are written in tmp/ and renamed in place so
+    readers never see partial files. Once maxbytes is exceeded the objects
+    used the longest time ago are removed, a hit refreshing the
+    modification time of its object.
+    """
+
+    def __init__(self, root, maxbytes):
+        self.root = root
+        self.maxbytes = maxbytes
+        self.written = 0
+        self.counters = dict.fromkeys(['hits', 'misses'], 0)
+        for d in ['objects', 'index', 'tmp']:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    def get(self, key):
+        """Returns a (file, size, content type) tuple or None
+        """
+        try:
+            with open(self._index(key), 'r') as index:
+                (digest, contentType) = index.read().split(' ', 1)
+            f = open(self._object(digest), 'rb')
+        except FileNotFoundError:
+            # never cached, cleared or body evicted
+            self.counters['misses'] += 1
+            return None
+
+        self.counters['hits'] += 1
+        os.utime(f.fileno())
+        return (f, os.fstat(f.fileno()).st_size, contentType)
+
+    def put(self, key, body, contentType):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) > self.maxbytes:
+            return
+
+        digest = hashlib.sha1(body).hexdigest()
+        path = self._object(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, body)
+            self.written += len(body)
+
+        index = self._index(key)
+        os.makedirs(os.path.dirname(index), exist_ok=True)
+        self._write(index, '{0} {1}'.format(digest, contentType).encode())
+
+        if self.written > self.maxbytes // 10:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used objects until the cache is back
+        under 90% of its size
+        """
+        self.written = 0
+        objects = []
+        for (dirpath, dirnames, filenames) in os.walk(
+                os.path.join(self.root, 'objects')):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, path))
+
+        size = sum(o[1] for o in objects)
+        for (mtime, osize, path) in sorted(objects):
+            if size <= 0.9 * self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= osize
+
+    def clear(self, city=None):
+        """Forgets the responses of the city, or of all the cities. Their
+        bodies are removed later on by evict
+        """
+        index = os.path.join(self.root, 'index')
+        if city is not None:
+            index = os.path.join(index, city)
+        shutil.rmtree(index, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, 'index'), exist_ok=True)
+
+    def _write(self, path, data):
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _object(self, digest):
+        return os.path.join(self.root, 'objects', digest[0:2], digest)
+
+    def _index(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'index', str(key[1]), digest)
+
+
+class ResponseCache(object):
+    """
+    Cache of the responses of the endpoints, keyed by (endpoint, city, ...)
+    tuples and holding (body, content type) tuples
+
+    The in-process tier is enabled by a positive RESPONSE_CACHE_SIZE and the
+    disk tier shared by the processes by RESPONSE_CACHE_DIR and a positive
+    RESPONSE_CACHE_DISK_SIZE. Disk hits are returned as open files.
+    """
+    memory = None
+    disk = None
+
+    @classmethod
+    def init_app(cls, app):
+        size = app.config.get('RESPONSE_CACHE_SIZE', 0)
+        cls.memory = None
+        if size > 0:
+            cls.memory = LRUCache(size, app.config.get('RESPONSE_CACHE_TTL'))
+
+        root = app.config.get('RESPONSE_CACHE_DIR')
+        size = app.config.get('RESPONSE_CACHE_DISK_SIZE', 0)
+        cls.disk = None
+        if root and size > 0:
+            cls.disk = DiskCache(root, size)
+
+    @classmethod
+    def enabled(cls):
+        return cls.memory is not None or cls.disk is not None
+
+    @classmethod
+    def get(cls, key):
+        """Returns a (body, content type) tuple or None. The body is an open
+        file when it comes from the disk tier.
+        """
+        cached = None
+        if cls.memory is not None:
+            cached = cls.memory.get(key)
+        if cached is None and cls.disk is not None:
+            cached = cls.disk.get(key)
+            if cached is not None:
+                cached = (cached[0], cached[2])
+        return cached
+
+    @classmethod
+    def put(cls, key, body, contentType):
+        if cls.memory is not None:
+            cls.memory.put(key, (body, contentType))
+        if cls.disk is not None:
+            cls.disk.put(key, body, contentType)
+
+    @classmethod
+    def invalidate(cls, city):
+        """Removes all the responses for the city
+        """
+        if cls.memory is not None:
+            cls.memory.invalidate(city)
+        if cls.disk is not None:
+            cls.disk.clear(city)
+
+    @classmethod
+    def stats(cls):
+        """Returns the 'hits', 'misses', 'evictions' and 'expirations'
+        counters and the current number of 'entries' and 'bytes' of the
+        in-process tier, and the 'hits' and 'misses' of this process on the
+        disk tier as 'disk'
+        """
+        stats = {}
+        if cls.memory is not None:
+            stats = cls.memory.stats()
+        if cls.disk is not None:
+            stats['disk'] = dict(cls.disk.counters)
+        return stats
+
+
+class PrebuiltResponses(object):
+    """
+    Responses of the endpoints every client session starts with, kept as
+    bytes along with their compressed variants for all the offered content
+    codings
+
+    Entries are built for a revision of their data, such as the dataset
+    version, and are built again once the revision changes.
+    """
+    entries = {}    # key -> (revision, {encoding: (body, type, encoding)})
+
+    @classmethod
+    def get(cls, key, revision, encoding):
+        """Returns the (body, content type, encoding) of the response for
+        the revision and the content coding, or None
+        """
+        entry = cls.entries.get(key)
+        if entry is None or entry[0] != revision:
+            return None
+        return entry[1].get(encoding) or entry[1][None]
+
+    @classmethod
+    def put(cls, key, revision, body, contentType, encoding):
+        """Stores a response and returns it as get does
+        """
+        if not isinstance(body, (str, bytes, bytearray)):
+            body = ''.join(body)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        body = bytes(body)
+
+        variants = {None: (body, contentType, None)}
+        if len(body) >= Compression.minsize:
+            for e in Compression.encodings:
+                variants[e] = (Compression.compress(body, e), contentType, e)
+        cls.entries[key] = (revision, variants)
+        return variants.get(encoding) or variants[None]
+
+    @classmethod
+    def clear(cls):
+        cls.entries = {}
+
+
+class HTTPCache(object):
+    """
+    Validators and lifetimes of the responses for the browsers and proxies
+
+    Responses of a city get a strong ETag derived from their cache key and
+    the dataset version of the city, so that they change with each
+    processdb run. CACHE_MAX_AGE gives the Cache-Control lifetime in
+    seconds of the responses of each endpoint.
+    """
+    maxages = {}
+
+    @classmethod
+    def init_app(cls, app):
+        cls.maxages = app.config.get('CACHE_MAX_AGE') or {}
+
+    @classmethod
+    def etag(cls, key, encoding=None):
+        """Returns the ETag of the response for the key, which ends with the
+        dataset version, as compressed with encoding
+        """
+        etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        if encoding is not None:
+            etag = '{0}-{1}'.format(etag, encoding)
+        return etag
+
+    @classmethod
+    def cache_control(cls, endpoint):
+        maxage = cls.maxages.get(endpoint)
+        if maxage is None:
+            return None
+        return 'public, max-age={0}'.format(maxage)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class BrotliCompressor(object):
+    """
+    zlib.compressobj like interface of a brotli compressor
+    """
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class Compression(object):
+    """
+    HTTP compression of the responses
+
+    COMPRESSION_ENCODINGS lists the content codings offered, by order of
+    preference among the ones the client accepts with the same quality.
+    'br' is only offered when the brotli module is installed. Bodies
+    smaller than COMPRESSION_MIN_SIZE bytes are sent as is. With
+    COMPRESSION_CACHE the compressed bodies are stored in the response
+    cache next to the identity ones.
+    """
+    encodings = []
+    minsize = 1024
+    level = 6
+    cache = False
+
+    # wbits of zlib.compressobj for the gzip and zlib (HTTP deflate) formats
+    WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+    @classmethod
+    def init_app(cls, app):
+        encodings = app.config.get('COMPRESSION_ENCODINGS') or []
+        cls.encodings = [e for e in encodings
+                         if e in cls.WBITS or (e == 'br' and brotli)]
+        cls.minsize = app.config.get('COMPRESSION_MIN_SIZE', 1024)
+        cls.level = app.config.get('COMPRESSION_LEVEL', 6)
+        cls.cache = app.config.get('COMPRESSION_CACHE', False)
+
+    @classmethod
+    def negotiate(cls, accept):
+        """Returns the content coding to use for an Accept-Encoding header,
+        or None for the identity
+        """
+        if not cls.encodings or not accept:
+            return None
+        return parse_accept_header(accept).best_match(cls.encodings)
+
+    @classmethod
+    def compressor(cls, encoding):
+        if encoding == 'br':
+            # brotli qualities go up to 11 where zlib levels stop at 9
+            return BrotliCompressor(min(11, cls.level + 2))
+        return zlib.compressobj(cls.level, zlib.DEFLATED, cls.WBITS[encoding])
+
+    @classmethod
+    def compress(cls, data, encoding):
+        compressor = cls.compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    @classmethod
+    def chunks(cls, chunks, encoding):
+        """Compresses a stream of str or bytes chunks
+        """
+        compressor = cls.compressor(encoding)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
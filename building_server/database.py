@@ -1,19 +1,232 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import struct
+import time
+import threading
+import weakref
 from itertools import chain
-from psycopg2 import connect
+from psycopg2 import connect, Binary, Error, OperationalError, InterfaceError
+from psycopg2.errors import UndefinedTable
+from psycopg2.pool import PoolError
 from psycopg2.extras import NamedTupleCursor
 
-from .utils import CitiesConfig
+from .bboxindex import BboxIndex
+from .utils import Box3D, CitiesConfig
+
+
+# header of a binary COPY, followed by flags and header extension lengths
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+COPY_TYPES = {
+    'int2': lambda b: struct.unpack('>h', b)[0],
+    'int4': lambda b: struct.unpack('>i', b)[0],
+    'int8': lambda b: struct.unpack('>q', b)[0],
+    'float8': lambda b: struct.unpack('>d', b)[0],
+    'text': lambda b: str(b, 'utf-8'),
+    'bytea': lambda b: b
+}
+
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+
+
+def parse_copy(data, columns):
+    """Decodes the rows of a binary COPY
+
+    Parameters
+    ----------
+    data : memoryview
+    columns : list
+        (name, type) of each column with types among COPY_TYPES
+
+    Returns
+    -------
+    res : list
+        List of dict
+    """
+    if bytes(data[0:11]) != COPY_SIGNATURE:
+        raise ValueError("Not a binary COPY")
+    offset = 15 + _INT32.size + _INT32.unpack_from(data, 15)[0]
+
+    decoders = [(name, COPY_TYPES[t]) for (name, t) in columns]
+    rows = []
+    while _INT16.unpack_from(data, offset)[0] != -1:
+        offset += _INT16.size
+        row = {}
+        for (name, decode) in decoders:
+            length = _INT32.unpack_from(data, offset)[0]
+            offset += _INT32.size
+            if length < 0:
+                row[name] = None
+            else:
+                row[name] = decode(data[offset:offset + length])
+                offset += length
+        rows.append(row)
+
+    return rows
+
+
+class CopyBuffer(object):
+    """
+    Growable buffer receiving binary COPY data, reused from one request to
+    the next
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.data = bytearray(capacity)
+        self.size = 0
+
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > len(self.data):
+            # a new bytearray leaves the memoryviews handed out intact
+            data = bytearray(max(end, 2 * len(self.data)))
+            data[0:self.size] = self.data[0:self.size]
+            self.data = data
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def view(self, start=0):
+        return memoryview(self.data)[start:self.size]
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of autocommit connections to the db
+
+    Connections are opened by the process using them, so that uWSGI workers
+    never share the connections of the master they are forked from.
+    Connections idle for more than `idle` seconds are checked before being
+    handed out again, and closed if the pool holds more than `minconn`.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=4, timeout=10, idle=30):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle = idle
+        self.lock = threading.Condition()
+        self.free = []      # (connection, time of release)
+        self.used = 0
+        self.pid = None
+        self.counters = dict.fromkeys(
+            ['checkouts', 'waits', 'connects', 'reconnects', 'retries'], 0)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """Returns the usage counters of the pool and its current size
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(free=len(self.free), used=self.used,
+                         size=len(self.free) + self.used)
+        return stats
+
+    def getconn(self):
+        """Checks out a live connection, waiting for one to be released if
+        maxconn connections are already in use
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.free = []
+                self.used = 0
+                self.pid = os.getpid()
+
+            deadline = time.monotonic() + self.timeout
+            while not self.free and self.used >= self.maxconn:
+                self.counters['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    raise PoolError("no connection available after {0}s"
+                                    .format(self.timeout))
+            self.used += 1
+            self.counters['checkouts'] += 1
+            (conn, since) = self.free.pop() if self.free else (None, None)
+
+        try:
+            if conn is None:
+                conn = self.connect()
+            elif not self.alive(conn, since):
+                conn.close()
+                conn = self.connect()
+                self.count('reconnects')
+        except Exception:
+            self.putconn(None)
+            raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Gives a connection back to the pool, close it if it is broken
+        """
+        now = time.monotonic()
+        with self.lock:
+            if conn is not None and not close and not conn.closed:
+                self.free.append((conn, now))
+            elif conn is not None:
+                conn.close()
+
+            # free connections are used last in first out, so the oldest ones
+            # are the first to be closed
+            while (len(self.free) > self.minconn
+                   and now - self.free[0][1] > self.idle):
+                self.free.pop(0)[0].close()
+
+            self.used -= 1
+            self.lock.notify()
+
+    def connect(self):
+        conn = connect(self.dsn, cursor_factory=NamedTupleCursor)
+        # autocommit mode for performance (we don't need transaction)
+        conn.autocommit = True
+        self.count('connects')
+        return conn
+
+    def alive(self, conn, since):
+        if conn.closed:
+            return False
+        if time.monotonic() - since <= self.idle:
+            return True
+        try:
+            conn.cursor().execute("SELECT 1")
+            return True
+        except Error:
+            return False
 
 
 class Session():
     """
     Session object used as a global connection object to the db
 
-    # FIXME: handle disconnection
+    Each thread checks out a connection from the pool on its first query and
+    keeps it until release() is called at the end of the request.
+
+    With a BBOX_INDEX_CHECK delay, the bbox table of each city is loaded once
+    in a BboxIndex which answers the tile hierarchy queries without the
+    database. The table is checked for changes at most once per delay.
+    Likewise the dataset versions stamped by processdb are read at most once
+    per VERSION_CHECK delay.
     """
-    db = None
+    pool = None
+    binary_fetch = False
+    local = threading.local()
+    mesh_tables = {}
+    index_check = None
+    indexes = {}
+    version_check = None
+    versions = {}
+
+    # dataset version of each city, written by processdb
+    VERSION_TABLE = 'building_server_versions'
+    # names of the statements prepared on each connection
+    prepared = weakref.WeakKeyDictionary()
+    statements = {}
+    statements_lock = threading.Lock()
 
     @classmethod
     def offset(cls, city, tile):
@@ -31,20 +244,23 @@ class Session():
             [x, y, z] as float or None if no tile is found
         """
 
-        sql = ("SELECT bbox from {0}_bbox WHERE quadtile = '{1}'"
-               .format(CitiesConfig.table(city), tile))
-        res = cls.query_aslist(sql)
+        index = cls.bbox_index(city)
+        if index is not None:
+            return index.offset(tile)
+
+        sql = "SELECT bbox from {0}_bbox WHERE quadtile = $1"
+        res = cls.query_prepared('offset', city, sql, ['varchar'], [tile])
 
         offset = None
         if res:
-            o = res[0]
-            box3D = o[6:len(o)-1]   # remove "BOX(" and ")"
-            part = box3D.split(',')
-            p = part[0].split(' ')
-            offset = [float(p[0]), float(p[1]), float(p[2])]
+            offset = cls._lower_corner(res[0]['bbox'])
 
         return offset
 
+    @staticmethod
+    def _lower_corner(bbox):
+        return Box3D(bbox).corners()[0]
+
     @classmethod
     def tile_geom_geojson(cls, city, offset, tile):
         """Returns a list of geometries in string representation.
@@ -67,16 +283,16 @@ class Session():
         """
 
         sql = ("SELECT gid, ST_AsGeoJSON(ST_Translate(geom,"
-               "{2},{3},{4}), 2, 1) AS geom from {0}"
-               " WHERE quadtile='{1}'"
-               .format(CitiesConfig.table(city), tile, -offset[0], -offset[1],
-                       -offset[2]))
-        res = cls.query_asdict(sql)
+               "$2, $3, $4), 2, 1) AS geom from {0}"
+               " WHERE quadtile = $1")
+        res = cls.query_prepared('tile_geom_geojson', city, sql,
+                                 ['varchar', 'float8', 'float8', 'float8'],
+                                 [tile, -offset[0], -offset[1], -offset[2]])
 
         return res
 
     @classmethod
-    def tile_geom_binary(cls, city, tile):
+    def tile_geom_binary(cls, city, tile, prebuilt=True):
         """Returns a list of geometries in binary representation
 
         Parameters
@@ -84,18 +300,347 @@ class Session():
         city : str
         tile : str
             '6/22/28'
+        prebuilt : bool
+            Returns the meshes of the <table>_mesh table when it exists
 
         Returns
         -------
         res : list
-            List of OrderedDict with 'box3D' and 'binary' keys.
+            List of OrderedDict with 'gid', 'box3d' and either a 'binary'
+            key with the WKB geometry or a 'mesh' key with the mesh packed
+            by transcode.packMesh.
         """
 
-        sql = ("SELECT Box3D(geom), ST_AsBinary(geom) as binary from {0}"
-               " where quadtile='{1}'".format(CitiesConfig.table(city), tile))
-        res = cls.query_asdict(sql)
+        def query(mesh):
+            if mesh:
+                name = 'tile_mesh_binary'
+                sql = ("SELECT g.gid, m.bbox as box3d, m.mesh from {0} g"
+                       " join {0}_mesh m on m.gid = g.gid"
+                       " where g.quadtile = $1")
+            else:
+                name = 'tile_geom_binary'
+                sql = ("SELECT gid, Box3D(geom), ST_AsBinary(geom) as binary"
+                       " from {0} where quadtile = $1")
+            return cls.query_prepared(name, city, sql, ['varchar'], [tile])
 
-        return res
+        return cls._with_meshes(city, prebuilt, query)
+
+    @classmethod
+    def tile_content_binary(cls, city, tile, children, prebuilt=True):
+        """Returns everything getGeometry needs for a tile in a single query
+
+        Parameters
+        ----------
+        city : str
+        tile : str
+            '6/22/28'
+        children : list
+            Quadtiles whose bbox is returned, such as ["7/44/56", ...]
+        prebuilt : bool
+            Returns the meshes of the <table>_mesh table when it exists
+
+        Returns
+        -------
+        res : tuple
+            (offset, geoms, bboxes) where offset is as returned by offset,
+            geoms as returned by tile_geom_binary and bboxes as returned by
+            bbox_for_quadtiles. With PG_BINARY_FETCH the 'box3d' of geoms
+            is a (xmin, ymin, zmin, xmax, ymax, zmax) tuple and the 'binary'
+            or 'mesh' a memoryview valid until the end of the request.
+        """
+
+        # with the bbox index only the features are queried
+        index = cls.bbox_index(city)
+        parameters = [tile, list(children)]
+
+        def query(mesh):
+            (name, key, sql) = cls._tile_content_binary_sql(
+                mesh, cls.binary_fetch, index is None)
+            if cls.binary_fetch:
+                rows = cls.query_binary(city, sql, parameters,
+                                        cls.TILE_CONTENT_COLUMNS)
+            else:
+                rows = cls.query_prepared(name, city, sql,
+                                          ['varchar', 'varchar[]'],
+                                          parameters)
+            return cls._tile_content(rows, 'box3d', key)
+
+        return cls._tile_metadata(index, tile, children,
+                                  cls._with_meshes(city, prebuilt, query))
+
+    @classmethod
+    def tile_content_geojson(cls, city, tile, children):
+        """Returns everything getGeometry needs for a tile in a single query
+
+        Parameters
+        ----------
+        city : str
+        tile : str
+            '6/22/28'
+        children : list
+            Quadtiles whose bbox is returned, such as ["7/44/56", ...]
+
+        Returns
+        -------
+        res : tuple
+            (offset, geoms, bboxes) where offset is as returned by offset,
+            geoms as returned by tile_geom_geojson and bboxes as returned by
+            bbox_for_quadtiles
+        """
+
+        index = cls.bbox_index(city)
+        (name, sql) = cls._tile_content_geojson_sql(index is None)
+        rows = cls.query_prepared(name, city, sql, ['varchar', 'varchar[]'],
+                                  [tile, list(children)])
+        return cls._tile_metadata(index, tile, children,
+                                  cls._tile_content(rows, None, 'geom'))
+
+    @classmethod
+    def _tile_content_binary_sql(cls, mesh, numeric, metadata, batch=False):
+        # returns the statement name, the data key and the query. Batch
+        # queries return the features of the tiles of $1, with no metadata
+        where = "quadtile = $1"
+        if batch:
+            where = "quadtile = ANY($1)"
+
+        if mesh:
+            (name, key) = ('tile_content_mesh', 'mesh')
+            sql = cls._tile_content_sql(
+                "g.gid", "m.bbox", "m.mesh",
+                "{0} g join {0}_mesh m on m.gid = g.gid where g." + where,
+                numeric, metadata, "g.quadtile" if batch else None)
+        else:
+            (name, key) = ('tile_content_binary', 'binary')
+            sql = cls._tile_content_sql(
+                "gid", "Box3D(geom)", "ST_AsBinary(geom)",
+                "{0} where " + where, numeric, metadata,
+                "quadtile" if batch else None)
+
+        if batch:
+            name += '_batch'
+        elif not metadata:
+            name += '_features'
+        return (name, key, sql)
+
+    @classmethod
+    def _tile_content_geojson_sql(cls, metadata, batch=False):
+        # returns the statement name and the query
+        name = 'tile_content_geojson'
+        source = "{0} g, {0}_bbox b where g.quadtile = $1 and b.quadtile = $1"
+        if batch:
+            name += '_batch'
+            source = ("{0} g, {0}_bbox b where g.quadtile = ANY($1)"
+                      " and b.quadtile = g.quadtile")
+        elif not metadata:
+            name += '_features'
+
+        sql = cls._tile_content_sql(
+            "g.gid", None,
+            "ST_AsGeoJSON(ST_Translate(g.geom, -ST_XMin(b.bbox),"
+            " -ST_YMin(b.bbox), -ST_ZMin(b.bbox)), 2, 1)",
+            source, metadata=metadata, quadtile="g.quadtile" if batch else None)
+        return (name, sql)
+
+    @classmethod
+    def tiles_content_binary(cls, city, children, prebuilt=True):
+        """Returns everything getGeometry needs for several tiles in two
+        queries, or one with the bbox index
+
+        Parameters
+        ----------
+        city : str
+        children : dict
+            Quadtiles whose bbox is returned for each tile, such as
+            {"6/22/28": ["7/44/56", ...], ...}
+        prebuilt : bool
+            Returns the meshes of the <table>_mesh table when it exists
+
+        Returns
+        -------
+        res : dict
+            (offset, geoms, bboxes) for each tile, as returned by
+            tile_content_binary
+        """
+
+        parameters = [list(children)]
+
+        def query(mesh):
+            (name, key, sql) = cls._tile_content_binary_sql(
+                mesh, cls.binary_fetch, False, True)
+            if cls.binary_fetch:
+                rows = cls.query_binary(city, sql, parameters,
+                                        cls.TILE_CONTENT_COLUMNS)
+            else:
+                rows = cls.query_prepared(name, city, sql, ['varchar[]'],
+                                          parameters)
+            return (rows, key)
+
+        (rows, key) = cls._with_meshes(city, prebuilt, query)
+        bboxes = cls.bbox_for_quadtiles(city, cls._tiles_quadtiles(children))
+        return cls._tiles_content(children, rows, bboxes, 'box3d', key)
+
+    @classmethod
+    def tiles_content_geojson(cls, city, children):
+        """Returns everything getGeometry needs for several tiles in two
+        queries, or one with the bbox index
+
+        Parameters
+        ----------
+        city : str
+        children : dict
+            Quadtiles whose bbox is returned for each tile, such as
+            {"6/22/28": ["7/44/56", ...], ...}
+
+        Returns
+        -------
+        res : dict
+            (offset, geoms, bboxes) for each tile, as returned by
+            tile_content_geojson
+        """
+
+        (name, sql) = cls._tile_content_geojson_sql(False, True)
+        rows = cls.query_prepared(name, city, sql, ['varchar[]'],
+                                  [list(children)])
+        bboxes = cls.bbox_for_quadtiles(city, cls._tiles_quadtiles(children))
+        return cls._tiles_content(children, rows, bboxes, None, 'geom')
+
+    @staticmethod
+    def _tiles_quadtiles(children):
+        # the tiles and all their children
+        return list(children) + list(chain(*children.values()))
+
+    @classmethod
+    def _tiles_content(cls, children, rows, bboxes, bboxKey, dataKey):
+        # features are grouped by tile, and offsets and children bboxes
+        # picked from the bboxes of all the quadtiles
+        features = {tile: [] for tile in children}
+        for row in rows:
+            features[row['quadtile']].append(row)
+        bboxes = {bbox['quadtile']: bbox for bbox in bboxes}
+
+        content = {}
+        for (tile, quadtiles) in children.items():
+            offset = None
+            if tile in bboxes:
+                offset = cls._lower_corner(bboxes[tile]['bbox'])
+            geoms = cls._tile_content(features[tile], bboxKey, dataKey)[1]
+            content[tile] = (offset, geoms,
+                             [bboxes[q] for q in quadtiles if q in bboxes])
+        return content
+
+    # columns of the tile content queries, kind 0 is the tile itself, 1 its
+    # features and 2 its children
+    TILE_CONTENT_COLUMNS = [('kind', 'int2'), ('gid', 'int8'),
+                            ('quadtile', 'text'), ('bbox', 'text'),
+                            ('xmin', 'float8'), ('ymin', 'float8'),
+                            ('zmin', 'float8'), ('xmax', 'float8'),
+                            ('ymax', 'float8'), ('zmax', 'float8'),
+                            ('data', 'bytea')]
+
+    @staticmethod
+    def _tile_content_sql(gid, box, data, source, numeric=False,
+                          metadata=True, quadtile=None):
+        # features bboxes are either text or numeric corners, and features
+        # of batch queries come with their quadtile
+        corners = ["NULL::float8"] * 6
+        featureBox = ["{0}::text".format(box or "NULL")] + corners
+        if numeric:
+            featureBox = ["NULL::text"] + [
+                "ST_{0}({1})".format(f, box)
+                for f in ['XMin', 'YMin', 'ZMin', 'XMax', 'YMax', 'ZMax']]
+
+        quadtile = "{0}::text".format(quadtile or "NULL")
+        branches = [(["1::int2", "{0}::int8".format(gid), quadtile]
+                     + featureBox + [data],
+                     source)]
+        if metadata:
+            branches.insert(0, (
+                ["0::int2", "NULL::int8", "NULL::text", "bbox::text"]
+                + corners + ["NULL"], "{0}_bbox where quadtile = $1"))
+            branches.append((
+                ["2::int2", "NULL::int8", "quadtile::text", "bbox::text"]
+                + corners + ["NULL"], "{0}_bbox where quadtile = ANY($2)"))
+
+        # columns are named in every branch as any of them may come first
+        names = [c[0] for c in Session.TILE_CONTENT_COLUMNS]
+        return " UNION ALL ".join(
+            "SELECT {0} from {1}".format(
+                ", ".join("{0} as {1}".format(e, n)
+                          for (e, n) in zip(expressions, names)), source)
+            for (expressions, source) in branches)
+
+    @staticmethod
+    def _tile_metadata(index, tile, children, content):
+        # offset and children bboxes come from the bbox index if any
+        if index is None:
+            return content
+        return (index.offset(tile), content[1],
+                index.bbox_for_quadtiles(children))
+
+    @classmethod
+    def _tile_content(cls, rows, bboxKey, dataKey):
+        offset = None
+        geoms = []
+        bboxes = []
+        for row in rows:
+            if row['kind'] == 1:
+                geom = {'gid': row['gid'], dataKey: row['data']}
+                if bboxKey:
+                    geom[bboxKey] = row['bbox']
+                    if row['bbox'] is None:
+                        geom[bboxKey] = (row['xmin'], row['ymin'],
+                                         row['zmin'], row['xmax'],
+                                         row['ymax'], row['zmax'])
+                geoms.append(geom)
+            elif row['kind'] == 2:
+                bboxes.append({'quadtile': row['quadtile'],
+                               'bbox': row['bbox']})
+            else:
+                offset = cls._lower_corner(row['bbox'])
+
+        return (offset, geoms, bboxes)
+
+    @classmethod
+    def has_mesh_table(cls, city):
+        """Returns True if the mesh table of the city exists. The answer is
+        kept until the dataset version of the city changes or a query finds
+        the table dropped.
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        exists : bool
+        """
+
+        version = cls.dataset_version(city)
+        cached = cls.mesh_tables.get(city)
+        if cached is None or cached[0] != version:
+            sql = cls._mesh_table_sql(city)
+            cached = (version, cls.query_aslist(sql)[0])
+            cls.mesh_tables[city] = cached
+
+        return cached[1]
+
+    @staticmethod
+    def _mesh_table_sql(city):
+        return ("SELECT to_regclass('{0}_mesh') is not null as found"
+                .format(CitiesConfig.table(city)))
+
+    @classmethod
+    def _with_meshes(cls, city, prebuilt, query):
+        # runs query(mesh), mesh telling whether to read the <table>_mesh
+        # table, and again without it if processdb dropped the table since
+        mesh = prebuilt and cls.has_mesh_table(city)
+        try:
+            return query(mesh)
+        except UndefinedTable:
+            if not mesh:
+                raise
+            cls.mesh_tables.pop(city, None)
+            return query(False)
 
     @classmethod
     def attribute_for_gid(cls, city, gid, attribute):
@@ -112,9 +657,9 @@ class Session():
         val : str
         """
 
-        sql = ("SELECT {0} FROM {1} WHERE gid = {2}"
-               .format(attribute, CitiesConfig.table(city), gid))
-        res = cls.query_asdict(sql)
+        sql = ("SELECT {0} FROM {1} WHERE gid = %s"
+               .format(attribute, CitiesConfig.table(city)))
+        res = cls.query_asdict(sql, [gid])
 
         val = None
         if res:
@@ -122,6 +667,52 @@ class Session():
 
         return val
 
+    @classmethod
+    def attributes_for_gids(cls, city, gids, attributes):
+        """Returns the values of several attributes for several objects in a
+        single query
+
+        Parameters
+        ----------
+        city : str
+        gids : list
+            Object ids as int
+        attributes : list
+            Attribute names among CitiesConfig.attributes(city)
+
+        Returns
+        -------
+        res : dict
+            {gid: {attribute: val}} with values as str
+
+        Raises
+        ------
+        ValueError
+            If an attribute is not allowed for the city
+        """
+
+        sql = cls._attributes_sql(city, attributes)
+        res = cls.query_asdict(sql, [list(gids)])
+
+        return cls._attributes(res, attributes)
+
+    @staticmethod
+    def _attributes_sql(city, attributes):
+        allowed = CitiesConfig.attributes(city)
+        for attribute in attributes:
+            if attribute not in allowed:
+                raise ValueError("Unknown attribute '{0}' for city '{1}'"
+                                 .format(attribute, city))
+
+        columns = ', '.join('"{0}"'.format(a) for a in attributes)
+        return ("SELECT gid as gid_, {0} FROM {1} WHERE gid = ANY(%s)"
+                .format(columns, CitiesConfig.table(city)))
+
+    @staticmethod
+    def _attributes(res, attributes):
+        return {row['gid_']: {a: str(row[a]) for a in attributes}
+                for row in res}
+
     @classmethod
     def bbox_for_quadtiles(cls, city, quadtiles):
         """Returns a bbox for each quadtile in parameter
@@ -138,16 +729,16 @@ class Session():
             List of OrderedDict with 'bbox' and 'quadtile' keys.
         """
 
-        cond = ""
-        for quadtile in quadtiles:
-            if cond:
-                cond += " or "
-            cond += "quadtile='{0}'".format(quadtile)
+        index = cls.bbox_index(city)
+        if index is not None:
+            return index.bbox_for_quadtiles(quadtiles)
 
-        sql = ('SELECT quadtile, bbox from {0}_bbox where {1}'
-               .format(CitiesConfig.table(city), cond))
+        return cls.query_prepared('bbox_for_quadtiles', city,
+                                  cls.BBOX_FOR_QUADTILES_SQL, ['varchar[]'],
+                                  [list(quadtiles)])
 
-        return cls.query_asdict(sql)
+    BBOX_FOR_QUADTILES_SQL = ('SELECT quadtile, bbox from {0}_bbox'
+                              ' where quadtile = ANY($1)')
 
     @classmethod
     def tiles_for_level(cls, city, level):
@@ -164,12 +755,167 @@ class Session():
             List of OrderedDict with 'quadtile' and 'bbox' as keys
         """
 
+        index = cls.bbox_index(city)
+        if index is not None:
+            return index.tiles_for_level(level)
+
+        return cls.query_asdict(*cls._tiles_for_level_sql(city, level))
+
+    @staticmethod
+    def _tiles_for_level_sql(city, level):
+        # returns the query and its parameters
         regex = "{0}/".format(level)
 
         sql = ("SELECT quadtile, bbox FROM {0}_bbox"
-               " WHERE substr(quadtile,1,{1})='{2}'"
-               .format(CitiesConfig.table(city), len(regex), regex))
-        return cls.query_asdict(sql)
+               " WHERE substr(quadtile,1,{1})=%s"
+               .format(CitiesConfig.table(city), len(regex)))
+        return (sql, [regex])
+
+    @classmethod
+    def bbox_index(cls, city):
+        """Returns the in-memory index of the bbox table of the city
+
+        The index is loaded on first use and loaded again when the table
+        changes, that is when it is recreated or rows are written to it.
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        index : BboxIndex
+            None if BBOX_INDEX_CHECK is not set or the table does not exist
+        """
+
+        if cls.index_check is None:
+            return None
+
+        now = time.monotonic()
+        index = cls.indexes.get(city)
+        if index is not None and now - index.checked < cls.index_check:
+            return index
+
+        version = cls.bbox_version(city)
+        if version is None:
+            cls.indexes.pop(city, None)
+            return None
+
+        if index is None or index.version != version:
+            sql = ("SELECT quadtile, bbox::text as bbox FROM {0}_bbox"
+                   .format(CitiesConfig.table(city)))
+            rows = [(r['quadtile'], r['bbox']) for r in cls.query_asdict(sql)]
+            index = BboxIndex(rows, version)
+            cls.indexes[city] = index
+        index.checked = now
+
+        return index
+
+    @classmethod
+    def bbox_version(cls, city):
+        """Returns a value changing with the content of the bbox table
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        version : tuple
+            Oid of the table and its counts of inserted, updated and deleted
+            rows, or None if the table does not exist
+        """
+
+        res = cls.query_aslist(cls._bbox_version_sql(city))
+
+        version = None
+        if res:
+            version = tuple(res)
+
+        return version
+
+    @staticmethod
+    def _bbox_version_sql(city):
+        return ("SELECT c.oid, s.n_tup_ins, s.n_tup_upd, s.n_tup_del"
+                " FROM pg_class c"
+                " LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid"
+                " WHERE c.oid = to_regclass('{0}_bbox')"
+                .format(CitiesConfig.table(city)))
+
+    @classmethod
+    def dataset_version(cls, city):
+        """Returns the dataset version stamped by processdb for the city
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        version : str
+            None if VERSION_CHECK is not set or the city was never stamped
+        """
+
+        if cls.version_check is None:
+            return None
+
+        now = time.monotonic()
+        cached = cls.versions.get(city)
+        if cached is not None and now - cached[1] < cls.version_check:
+            return cached[0]
+
+        version = None
+        sql = "SELECT to_regclass(%s) is not null"
+        if cls.query_aslist(sql, [cls.VERSION_TABLE])[0]:
+            sql = ("SELECT version FROM {0} WHERE city = %s"
+                   .format(cls.VERSION_TABLE))
+            res = cls.query_aslist(sql, [city])
+            if res:
+                version = res[0]
+
+        cls.versions[city] = (version, now)
+        return version
+
+    @classmethod
+    def stamp_version(cls, city, version):
+        """Records a new dataset version for the city
+
+        Parameters
+        ----------
+        city : str
+        version : str
+
+        Returns
+        -------
+        Nothing
+        """
+
+        sql = ("CREATE TABLE IF NOT EXISTS {0} (city varchar PRIMARY KEY"
+               ", version varchar);".format(cls.VERSION_TABLE))
+        cls.connection().cursor().execute(sql)
+
+        sql = ("INSERT INTO {0} values (%s, %s) ON CONFLICT (city)"
+               " DO UPDATE SET version = EXCLUDED.version"
+               .format(cls.VERSION_TABLE))
+        cls.connection().cursor().execute(sql, [city, version])
+
+    @classmethod
+    def quadtiles(cls, city):
+        """Returns all the quadtiles of the city
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        res : list
+            ["z0/y0/x0", "z1/y1/x1", ...]
+        """
+
+        sql = ("SELECT quadtile FROM {0}_bbox"
+               .format(CitiesConfig.table(city)))
+        return cls.query_aslist(sql)
 
     @classmethod
     def score_for_polygon(cls, city, pol, scoreFunction):
@@ -212,7 +958,7 @@ class Session():
 
         sql = ("ALTER TABLE {0} ADD COLUMN {1} {2}"
                .format(CitiesConfig.table(city), column, typecol))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
 
     @classmethod
     def update_table(cls, city, quadtile, weight, gid):
@@ -232,7 +978,7 @@ class Session():
 
         sql = ("UPDATE {0} SET quadtile = '{1}', weight = {2} WHERE gid = {3}"
                .format(CitiesConfig.table(city), quadtile, weight, gid))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
 
     @classmethod
     def create_index(cls, city, column):
@@ -251,7 +997,7 @@ class Session():
         sql = ("CREATE INDEX tileIdx_{0} on {1} ({2})"
                .format(CitiesConfig.table(city).replace(".", ""), CitiesConfig.table(city),
                        column))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
 
     @classmethod
     def create_bbox_table(cls, city):
@@ -268,7 +1014,7 @@ class Session():
 
         sql = ("CREATE TABLE {0}_bbox (quadtile varchar(10) PRIMARY KEY"
                ", bbox Box3D);".format(CitiesConfig.table(city)))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
 
     @classmethod
     def insert_into_bbox_table(cls, city, quadtile, bbox):
@@ -289,7 +1035,45 @@ class Session():
         sql = ("INSERT INTO {0}_bbox values ('{1}', "
                "Box3D(ST_GeomFromText('LINESTRING({2})')))"
                .format(CitiesConfig.table(city), quadtile, bbox))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
+
+    @classmethod
+    def create_mesh_table(cls, city):
+        """Creates the table of prebuilt meshes for the city
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        Nothing
+        """
+
+        sql = ("CREATE TABLE {0}_mesh (gid integer PRIMARY KEY"
+               ", bbox Box3D, mesh bytea);".format(CitiesConfig.table(city)))
+        cls.connection().cursor().execute(sql)
+
+    @classmethod
+    def insert_into_mesh_table(cls, city, meshes):
+        """Insert prebuilt meshes in the mesh table for the city
+
+        Parameters
+        ----------
+        city : str
+        meshes : list
+            List of (gid, box3d, mesh) with the bbox as a 'BOX3D(...)' string
+            and the mesh packed by transcode.packMesh
+
+        Returns
+        -------
+        Nothing
+        """
+
+        sql = ("INSERT INTO {0}_mesh values (%s, %s::box3d, %s)"
+               .format(CitiesConfig.table(city)))
+        cls.connection().cursor().executemany(sql, [(gid, box3d, Binary(mesh))
+                                          for (gid, box3d, mesh) in meshes])
 
     @classmethod
     def drop_column(cls, city, column):
@@ -307,7 +1091,7 @@ class Session():
 
         sql = ("ALTER TABLE {0} DROP COLUMN IF EXISTS {1}"
                .format(CitiesConfig.table(city), column))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
 
     @classmethod
     def drop_bbox_table(cls, city):
@@ -324,44 +1108,250 @@ class Session():
 
         sql = ("DROP TABLE IF EXISTS {0}_bbox;"
                .format(CitiesConfig.table(city)))
-        cls.db.cursor().execute(sql)
+        cls.connection().cursor().execute(sql)
+
+    @classmethod
+    def drop_mesh_table(cls, city):
+        """Drops the mesh table
+
+        Parameters
+        ----------
+        city : str
+
+        Returns
+        -------
+        Nothing
+        """
+
+        sql = ("DROP TABLE IF EXISTS {0}_mesh;"
+               .format(CitiesConfig.table(city)))
+        cls.connection().cursor().execute(sql)
 
     @classmethod
-    def query(cls, query, parameters=None):
+    def query(cls, query, parameters=None, prepare=None):
         """Performs a query and yield results
+
+        prepare is an optional (name, sql) PREPARE statement run before the
+        query on the connections which did not run it yet.
         """
-        cur = cls.db.cursor()
-        cur.execute(query, parameters)
+        def execute(conn, cur):
+            if prepare:
+                cls._prepare(conn, cur, *prepare)
+            cur.execute(query, parameters)
+
+        cur = cls._execute(execute)
         if not cur.rowcount:
             return None
         for row in cur:
             yield row
 
     @classmethod
-    def query_asdict(cls, query, parameters=None):
+    def query_binary(cls, city, sql, parameters, columns):
+        """Runs a query through a binary COPY, without the text encoding of
+        bytea and numbers
+
+        Parameters
+        ----------
+        city : str
+        sql : str
+            Query with {0} for the table of the city and $1, $2, ... for the
+            parameters
+        parameters : list
+        columns : list
+            (name, type) of the columns of the query, with types among
+            COPY_TYPES
+
+        Returns
+        -------
+        res : list
+            List of dict. bytea values are memoryviews of a buffer reused by
+            the thread once the connection is released.
+        """
+        # COPY takes no bound parameters, psycopg2 quotes them instead
+        sql = re.sub(r'\$(\d+)', r'%(p\1)s',
+                     sql.format(CitiesConfig.table(city)))
+        parameters = {'p{0}'.format(i + 1): p
+                      for (i, p) in enumerate(parameters)}
+        buffer = cls.buffer()
+        start = buffer.size
+
+        def execute(conn, cur):
+            buffer.size = start
+            copy = ("COPY ({0}) TO STDOUT WITH (FORMAT binary)"
+                    .format(cur.mogrify(sql, parameters).decode('utf-8')))
+            cur.copy_expert(copy, buffer)
+
+        cls._execute(execute)
+        return parse_copy(buffer.view(start), columns)
+
+    @classmethod
+    def _execute(cls, execute):
+        # queries are read only so they are run again once on a new
+        # connection if the connection was lost
+        for attempt in range(0, 2):
+            conn = cls.connection()
+            cur = conn.cursor()
+            try:
+                execute(conn, cur)
+                return cur
+            except (OperationalError, InterfaceError):
+                cls.release(close=True)
+                if attempt:
+                    raise
+                cls.pool.count('retries')
+
+    @classmethod
+    def query_asdict(cls, query, parameters=None, prepare=None):
         """Iterates over results and returns namedtuples
         """
         return [
             line._asdict()
-            for line in cls.query(query, parameters=parameters)
+            for line in cls.query(query, parameters=parameters,
+                                  prepare=prepare)
         ]
 
     @classmethod
-    def query_aslist(cls, query, parameters=None):
+    def query_aslist(cls, query, parameters=None, prepare=None):
         """Iterates over results and returns values in a flat list
         (usefull if one column only)
         """
-        return list(chain(*cls.query(query, parameters=parameters)))
+        return list(chain(*cls.query(query, parameters=parameters,
+                                     prepare=prepare)))
+
+    @classmethod
+    def query_prepared(cls, name, city, sql, types, parameters):
+        """Runs a query through a statement prepared once per connection for
+        the table of the city
+
+        Parameters
+        ----------
+        name : str
+        city : str
+        sql : str
+            Query with {0} for the table of the city and $1, $2, ... for the
+            parameters
+        types : list
+            SQL types of the parameters
+        parameters : list
+
+        Returns
+        -------
+        res : list
+            List of OrderedDict
+        """
+        (execute, prepare) = cls._statement(name, city, sql, types)
+        return cls.query_asdict(execute, parameters, prepare)
+
+    @staticmethod
+    def _statement(name, city, sql, types):
+        # returns the EXECUTE query and the (name, PREPARE query) of the
+        # statement for the table of the city
+        table = CitiesConfig.table(city)
+        statement = '{0}_{1}'.format(name, table.replace('.', '_'))
+        prepare = ('PREPARE {0} ({1}) AS {2}'
+                   .format(statement, ', '.join(types), sql.format(table)))
+        execute = ('EXECUTE {0} ({1})'
+                   .format(statement, ', '.join(['%s'] * len(types))))
+        return (execute, (statement, prepare))
+
+    @classmethod
+    def _prepare(cls, conn, cur, statement, sql):
+        new = cls._unprepared(conn, statement)
+        if new:
+            cur.execute(sql)
+            cls.prepared[conn].add(statement)
+        cls._count_execution(statement, new)
+
+    @classmethod
+    def _unprepared(cls, conn, statement):
+        prepared = cls.prepared.get(conn)
+        if prepared is None:
+            prepared = cls.prepared.setdefault(conn, set())
+        return statement not in prepared
+
+    @classmethod
+    def _count_execution(cls, statement, new):
+        with cls.statements_lock:
+            counters = cls.statements.setdefault(
+                statement, {'prepares': 0, 'executions': 0})
+            counters['prepares'] += new
+            counters['executions'] += 1
+
+    @classmethod
+    def connection(cls):
+        """Returns the connection of the current thread
+        """
+        conn = getattr(cls.local, 'db', None)
+        if conn is None:
+            conn = cls.pool.getconn()
+            cls.local.db = conn
+        return conn
+
+    @classmethod
+    def buffer(cls):
+        """Returns the binary fetch buffer of the current thread
+        """
+        buffer = getattr(cls.local, 'buffer', None)
+        if buffer is None:
+            buffer = CopyBuffer()
+            cls.local.buffer = buffer
+        return buffer
+
+    @classmethod
+    def release(cls, exception=None, close=False):
+        """Gives the connection of the current thread back to the pool and
+        recycles its binary fetch buffer
+        """
+        buffer = getattr(cls.local, 'buffer', None)
+        if buffer is not None:
+            buffer.size = 0
+
+        conn = getattr(cls.local, 'db', None)
+        if conn is not None:
+            cls.local.db = None
+            cls.pool.putconn(conn, close or conn.closed)
+
+    @classmethod
+    def statement_stats(cls):
+        """Returns the usage counters of the prepared statements
+
+        Returns
+        -------
+        stats : dict
+            For each statement, the number of connections it was prepared on
+            as 'prepares' and its number of runs as 'executions'. Only the
+            first execution on a connection parses and plans the query.
+        """
+        with cls.statements_lock:
+            return {name: dict(counters)
+                    for (name, counters) in cls.statements.items()}
+
+    @classmethod
+    def stats(cls):
+        """Returns the usage counters of the connection pool
+
+        Returns
+        -------
+        stats : dict
+            'checkouts', 'waits', 'connects', 'reconnects' and 'retries'
+            counters, and the 'free', 'used' and 'size' connection counts
+        """
+        return cls.pool.stats()
 
     @classmethod
     def init_app(cls, app):
         """
         Initialize db session lazily
         """
-        cls.db = connect(
+        cls.pool = ConnectionPool(
             "postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_NAME}"
             .format(**app.config),
-            cursor_factory=NamedTupleCursor,
-        )
-        # autocommit mode for performance (we don't need transaction)
-        cls.db.autocommit = True
+            minconn=app.config.get('PG_POOL_MIN', 1),
+            maxconn=app.config.get('PG_POOL_MAX', 4),
+            timeout=app.config.get('PG_POOL_TIMEOUT', 10),
+            idle=app.config.get('PG_POOL_IDLE', 30))
+        cls.binary_fetch = app.config.get('PG_BINARY_FETCH', False)
+        cls.index_check = app.config.get('BBOX_INDEX_CHECK')
+        cls.indexes = {}
+        cls.version_check = app.config.get('VERSION_CHECK')
+        cls.versions = {}
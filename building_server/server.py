@@ -1,48 +1,265 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import json
 import struct
-from flask import Response
+import logging
+from types import GeneratorType
+from flask import (Response, abort, has_request_context, request,
+                   stream_with_context)
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.wsgi import wrap_file
 from . import utils
+from .cache import HTTPCache, PrebuiltResponses, ResponseCache
+from .compression import Compression
 from .database import Session
-from .transcode import toglTF
+from .transcode import toglTF, toGLB2
 from .utils import CitiesConfig
 
+logger = logging.getLogger(__name__)
+
+
+def attributes_for_gids(city, gids, attributes):
+    try:
+        return Session.attributes_for_gids(city, gids, attributes)
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def respond(endpoint, args):
+    """Returns the response of the endpoint, whose body is built by
+    endpoint._build(args) unless it is cached or the client has it already
+    """
+    headers = {}
+    if has_request_context():
+        headers = request.headers
+
+    key = endpoint._key(args)
+    version = dataset_version(key)
+    (cacheKey, encoding, etag) = negotiate(key, version,
+                                           headers.get('Accept-Encoding'))
+
+    if not_modified(etag, headers.get('If-None-Match')):
+        return make_response(b'', None, None, endpoint.ENDPOINT, etag, 304)
+
+    if endpoint.PREBUILT:
+        revision = (version, endpoint._revision(args))
+        cached = PrebuiltResponses.get(key, revision, encoding)
+        if cached is None:
+            cached = PrebuiltResponses.put(key, revision,
+                                           *endpoint._build(args), encoding)
+        return make_response(*cached, endpoint.ENDPOINT, etag)
+
+    cached = lookup(cacheKey, encoding)
+    if cached is None:
+        cached = store(cacheKey, *endpoint._build(args), encoding)
+
+    return make_response(*cached, endpoint.ENDPOINT, etag)
+
+
+def dataset_version(key):
+    """Returns the version of the data the response for the key is built
+    from, the configuration for keys with no city
+    """
+    if key is None:
+        return None
+    if key[1] is None:
+        return CitiesConfig.version
+    return Session.dataset_version(key[1])
+
+
+def prebuild():
+    """Builds the getCities and getCity responses of all the cities, which
+    are the first requests of every client
+    """
+    GetCities().run()
+    for city in CitiesConfig.cities:
+        try:
+            GetCity().run({'city': city})
+        except Exception as e:
+            logger.warning("getCity of {0} not prebuilt: {1}".format(city, e))
+        finally:
+            Session.release()
+
+
+def negotiate(key, version, accept):
+    """Returns the cache key of the response for the dataset version, its
+    content coding and its ETag, None when the version is not known
+    """
+    encoding = Compression.negotiate(accept)
+    etag = None
+    if key is not None and version is not None:
+        key = key + (version,)
+        etag = HTTPCache.etag(key, encoding)
+    return (key, encoding, etag)
+
+
+def not_modified(etag, ifNoneMatch):
+    return etag is not None and parse_etags(ifNoneMatch).contains_weak(etag)
+
+
+def response_headers(endpoint, contentType, encoding, etag):
+    headers = [('Access-Control-Allow-Origin', '*')]
+    if contentType is not None:
+        headers.append(('Content-Type', contentType))
+    if encoding is not None:
+        headers.append(('Content-Encoding', encoding))
+    if Compression.encodings:
+        headers.append(('Vary', 'Accept-Encoding'))
+    if etag is not None:
+        headers.append(('ETag', quote_etag(etag)))
+    cacheControl = HTTPCache.cache_control(endpoint)
+    if cacheControl is not None:
+        headers.append(('Cache-Control', cacheControl))
+    return headers
+
+
+def lookup(key, encoding):
+    """Returns the (body, content type, encoding) of a cached response or
+    None. A compressed variant is used if there is one for the encoding.
+    """
+    if key is None:
+        return None
+
+    if encoding is not None and Compression.cache:
+        cached = ResponseCache.get(key + (encoding,))
+        if cached is not None:
+            return cached + (encoding,)
+
+    cached = ResponseCache.get(key)
+    if cached is not None:
+        return encode(key, *cached, encoding)
+    return None
+
+
+def store(key, body, contentType, encoding):
+    """Caches a body just built and returns it as lookup would. Bodies
+    built as an iterator of strings are streamed and cached once sent.
+    """
+    if isinstance(body, GeneratorType):
+        body = utils.buffered(cache_chunks(key, body, contentType))
+    elif key is not None:
+        ResponseCache.put(key, body, contentType)
+
+    return encode(key, body, contentType, encoding)
+
+
+def encode(key, body, contentType, encoding):
+    # compress the body, unless it is too small to be worth it
+    if encoding is None:
+        return (body, contentType, None)
+    if isinstance(body, GeneratorType):
+        return (Compression.chunks(body, encoding), contentType, encoding)
+
+    if hasattr(body, 'fileno'):
+        with body:
+            body = body.read()
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if len(body) < Compression.minsize:
+        return (body, contentType, None)
+
+    body = Compression.compress(body, encoding)
+    if key is not None and Compression.cache:
+        ResponseCache.put(key + (encoding,), body, contentType)
+    return (body, contentType, encoding)
+
+
+def make_response(body, contentType, encoding=None, endpoint=None, etag=None,
+                  status=200):
+    if hasattr(body, 'fileno'):
+        # a file from the disk cache is sent by the WSGI server
+        resp = Response(wrap_file(request.environ, body), status,
+                        direct_passthrough=True)
+        resp.content_length = os.fstat(body.fileno()).st_size
+    else:
+        resp = Response(body, status)
+    if contentType is None:
+        del resp.headers['Content-Type']
+    for (name, value) in response_headers(endpoint, contentType, encoding,
+                                          etag):
+        resp.headers[name] = value
+
+    return resp
+
+
+def cache_chunks(key, chunks, contentType):
+    """Yields the chunks and caches the body once they are all sent
+    """
+    if key is None or not ResponseCache.enabled():
+        yield from chunks
+        return
+
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    if body:
+        ResponseCache.put(key, body[0][:0].join(body), contentType)
+
 
 class GetGeometry(object):
 
-    def run(self, args):
-        outputFormat = args['format']
+    ENDPOINT = 'getGeometry'
+    PREBUILT = False
 
-        geometry = ""
-        if outputFormat:
-            if outputFormat.lower() == "geojson":
-                geometry = self._as_geojson(args)
-            else:
-                geometry = self._as_glTF(args)
-        else:
-            geometry = self._as_glTF(args)
-
-        resp = Response(geometry)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
+    def run(self, args):
+        return respond(self, args)
 
-        return resp
+    def _format(self, args):
+        return (args['format'] or "").lower()
 
-    def _as_geojson(self, args):
+    def _key(self, args):
+        return ('getGeometry', args['city'], args['tile'],
+                self._format(args), args['attributes'], args.get('merge'),
+                args.get('quantize'))
 
-        # arguments
+    def _build(self, args):
         city = args['city']
         tile = args['tile']
-        attributes = []
-        if args['attributes']:
-            attributes = args['attributes'].split(',')
+        children = self._children_quadtiles(tile)
+
+        # get tile origin, geometries and children bboxes in a single query,
+        # GeoJSON geometries being already translated to the tile origin
+        values = {}
+        if self._format(args) == "geojson":
+            content = Session.tile_content_geojson(city, tile, children)
+            values = self._feature_values(city, args, [content])
+        else:
+            content = Session.tile_content_binary(city, tile, children)
+
+        return self._render(args, content, values)
+
+    def _feature_values(self, city, args, contents):
+        # fetch the extra properties of all the features at once
+        attributes = self._attributes(args)
+        if not attributes:
+            return {}
+        gids = [geom['gid'] for content in contents for geom in content[1]]
+        return attributes_for_gids(city, gids, attributes)
+
+    def _render(self, args, content, values):
+        # returns the body of the tile and its content type
+        outputFormat = self._format(args)
+        if outputFormat == "geojson":
+            return (self._geojson(args['city'], self._attributes(args),
+                                  content, values), 'application/json')
+        elif outputFormat == "glb2":
+            return (self._glb2(args, content), 'model/gltf-binary')
+        else:
+            # binary glTF 1.0 followed by the JSON tail
+            return (self._glTF(args, content), 'application/octet-stream')
 
-        # get offset in database
-        offset = Session.offset(city, tile)
+    def _attributes(self, args):
+        if args['attributes']:
+            return args['attributes'].split(',')
+        return []
 
-        # get geometries for a specific tile in database
-        geomsjson = Session.tile_geom_geojson(city, offset, tile)
+    def _geojson(self, city, attributes, content, values):
+        # yields the document in chunks
+        (offset, geomsjson, bboxs) = content
 
         # build a features collection with extra properties if necessary
         feature_collection = utils.FeatureCollection()
@@ -54,8 +271,7 @@ class GetGeometry(object):
             properties.add(property)
 
             for attribute in attributes:
-                val = Session.attribute_for_gid(city, str(geom['gid']),
-                                                attribute)
+                val = values.get(geom['gid'], {}).get(attribute)
                 property = utils.Property(attribute, '"{0}"'.format(val))
                 properties.add(property)
 
@@ -63,47 +279,69 @@ class GetGeometry(object):
             feature_collection.add(f)
 
         # build children bboxes
-        bboxes_str = self._children_bboxes(city, tile)
+        bboxes_str = self._children_bboxes(bboxs)
 
         # build the resulting json
-        geometries = utils.Property("geometries", feature_collection.geojson())
-        json = ('{{ {0}, "tiles":[{1}]}}'
-                .format(geometries.geojson(), bboxes_str))
+        yield '{ "geometries" : '
+        yield from feature_collection.chunks()
+        yield ', "tiles":[{0}]}}'.format(bboxes_str)
 
-        return json
+    def _glTF(self, args, content):
+        (offset, geombin, bboxs) = content
+        merge = args.get('merge')
 
-    def _as_glTF(self, args):
-        # retrieve arguments
-        city = args['city']
-        tile = args['tile']
+        if not geombin:
+            bgltf = struct.pack('4sIIII', b"glTF", 1, 20, 0, 0)  # empty bglTF
+            return bgltf + b'{"tiles":[]}'
 
-        # get geom as binary
-        geombin = Session.tile_geom_binary(city, tile)
+        # prepare data for toglTF function and run it
+        (data, prebuilt) = self._transcode_rows(geombin)
+        bgltf = toglTF(data, True, offset, merge=merge, prebuilt=prebuilt)
 
-        json = ""
+        # build children bboxes
+        bboxes_str = self._children_bboxes(bboxs)
+
+        # build the json tail, batch ids index the gids list
+        if merge:
+            gids = ','.join(str(geom['gid']) for geom in geombin)
+            json = (', "tiles":[{0}], "gids":[{1}]}}'
+                    .format(bboxes_str, gids))
+        else:
+            json = ', "tiles":[{0}]}}'.format(bboxes_str)
+
+        return bgltf + json.encode('utf-8')
+
+    def _glb2(self, args, content):
+        (offset, geombin, bboxs) = content
+        merge = args.get('merge')
+
+        # children bboxes go in the glTF extras instead of a JSON tail
+        tiles = []
         if not geombin:
-            json = struct.pack('4sIIII', b"glTF", 1, 20, 0, 0)  # empty bglTF
-            json += b'{"tiles":[]}'
-            json = json.decode("utf-8")
+            offset = [0, 0, 0]
         else:
-            offset = Session.offset(city, tile)
+            for (quadtile, b) in self._children_tiles(bboxs):
+                (p1, p2) = b.corners()
+                tiles.append({"id": quadtile, "bbox": p1 + p2})
 
-            # prepare data for toglTF function and run it
-            data = []
-            for geom in geombin:
-                data.append((geom['binary'], geom['box3d']))
-            json = toglTF(data, True, offset)
+        (data, prebuilt) = self._transcode_rows(geombin)
 
-            # build children bboxes
-            bboxes_str = self._children_bboxes(city, tile)
+        # batch ids index the gids list
+        extras = {"tiles": tiles}
+        if merge:
+            extras["gids"] = [geom['gid'] for geom in geombin]
 
-            # build the resulting json
-            json = ('{0}, "tiles":[{1}]}}'
-                    .format(json, bboxes_str))
+        return toGLB2(data, offset, extras=extras, merge=merge,
+                      quantize=args.get('quantize'), prebuilt=prebuilt)
 
-        return json
+    def _transcode_rows(self, geombin):
+        # meshes prebuilt by processdb are used instead of the WKB if any
+        prebuilt = bool(geombin) and 'mesh' in geombin[0]
+        key = 'mesh' if prebuilt else 'binary'
+        data = [(geom[key], geom['box3d']) for geom in geombin]
+        return (data, prebuilt)
 
-    def _children_bboxes(self, city, tile):
+    def _children_quadtiles(self, tile):
 
         [z, y, x] = map(int, tile.split("/"))
         q0 = str(z+1) + "/" + str(2*y) + "/" + str(2*x)
@@ -111,12 +349,19 @@ class GetGeometry(object):
         q2 = str(z+1) + "/" + str(2*y) + "/" + str(2*x+1)
         q3 = str(z+1) + "/" + str(2*y+1) + "/" + str(2*x+1)
 
-        bboxs = Session.bbox_for_quadtiles(city, [q0, q1, q2, q3])
+        return [q0, q1, q2, q3]
+
+    def _children_tiles(self, bboxs):
+
+        boxes = utils.Box3D.batch([bbox['bbox'] for bbox in bboxs])
+        return [(bbox['quadtile'], b) for (bbox, b) in zip(bboxs, boxes)]
+
+    def _children_bboxes(self, bboxs):
+
         lbb = []
-        for bbox in bboxs:
-            b = utils.Box3D(bbox['bbox'])
+        for (quadtile, b) in self._children_tiles(bboxs):
             qstr = ('{{"id" : "{0}", {1}}}'
-                    .format(bbox['quadtile'], b.geojson()))
+                    .format(quadtile, b.geojson()))
             lbb.append(qstr)
 
         bboxes_str = ', '.join(lbb)
@@ -124,72 +369,197 @@ class GetGeometry(object):
         return bboxes_str
 
 
-class GetCities(object):
-
-    def run(self):
-        cities_str = str(CitiesConfig.cities).replace('\'', '"')
+class GetGeometries(GetGeometry):
+    """
+    getGeometry for several tiles of a city at once
 
-        resp = Response(cities_str)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
+    The body holds a part per tile, in the order of the request, made of
+    the length of the tile id as an uint16, the tile id, the length of the
+    tile body as an uint32, both little endian, and the body getGeometry
+    returns for the tile. Parts are sent as the tiles are transcoded.
+    """
 
-        return resp
+    ENDPOINT = 'getGeometries'
+    MAX_TILES = 64
+    QUADTILE = re.compile(r'^\d+/\d+/\d+$')
 
+    def run(self, args):
+        return respond(self, args)
 
-class GetCity(object):
+    def _key(self, args):
+        # tiles are cached one by one
+        return None
 
-    def run(self, args):
+    def _build(self, args):
         city = args['city']
-        tiles = Session.tiles_for_level(city, 0)
+        tiles = self._tile_list(args)
+        keys = self._tile_keys(args, tiles, Session.dataset_version(city))
+        (bodies, missing) = self._cached(keys)
+
+        # all the tiles which are not cached are fetched at once
+        contents = {}
+        values = {}
+        if missing:
+            children = {tile: self._children_quadtiles(tile)
+                        for tile in missing}
+            if self._format(args) == "geojson":
+                contents = Session.tiles_content_geojson(city, children)
+                values = self._feature_values(city, args, contents.values())
+            else:
+                contents = Session.tiles_content_binary(city, children)
+
+        parts = self._parts(args, tiles, keys, bodies, contents, values)
+        if has_request_context():
+            # the fetched rows stay valid until the last part is sent
+            parts = stream_with_context(parts)
+        return (parts, 'application/octet-stream')
+
+    def _tile_list(self, args):
+        tiles = []
+        for tile in args['tiles'].split(','):
+            if not self.QUADTILE.match(tile):
+                abort(400, "invalid tile '{0}'".format(tile))
+            if tile not in tiles:
+                tiles.append(tile)
+
+        if len(tiles) > self.MAX_TILES:
+            abort(400, "no more than {0} tiles".format(self.MAX_TILES))
+        return tiles
+
+    def _tile_args(self, args, tile):
+        args = dict(args)
+        args['tile'] = tile
+        return args
+
+    def _tile_keys(self, args, tiles, version):
+        # cache keys of the getGeometry responses of the tiles
+        return {tile: negotiate(GetGeometry._key(self,
+                                                 self._tile_args(args, tile)),
+                                version, None)[0]
+                for tile in tiles}
+
+    def _cached(self, keys):
+        # returns the bodies of the tiles found in the response cache and
+        # the other tiles
+        bodies = {}
+        missing = []
+        for (tile, key) in keys.items():
+            cached = ResponseCache.get(key)
+            if cached is None:
+                missing.append(tile)
+            elif hasattr(cached[0], 'fileno'):
+                with cached[0] as f:
+                    bodies[tile] = f.read()
+            else:
+                bodies[tile] = cached[0]
+        return (bodies, missing)
 
-        json = ""
+    def _parts(self, args, tiles, keys, bodies, contents, values):
         for tile in tiles:
-            b = utils.Box3D(tile['bbox'])
-            p = utils.Property("id", '"{0}"'.format(tile['quadtile']))
+            body = bodies.get(tile)
+            if body is None:
+                (body, contentType) = self._render(
+                    self._tile_args(args, tile), contents[tile], values)
+                if isinstance(body, GeneratorType):
+                    body = ''.join(body)
+                ResponseCache.put(keys[tile], body, contentType)
 
-            tilejson = ('{{ {0}, {1} }}'
-                        .format(p.geojson(), b.geojson()))
-            if json:
-                json = "{0}, {1}".format(json, tilejson)
-            else:
-                json = tilejson
-        json = '{{"tiles":[{0}]}}'.format(json)
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            quadtile = tile.encode('utf-8')
+            yield (struct.pack('<H', len(quadtile)) + quadtile
+                   + struct.pack('<I', len(body)) + bytes(body))
 
-        resp = Response(json)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
 
-        return resp
+class GetCities(object):
 
+    ENDPOINT = 'getCities'
+    PREBUILT = True
 
-class GetAttribute(object):
+    def run(self, args=None):
+        return respond(self, args)
+
+    def _key(self, args):
+        # built from the configuration, for all the cities
+        return ('getCities', None)
+
+    def _revision(self, args):
+        return None
+
+    def _build(self, args):
+        return (json.dumps(CitiesConfig.cities), 'text/plain')
+
+
+class GetCity(object):
+
+    ENDPOINT = 'getCity'
+    PREBUILT = True
 
     def run(self, args):
-        city = args['city']
-        gids = args['gid'].split(',')
-        attributes = args['attribute'].split(',')
+        return respond(self, args)
+
+    def _key(self, args):
+        return ('getCity', args['city'])
+
+    def _revision(self, args):
+        # the bbox index is loaded again when the bbox table changes, which
+        # is checked here when there is no index
+        index = Session.bbox_index(args['city'])
+        if index is None:
+            return Session.bbox_version(args['city'])
+        return index.version
+
+    def _build(self, args):
+        tiles = Session.tiles_for_level(args['city'], 0)
+        return (self._tiles(tiles), 'text/plain')
+
+    def _tiles(self, tiles):
+        # yields the document in chunks
+        yield '{"tiles":['
+        boxes = utils.Box3D.batch([tile['bbox'] for tile in tiles])
+        for (i, (tile, b)) in enumerate(zip(tiles, boxes)):
+            p = utils.Property("id", '"{0}"'.format(tile['quadtile']))
 
-        json = ""
-        for gid in gids:
-            gidjson = ""
-            for attribute in attributes:
-                val = Session.attribute_for_gid(city, str(gid), attribute)
-                property = utils.Property(attribute, '"{0}"'.format(val))
-                if gidjson:
-                    gidjson = "{0}, {1}".format(gidjson, property.geojson())
-                else:
-                    gidjson = property.geojson()
-            gidjson = "{{ {0} }}".format(gidjson)
-
-            if json:
-                json = "{0}, {1}".format(json, gidjson)
-            else:
-                json = gidjson
+            if i:
+                yield ', '
+            yield '{{ {0}, {1} }}'.format(p.geojson(), b.geojson())
+        yield ']}'
 
-        json = "[{0}]".format(json)
 
-        resp = Response(json)
-        resp.headers['Access-Control-Allow-Origin'] = '*'
-        resp.headers['Content-Type'] = 'text/plain'
+class GetAttribute(object):
+
+    ENDPOINT = 'getAttribute'
+    PREBUILT = False
+
+    def run(self, args):
+        return respond(self, args)
+
+    def _key(self, args):
+        return ('getAttribute', args['city'], args['gid'], args['attribute'])
+
+    def _build(self, args):
+        (gids, attributes) = self._arguments(args)
+        values = attributes_for_gids(args['city'], gids, attributes)
+        return (self._values(gids, attributes, values), 'text/plain')
+
+    def _arguments(self, args):
+        try:
+            gids = [int(gid) for gid in args['gid'].split(',')]
+        except ValueError:
+            abort(400, "gid must be a list of integers")
+        return (gids, args['attribute'].split(','))
+
+    def _values(self, gids, attributes, values):
+        # yields the document in chunks
+        yield '['
+        for (i, gid) in enumerate(gids):
+            properties = []
+            for attribute in attributes:
+                val = values.get(gid, {}).get(attribute)
+                property = utils.Property(attribute, '"{0}"'.format(val))
+                properties.append(property.geojson())
 
-        return resp
+            if i:
+                yield ', '
+            yield '{{ {0} }}'.format(', '.join(properties))
+        yield ']'
@@ -1,68 +1,508 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import struct
 import binascii
-import math
+import json
+import logging
+import threading
+import multiprocessing
+from itertools import accumulate, chain
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
 import triangle
 
-def toglTF(rows, bgltf = False, origin = [0,0,0]):
+from .utils import Box3D
+
+logger = logging.getLogger(__name__)
+
+# WKB geometry type codes (ISO flavour, Z dimension)
+WKB_POLYGONZ = 1003
+WKB_MULTIPOLYGONZ = 1006
+WKB_POLYHEDRALSURFACEZ = 1015
+
+_UINT32 = {'<': struct.Struct('<I'), '>': struct.Struct('>I')}
+
+# glTF index component types
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+
+# the largest index value is reserved for primitive restart
+MAX_UINT16_VERTICES = 65535
+
+# vertex and index counts of a packed mesh
+_MESH_HEADER = struct.Struct('<II')
+
+def toglTF(rows, bgltf = False, origin = [0,0,0], splitMeshes = False, merge = False, prebuilt = False):
     """
     Converts Well-Known Binary geometry to glTF file
+
+    Features with more than MAX_UINT16_VERTICES vertices get 32 bits indices,
+    or are split in several 16 bits primitives if splitMeshes is set.
+    If merge is set all the features go in a single mesh and a _BATCHID
+    attribute gives the index in rows of the feature of each vertex.
+    Large tiles are parsed and triangulated by TranscodePool.
+    If prebuilt is set the first item of each row is a mesh packed by
+    packMesh instead of WKB.
     """
-    nodes = []
-    normals = []
-    bb = []
-    for i in range(0, len(rows)):
-        mp = parse(bytes(rows[i][0]))
-        triangles = []
-        for poly in mp:
-            if(len(poly) != 1):
-                print("No support for inner polygon rings")
-            else:
-                if(len(poly[0]) > 3):
-                    triangles.extend(triangulate(poly[0]))
-                    #print poly
-                    #print len(poly[0])
-                else:
-                    triangles.append(poly[0])
-        nodes.append(triangles)
-        normals.append(computeNormals(triangles))
-
-        box3D = rows[i][1][6:len(rows[i][1])-1] # remove "BOX3D(" and ")"
-        part = box3D.partition(',')
-        p1 = list(map(float,part[0].split(' ')))
-        p2 = list(map(float,part[2].split(' ')))
-        for i in range(0,3):
-            p1[i] -= origin[i]
-            p2[i] -= origin[i]
-        bb.append((p1, p2))
-    moveOrigin(nodes, origin)
-
-    data = ([], [], [], [])
+    (binVertices, binIndices, binNormals, binBatchIds, nVertices, nIndices, bb,
+     indexTypes, meshes) = buildPrimitives(rows, origin, splitMeshes, merge, prebuilt)
+
+    if bgltf:
+        binary = outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb, indexTypes, meshes, binBatchIds)
+        return binary
+    else:
+        json = outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, False, "test.bin", indexTypes, meshes, binBatchIds)
+        binary = outputBin(binVertices, binIndices, binNormals, binBatchIds)
+        return json
+
+def toGLB2(rows, origin = [0,0,0], splitMeshes = False, extras = None, merge = False, quantize = False, prebuilt = False):
+    """
+    Converts Well-Known Binary geometry to a glTF 2.0 binary file
+    extras is stored as is in the top level extras of the glTF
+    """
+    (binVertices, binIndices, binNormals, binBatchIds, nVertices, nIndices, bb,
+     indexTypes, meshes) = buildPrimitives(rows, origin, splitMeshes, merge, prebuilt)
+
+    return outputGLB2(binVertices, binIndices, binNormals, nVertices, nIndices, indexTypes, meshes, extras, binBatchIds, quantize)
+
+def buildPrimitives(rows, origin, splitMeshes, merge = False, prebuilt = False):
+    """
+    Parses, triangulates and indexes the features of a tile
+    If prebuilt is set rows hold meshes packed by packMesh instead of WKB
+    Returns per primitive lists of packed vertices, indices, normals and
+    batch ids (empty unless merge is set), vertex and index counts, bounding
+    boxes and index types, and the list of primitives of each mesh
+    """
+    # bboxes of all the rows are parsed and translated at once
+    values = boxValues([row[1] for row in rows]) - np.tile(origin, 2)
+    bb = [(v[0:3], v[3:6]) for v in values.tolist()]
+
+    if prebuilt:
+        # packed meshes are relative to the lower corner of their bbox
+        meshes = [unpackMesh(row[0], b[0]) for (row, b) in zip(rows, bb)]
+    else:
+        wkbs = [row[0] for row in rows]
+        if TranscodePool.enabled(sum(len(wkb) for wkb in wkbs)):
+            (nodes, normals) = TranscodePool.triangulate(wkbs)
+        else:
+            (nodes, normals) = triangulateFeatures(wkbs)
+
+        # translation and indexation run on the whole tile at once
+        features = [len(n) for n in nodes]
+        triangles = np.concatenate(nodes) if nodes else np.empty((0, 3, 3))
+        triangles = moveOrigin(triangles, origin)
+        meshes = indexation(triangles, normals, features)
+
+    if merge and rows:
+        meshes = [mergeMeshes(meshes)]
+        bb = [(values[:, 0:3].min(axis=0).tolist(),
+               values[:, 3:6].max(axis=0).tolist())]
+
     binVertices = []
     binIndices = []
     binNormals = []
+    binBatchIds = []
     nVertices = []
     nIndices = []
-    for i in range(0,len(nodes)):
-        ptsIdx = indexation(nodes[i], normals[i])
-        packedVertices = b''.join(ptsIdx[0])
-        binVertices.append(packedVertices)
-        binIndices.append(struct.pack('H'*len(ptsIdx[2]), *ptsIdx[2]))
-        binNormals.append(b''.join(ptsIdx[1]))
-        nVertices.append(len(ptsIdx[0]))
-        nIndices.append(len(ptsIdx[2]))
+    indexTypes = []
+    primitives = []
+    primitivesBb = []
+    indicesLength = 0
+    for (i, mesh) in enumerate(meshes):
+        (attributes, indices) = (mesh[:-1], mesh[-1])
+        if len(attributes[0]) <= MAX_UINT16_VERTICES:
+            parts = [(attributes, indices.astype(np.uint16))]
+        elif splitMeshes:
+            parts = splitMesh(attributes, indices)
+        else:
+            parts = [(attributes, indices.astype(np.uint32))]
+
+        primitives.append(list(range(len(nVertices), len(nVertices) + len(parts))))
+        for (attributes, indices) in parts:
+            if indices.dtype == np.uint32:
+                indexTypes.append(UNSIGNED_INT)
+                if indicesLength % 4:   # 32 bits indices must be aligned
+                    binIndices[-1] += b'\x00\x00'
+                    indicesLength += 2
+            else:
+                indexTypes.append(UNSIGNED_SHORT)
+            binVertices.append(attributes[0].tobytes())
+            binIndices.append(indices.tobytes())
+            binNormals.append(attributes[1].tobytes())
+            if merge:
+                binBatchIds.append(attributes[2].tobytes())
+            nVertices.append(len(attributes[0]))
+            nIndices.append(len(indices))
+            primitivesBb.append(bb[i])
+            indicesLength += len(binIndices[-1])
+
+    return (binVertices, binIndices, binNormals, binBatchIds, nVertices,
+            nIndices, primitivesBb, indexTypes, primitives)
+
+def packMesh(wkb, box3D):
+    """
+    Triangulates and indexes a single WKB feature once for all
+    Positions are relative to the lower corner of box3D, in glTF axis order.
+    Returns the vertex and index counts followed by the float32 vertices,
+    float32 normals and uint32 indices
+    """
+    (nodes, normals) = triangulateFeatures([wkb])
+    triangles = moveOrigin(nodes[0], parseBox3D(box3D)[0])
+    (vertices, normals, indices) = indexation(triangles, normals,
+                                              [len(triangles)])[0]
 
-    if bgltf:
-        binary = outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb)
-        return binary
+    return b''.join((_MESH_HEADER.pack(len(vertices), len(indices)),
+                     vertices.astype('<f4').tobytes(),
+                     normals.astype('<f4').tobytes(),
+                     indices.astype('<u4').tobytes()))
+
+def unpackMesh(mesh, delta):
+    """
+    Reads a mesh packed by packMesh and translates it by delta
+    Returns a (vertices, normals, indices) tuple like indexation
+    """
+    (nVertices, nIndices) = _MESH_HEADER.unpack_from(mesh)
+    offset = _MESH_HEADER.size
+    attributes = np.frombuffer(mesh, dtype='<f4', count=6 * nVertices,
+                               offset=offset).reshape(2, nVertices, 3)
+    indices = np.frombuffer(mesh, dtype='<u4', count=nIndices,
+                            offset=offset + 24 * nVertices)
+    delta = np.asarray(delta, dtype=np.float32)[[1, 2, 0]]
+
+    return (attributes[0] + delta, attributes[1], indices.astype(np.int64))
+
+def parseBox3D(box3D):
+    """
+    Returns the two corners of a 'BOX3D(x1 y1 z1,x2 y2 z2)' string, or of a
+    (x1, y1, z1, x2, y2, z2) sequence, as lists
+    """
+    return tuple(Box3D(box3D).corners())
+
+def boxValues(boxes):
+    """
+    Returns the values of a list of 'BOX3D(...)' strings or of
+    (x1, y1, z1, x2, y2, z2) sequences as a (n, 6) float array
+    """
+    if boxes and isinstance(boxes[0], str):
+        return Box3D.parse(boxes)
+    return np.array(boxes, dtype=np.float64).reshape(-1, 6)
+
+def triangulateFeatures(wkbs):
+    """
+    Parses and triangulates a list of WKB features
+    Returns the list of triangles of each feature and the normals of all the
+    triangles
+    """
+    nodes = []
+    for wkb in wkbs:
+        (points, rings, polygons) = parse(wkb)
+        single = np.diff(polygons) == 1
+        if not single.all():
+            logger.warning("No support for inner polygon rings")
+        outer = polygons[:-1][single]
+        nodes.append(triangulateRings(points, rings[outer], rings[outer + 1]))
+
+    triangles = np.concatenate(nodes) if nodes else np.empty((0, 3, 3))
+    return (nodes, computeNormals(triangles))
+
+class TranscodePool():
+    """
+    Process pool transcoding the features of large tiles
+
+    The pool is started by the first large tile of each process so that
+    uWSGI workers never share the pool of the master they are forked from.
+    Its workers come from a fork server, since forking a request thread
+    would copy the locks other threads hold. Tiles whose WKB is smaller
+    than the threshold stay in-process, and so does a tile whose
+    transcoding broke the pool.
+    """
+    size = 0
+    threshold = None
+    executor = None
+    pid = None
+    lock = threading.Lock()
+
+    @classmethod
+    def init_app(cls, app):
+        cls.size = app.config.get('TRANSCODE_POOL_SIZE', 0)
+        cls.threshold = app.config.get('TRANSCODE_POOL_THRESHOLD')
+
+    @classmethod
+    def enabled(cls, nbytes):
+        return (cls.size > 0 and cls.threshold is not None
+                and nbytes > cls.threshold)
+
+    @classmethod
+    def pool(cls):
+        with cls.lock:
+            if cls.executor is None or cls.pid != os.getpid():
+                cls.executor = ProcessPoolExecutor(
+                    cls.size,
+                    mp_context=multiprocessing.get_context('forkserver'))
+                cls.pid = os.getpid()
+            return cls.executor
+
+    @classmethod
+    def triangulate(cls, wkbs):
+        """
+        Same as triangulateFeatures, with the features split in chunks of
+        similar WKB size spread over the pool
+        """
+        wkbs = [bytes(wkb) for wkb in wkbs]
+        sizes = np.cumsum([len(wkb) for wkb in wkbs])
+        nChunks = min(2 * cls.size, len(wkbs))
+        bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, nChunks) / nChunks)
+        bounds = [0] + sorted(set(bounds.tolist())) + [len(wkbs)]
+        chunks = [wkbs[bounds[i]:bounds[i + 1]] for i in range(0, len(bounds) - 1)]
+
+        pool = cls.pool()
+        try:
+            results = list(pool.map(triangulateFeatures, chunks))
+        except BrokenProcessPool:
+            # a worker died, the next large tile starts a new pool and this
+            # one is transcoded in-process
+            with cls.lock:
+                if cls.executor is pool:
+                    cls.executor = None
+            pool.shutdown(wait=False)
+            return triangulateFeatures(wkbs)
+
+        nodes = []
+        normals = []
+        for (n, m) in results:
+            nodes.extend(n)
+            normals.append(m)
+        return (nodes, np.concatenate(normals))
+
+def outputGLB2(binVertices, binIndices, binNormals, nVertices, nIndices, indexTypes = None, meshes = None, extras = None, binBatchIds = None, quantize = False):
+    """
+    Builds a glTF 2.0 binary file (GLB v2)
+
+    The scene is built as a dict serialized once and the buffers are copied
+    in a preallocated bytearray. Meshes are named M0..Mn like in glTF 1.0,
+    empty primitives are dropped since glTF 2.0 forbids empty accessors.
+    Primitives get a _BATCHID attribute when binBatchIds is given.
+
+    With quantize, vertices are interleaved in 12 bytes: the position as
+    normalized uint16 over the extent of the tile, dequantized by the root
+    node transform (KHR_mesh_quantization), and at byte 8 the normal
+    oct-encoded in a normalized int8 VEC2 _OCTNORMAL attribute, so that
+    both attributes are aligned on 4 bytes as glTF 2.0 requires.
+    """
+    binBatchIds = binBatchIds or []
+    primitiveNb = len(binVertices)
+    if indexTypes is None:
+        indexTypes = [UNSIGNED_SHORT] * primitiveNb
+    if meshes is None:
+        meshes = [[i] for i in range(0, primitiveNb)]
+
+    root = {}
+    if quantize:
+        (binVertices, positionsMin, positionsMax, translation, scale) = \
+            quantizeVertices(binVertices, binNormals)
+        binNormals = []
+        root = {"translation": translation, "scale": scale}
+
+    # byte offset of each primitive in the vertices, normals and indices
+    offsetVce = list(accumulate([0] + [len(b) for b in binVertices]))
+    offsetNml = list(accumulate([0] + [len(b) for b in binNormals]))
+    offsetIdx = list(accumulate([0] + [len(b) for b in binIndices]))
+    offsetBatch = list(accumulate([0] + [len(b) for b in binBatchIds]))
+
+    # buffer views follow the order of the binary chunk
+    bufferViews = []
+    views = {}
+    binLength = 0
+    for (name, size, stride, target) in (
+            ("vertices", offsetVce[-1], 12, 34962),
+            ("normals", offsetNml[-1], 12, 34962),
+            ("batchids", offsetBatch[-1], 4, 34962),
+            ("indices", offsetIdx[-1], None, 34963)):
+        if not size:
+            continue
+        views[name] = len(bufferViews)
+        bufferViews.append({
+            "buffer": 0,
+            "byteLength": size,
+            "byteOffset": binLength,
+            "target": target
+        })
+        if stride:
+            bufferViews[-1]["byteStride"] = stride
+        binLength += size
+
+    accessors = []
+    gltfMeshes = []
+    for i in range(0, len(meshes)):
+        primitives = []
+        for p in meshes[i]:
+            if not nIndices[p]:
+                continue
+            attributes = {}
+            attributes["POSITION"] = len(accessors)
+            if quantize:
+                accessors.append({
+                    "bufferView": views["vertices"],
+                    "byteOffset": offsetVce[p],
+                    "componentType": UNSIGNED_SHORT,
+                    "normalized": True,
+                    "count": nVertices[p],
+                    "max": positionsMax[p],
+                    "min": positionsMin[p],
+                    "type": "VEC3"
+                })
+                attributes["_OCTNORMAL"] = len(accessors)
+                accessors.append({
+                    "bufferView": views["vertices"],
+                    "byteOffset": offsetVce[p] + 8,
+                    "componentType": 5120,
+                    "normalized": True,
+                    "count": nVertices[p],
+                    "type": "VEC2"
+                })
+            else:
+                vertices = np.frombuffer(binVertices[p], dtype=np.float32)
+                vertices = vertices.reshape(-1, 3)
+                accessors.append({
+                    "bufferView": views["vertices"],
+                    "byteOffset": offsetVce[p],
+                    "componentType": 5126,
+                    "count": nVertices[p],
+                    "max": vertices.max(axis=0).tolist(),
+                    "min": vertices.min(axis=0).tolist(),
+                    "type": "VEC3"
+                })
+                attributes["NORMAL"] = len(accessors)
+                accessors.append({
+                    "bufferView": views["normals"],
+                    "byteOffset": offsetNml[p],
+                    "componentType": 5126,
+                    "count": nVertices[p],
+                    "type": "VEC3"
+                })
+            if binBatchIds:
+                attributes["_BATCHID"] = len(accessors)
+                accessors.append({
+                    "bufferView": views["batchids"],
+                    "byteOffset": offsetBatch[p],
+                    "componentType": 5126,
+                    "count": nVertices[p],
+                    "type": "SCALAR"
+                })
+            primitives.append({
+                "attributes": attributes,
+                "indices": len(accessors),
+                "material": 0,
+                "mode": 4
+            })
+            accessors.append({
+                "bufferView": views["indices"],
+                "byteOffset": offsetIdx[p],
+                "componentType": indexTypes[p],
+                "count": nIndices[p],
+                "type": "SCALAR"
+            })
+        if primitives:
+            gltfMeshes.append({"name": "M{0}".format(i),
+                               "primitives": primitives})
+
+    gltf = {"asset": {"generator": "building-server", "version": "2.0"}}
+    if gltfMeshes:
+        nodes = [{"mesh": i} for i in range(0, len(gltfMeshes))]
+        root["children"] = list(range(0, len(nodes)))
+        gltf.update({
+            "scene": 0,
+            "scenes": [{"nodes": [len(nodes)]}],
+            "nodes": nodes + [root],
+            "meshes": gltfMeshes,
+            "materials": [{"name": "defaultMaterial"}],
+            "accessors": accessors,
+            "bufferViews": bufferViews,
+            "buffers": [{"byteLength": binLength}]
+        })
+        if quantize:
+            gltf["extensionsUsed"] = ["KHR_mesh_quantization"]
+            gltf["extensionsRequired"] = ["KHR_mesh_quantization"]
     else:
-        json = outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, False, "test.bin")
-        binary = outputBin(binVertices, binIndices, binNormals)
-        return json
+        binLength = 0
+    if extras is not None:
+        gltf["extras"] = extras
+
+    # chunks must be 4-byte aligned, JSON with spaces and binary with zeros
+    scene = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    scene += b' ' * (-len(scene) % 4)
+    binLength += -binLength % 4
+
+    length = 12 + 8 + len(scene)
+    if binLength:
+        length += 8 + binLength
+    glb = bytearray(length)
+    struct.pack_into('<4sII', glb, 0, b'glTF', 2, length)
+    struct.pack_into('<I4s', glb, 12, len(scene), b'JSON')
+    view = memoryview(glb)
+    view[20:20 + len(scene)] = scene
+    if binLength:
+        offset = 20 + len(scene)
+        struct.pack_into('<I4s', glb, offset, binLength, b'BIN\x00')
+        offset += 8
+        for chunk in chain(binVertices, binNormals, binBatchIds, binIndices):
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+    return glb
+
+def quantizeVertices(binVertices, binNormals):
+    """
+    Quantizes float32 positions and normals of each primitive into 12 bytes
+    interleaved vertices: 3 uint16 for the position over the extent of all
+    the primitives and, after 2 bytes of padding, 2 int8 for the oct-encoded
+    normal followed by 2 more bytes of padding
+    Returns the packed vertices, the quantized min and max of each primitive
+    and the translation and scale which map [0, 1] back to the positions
+    """
+    positions = [np.frombuffer(b, dtype=np.float32).reshape(-1, 3)
+                 for b in binVertices]
+    allPositions = np.concatenate(positions + [np.zeros((1, 3), np.float32)])
+    low = allPositions.min(axis=0).astype(np.float64)
+    extent = allPositions.max(axis=0) - low
+    extent[extent == 0] = 1
+
+    packed = []
+    positionsMin = []
+    positionsMax = []
+    for (p, b) in zip(positions, binNormals):
+        vertices = np.zeros((len(p), 6), dtype=np.uint16)
+        q = np.rint((p - low) / extent * 65535)
+        vertices[:, 0:3] = np.clip(q, 0, 65535)
+        vertices[:, 4] = octEncode(np.frombuffer(b, dtype=np.float32)
+                                   .reshape(-1, 3)).view(np.uint16)[:, 0]
+        packed.append(vertices.tobytes())
+        if len(p):
+            positionsMin.append(vertices[:, 0:3].min(axis=0).tolist())
+            positionsMax.append(vertices[:, 0:3].max(axis=0).tolist())
+        else:
+            positionsMin.append([0, 0, 0])
+            positionsMax.append([0, 0, 0])
 
-def outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb):
-    scene = outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, True)
+    return (packed, positionsMin, positionsMax, low.tolist(), extent.tolist())
+
+def octEncode(normals):
+    """
+    Oct-encodes unit normals into (n, 2) normalized int8
+    """
+    n = normals / np.abs(normals).sum(axis=1)[:, np.newaxis]
+    (x, y) = (n[:, 0], n[:, 1])
+    south = n[:, 2] < 0
+    sx = np.where(x >= 0, 1., -1.)
+    sy = np.where(y >= 0, 1., -1.)
+    (x, y) = (np.where(south, (1 - np.abs(y)) * sx, x),
+              np.where(south, (1 - np.abs(x)) * sy, y))
+    return np.rint(np.column_stack((x, y)) * 127).astype(np.int8)
+
+def outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb, indexTypes = None, meshes = None, binBatchIds = None):
+    scene = outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, True, "data:,", indexTypes, meshes, binBatchIds)
 
     scene = struct.pack(str(len(scene)) + 's', scene.encode('utf8'))
     # body must be 4-byte aligned
@@ -70,7 +510,7 @@ def outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb):
     if trailing != 0:
         scene = scene + struct.pack(str(trailing) + 's', b' ' * trailing)
 
-    body = outputBin(binVertices, binIndices, binNormals)
+    body = outputBin(binVertices, binIndices, binNormals, binBatchIds)
 
     header = struct.pack('4s', "glTF".encode('utf8')) + \
                 struct.pack('I', 1) + \
@@ -80,20 +520,34 @@ def outputbglTF(binVertices, binIndices, binNormals, nVertices, nIndices, bb):
 
     return header + scene + body
 
-def outputBin(binVertices, binIndices, binNormals):
+def outputBin(binVertices, binIndices, binNormals, binBatchIds = None):
     binary = b''.join(binVertices)
     binary = binary + b''.join(binNormals)
+    binary = binary + b''.join(binBatchIds or [])
     binary = binary + b''.join(binIndices)
     return binary
 
-def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgltf, uri = "data:,"):
+def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgltf, uri = "data:,", indexTypes = None, meshes = None, binBatchIds = None):
+    """
+    Vertices, indices, normals, counts, bb, indexTypes and batch ids are
+    given per primitive, meshes lists the primitives of each mesh (one
+    primitive per mesh, 16 bits indices and no batch ids by default)
+    """
+    binBatchIds = binBatchIds or []
+    primitiveNb = len(binVertices)
+    if indexTypes is None:
+        indexTypes = [UNSIGNED_SHORT] * primitiveNb
+    if meshes is None:
+        meshes = [[i] for i in range(0, primitiveNb)]
+    meshNb = len(meshes)
+
     # Buffer
-    meshNb = len(binVertices)
     sizeIdx = []
     sizeVce = []
-    for i in range(0, meshNb):
+    for i in range(0, primitiveNb):
         sizeVce.append(len(binVertices[i]))
         sizeIdx.append(len(binIndices[i]))
+    sizeBatch = [len(b) for b in binBatchIds]
 
     uriStr = uri
     if uri != "":
@@ -102,7 +556,7 @@ def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgl
 "KHR_binary_glTF": {{
     "byteLength": {0},
     "type": "arraybuffer"{1}
-}}""".format(2 * sum(sizeVce) + sum(sizeIdx), uriStr)
+}}""".format(2 * sum(sizeVce) + sum(sizeBatch) + sum(sizeIdx), uriStr)
 
     # Buffer view
     bufferViews = """\
@@ -123,19 +577,30 @@ def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgl
     "byteLength": {1},
     "byteOffset": {1},
     "target": 34962
-}}""".format(sum(sizeIdx), sum(sizeVce), 2 * sum(sizeVce))
+}}""".format(sum(sizeIdx), sum(sizeVce), 2 * sum(sizeVce) + sum(sizeBatch))
+    if binBatchIds:
+        bufferViews += """,
+"BV_batchids": {{
+    "buffer": "KHR_binary_glTF",
+    "byteLength": {0},
+    "byteOffset": {1},
+    "target": 34962
+}}""".format(sum(sizeBatch), 2 * sum(sizeVce))
 
     # Accessor
+    offsetIdx = list(accumulate([0] + sizeIdx))
+    offsetVce = list(accumulate([0] + sizeVce))
+    offsetBatch = list(accumulate([0] + sizeBatch))
     accessors = ""
-    for i in range(0, meshNb):
+    for i in range(0, primitiveNb):
         bbmin = str(bb[i][0][1]) + ',' + str(bb[i][0][2]) + ',' + str(bb[i][0][0])
         bbmax = str(bb[i][1][1]) + ',' + str(bb[i][1][2]) + ',' + str(bb[i][1][0])
         accessors = accessors + """\
 "AI_{0}": {{
     "bufferView": "BV_indices",
     "byteOffset": {1},
-    "byteStride": 2,
-    "componentType": 5123,
+    "byteStride": {7},
+    "componentType": {8},
     "count": {3},
     "type": "SCALAR"
 }},
@@ -158,26 +623,45 @@ def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgl
     "max": [1,1,1],
     "min": [-1,-1,-1],
     "type": "VEC3"
-}},""".format(i, sum(sizeIdx[0:i]), sum(sizeVce[0:i]), nIndices[i], nVertices[i], bbmax, bbmin)
+}},""".format(i, offsetIdx[i], offsetVce[i], nIndices[i], nVertices[i], bbmax, bbmin,
+             4 if indexTypes[i] == UNSIGNED_INT else 2, indexTypes[i])
+        if binBatchIds:
+            accessors = accessors + """\
+"AB_{0}": {{
+    "bufferView": "BV_batchids",
+    "byteOffset": {1},
+    "byteStride": 4,
+    "componentType": 5126,
+    "count": {2},
+    "type": "SCALAR"
+}},""".format(i, offsetBatch[i], nVertices[i])
     accessors = accessors[0:len(accessors)-1]
 
     # Meshes
-    meshes = ""
-    for i in range(0, meshNb):
-        meshes = meshes + """\
-"M{0}": {{
-    "primitives": [{{
+    batchAttribute = ""
+    if binBatchIds:
+        batchAttribute = ',\n            "_BATCHID": "AB_{0}"'
+    primitives = []
+    for i in range(0, primitiveNb):
+        primitives.append("""\
+{{
         "attributes": {{
             "POSITION": "AV_{0}",
-            "NORMAL": "AN_{0}"
+            "NORMAL": "AN_{0}"{1}
         }},
         "indices": "AI_{0}",
         "material": "defaultMaterial",
         "mode": 4
-    }}]
-}},""".format(i)
+    }}""".format(i, batchAttribute.format(i)))
+
+    meshesJSON = []
+    for i in range(0, meshNb):
+        meshesJSON.append("""\
+"M{0}": {{
+    "primitives": [{1}]
+}}""".format(i, ", ".join(primitives[p] for p in meshes[i])))
 
-    meshes = meshes[0:len(meshes)-1]
+    meshes = ",".join(meshesJSON)
 
     # Nodes
     meshesId = ""
@@ -234,145 +718,294 @@ def outputJSON(binVertices, binIndices, binNormals, nVertices, nIndices, bb, bgl
 
     return JSON
 
-def moveOrigin(nodes, delta):
+def mergeMeshes(meshes):
     """
-    Translates all the point by minus delta
-    Packs the coordinates into floats
+    Merges (vertices, normals, indices) meshes into a single one
+    Returns a (vertices, normals, batchIds, indices) tuple where batchIds is
+    the float32 index of the mesh each vertex comes from
     """
-    for n in nodes:
-        for t in n:
-            for i in range(0,3):
-                t[i] = struct.pack('fff', t[i][1] - delta[1], t[i][2] - delta[2], t[i][0] - delta[0])
+    if not meshes:
+        return (np.empty((0, 3), np.float32), np.empty((0, 3), np.float32),
+                np.empty(0, np.float32), np.empty(0, np.int64))
+
+    counts = [len(m[0]) for m in meshes]
+    offsets = accumulate([0] + counts)
+    vertices = np.concatenate([m[0] for m in meshes])
+    normals = np.concatenate([m[1] for m in meshes])
+    indices = np.concatenate([m[2] + o for (m, o) in zip(meshes, offsets)])
+    batchIds = np.repeat(np.arange(len(meshes), dtype=np.float32), counts)
 
+    return (vertices, normals, batchIds, indices)
 
-def indexation(triangles, normals):
+
+def splitMesh(attributes, indices, maxVertices = MAX_UINT16_VERTICES):
+    """
+    Splits an indexed mesh into parts of at most maxVertices vertices
+    attributes is a tuple of per vertex arrays (vertices, normals, ...)
+    Returns a list of (attributes, indices) with 16 bits indices
     """
-    Creates an index for points
-    Replaces points in triangles by their index
+    triangles = indices.reshape(-1, 3)
+    # vertices are numbered by first appearance so the running maximum of the
+    # indices bounds the number of vertices a run of triangles introduces
+    runmax = np.maximum.accumulate(triangles.max(axis=1))
+    parts = []
+    start = 0
+    while start < len(triangles):
+        end = start + np.searchsorted(runmax[start:],
+                                      runmax[start] + maxVertices - 2)
+        while True:
+            (used, local) = np.unique(triangles[start:end].reshape(-1),
+                                      return_inverse=True)
+            if len(used) <= maxVertices:
+                break
+            end = start + max((end - start) // 2, 1)
+        parts.append((tuple(a[used] for a in attributes),
+                      local.reshape(-1).astype(np.uint16)))
+        start = end
+
+    return parts
+
+
+def moveOrigin(triangles, delta):
     """
-    index = {}
-    indices = []
-    orderedPoints = []
-    orderedNormals = []
-    maxIdx = 0
+    Translates all the point by minus delta
+    Swaps the axes to (y, z, x) and converts the coordinates to float32
+    """
+    delta = np.asarray(delta, dtype=np.float64)
+    return (triangles - delta)[..., [1, 2, 0]].astype(np.float32)
 
-    for i in range(0, len(triangles)):
-        n = struct.pack('fff', *normals[i])
-        for pt in triangles[i]:
-            if (n,pt) in index:
-                indices.append(index[(n,pt)])
-            else:
-                orderedPoints.append(pt)
-                orderedNormals.append(n)
-                index[(n,pt)] = maxIdx
-                indices.append(maxIdx)
-                maxIdx+=1
 
-    return (orderedPoints, orderedNormals, indices)
+def indexation(triangles, normals, features):
+    """
+    Creates an index for the points of each feature
+
+    triangles is a (n, 3, 3) float32 array for the whole tile, normals holds
+    one normal per triangle and features the number of triangles of each
+    feature. Vertices are deduplicated on their packed position and normal
+    with np.unique and keep their order of first appearance.
+
+    Returns a (vertices, normals, indices) tuple of arrays per feature
+    """
+    n = len(triangles)
+    featureIdx = np.repeat(np.arange(len(features), dtype=np.uint32),
+                           features)
+
+    # one 28 bytes row per vertex: feature, position and normal
+    rows = np.empty((n, 3, 7), dtype=np.uint32)
+    rows[:, :, 0] = featureIdx[:, np.newaxis]
+    rows[:, :, 1:4] = triangles.view(np.uint32)
+    rows[:, :, 4:7] = normals.astype(np.float32).view(np.uint32)[:, np.newaxis]
+    rows = rows.reshape(-1, 7)
+
+    (_, first, inverse) = np.unique(rows.view(np.dtype((np.void, 28))),
+                                    return_index=True, return_inverse=True)
+    # renumber unique vertices by first appearance, features stay contiguous
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    indices = rank[inverse.reshape(-1)]
+    vertices = rows[first[order]]
+
+    vertexBounds = np.searchsorted(vertices[:, 0], np.arange(len(features) + 1))
+    triangleBounds = 3 * np.concatenate(([0], np.cumsum(features)))
+    result = []
+    for i in range(0, len(features)):
+        v = vertices[vertexBounds[i]:vertexBounds[i + 1]]
+        result.append((v[:, 1:4].view(np.float32), v[:, 4:7].view(np.float32),
+                       indices[triangleBounds[i]:triangleBounds[i + 1]]
+                       - vertexBounds[i]))
+
+    return result
+
+
+# projection planes (yz), (zx) and (xy) indexed by the dominant normal axis
+_PROJECTIONS = np.array([[1, 2], [0, 2], [0, 1]])
+
+
+def triangulateRings(points, starts, ends):
+    """
+    Triangulates 3D rings given by their start and end offsets in points
+
+    Rings are projected on the plane facing their Newell normal. Convex rings
+    are fan triangulated in a single vectorized pass and concave ones go
+    through triangle. Triangles keep the orientation of their ring and are
+    returned in ring order as a (m, 3, 3) array.
+    """
+    counts = ends - starts
+    keep = counts >= 3
+    (starts, ends, counts) = (starts[keep], ends[keep], counts[keep])
+    if not len(counts):
+        return np.empty((0, 3, 3))
+
+    # per vertex index of the vertex itself, of the next and of the previous one
+    bounds = np.cumsum(counts) - counts
+    ringIdx = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - bounds[ringIdx]
+    idx = starts[ringIdx] + local
+    nxt = np.where(local == counts[ringIdx] - 1, starts[ringIdx], idx + 1)
+    prv = np.where(local == 0, ends[ringIdx] - 1, idx - 1)
+
+    # Newell normal relative to the first vertex of each ring
+    first = points[starts[ringIdx]]
+    cross = np.cross(points[idx] - first, points[nxt] - first)
+    normal = np.add.reduceat(cross, bounds)
+    axis = np.argmax(np.fabs(normal), axis=1)
+    proj = _PROJECTIONS[axis[ringIdx]]
+    flat = np.take_along_axis(points[idx], proj, axis=1)
+    flatNxt = np.take_along_axis(points[nxt], proj, axis=1)
+    flatPrv = np.take_along_axis(points[prv], proj, axis=1)
+
+    # convex rings turn the same way at every vertex and wind only once
+    (e0, e1) = (flat - flatPrv, flatNxt - flat)
+    turn = e0[:, 0] * e1[:, 1] - e0[:, 1] * e1[:, 0]
+    angle = np.arctan2(turn, (e0 * e1).sum(axis=1))
+    convex = (((np.minimum.reduceat(turn, bounds) >= 0)
+               | (np.maximum.reduceat(turn, bounds) <= 0))
+              & np.isclose(np.fabs(np.add.reduceat(angle, bounds)), 2 * np.pi))
+    convex |= counts == 3   # triangles are kept as they are
+
+    # fan triangulation (s, s+k, s+k+1) of convex rings
+    fanCounts = np.where(convex, counts - 2, 0)
+    fanRing = np.repeat(np.arange(len(counts)), fanCounts)
+    k = np.arange(fanCounts.sum()) - (np.cumsum(fanCounts)
+                                      - fanCounts)[fanRing] + 1
+    s = starts[fanRing]
+    triangles = [points[np.column_stack((s, s + k, s + k + 1))]]
+    order = [fanRing]
+
+    for r in np.flatnonzero(~convex):
+        tri = triangulate(points[starts[r]:ends[r]])
+        triangles.append(tri)
+        order.append(np.full(len(tri), r))
+
+    order = np.argsort(np.concatenate(order), kind='stable')
+    return np.concatenate(triangles)[order]
 
 
 def triangulate(polygon):
     """
-    Triangulates 3D polygons
-    """
-    vect1 = [polygon[1][0] - polygon[0][0],
-             polygon[1][1] - polygon[0][1],
-             polygon[1][2] - polygon[0][2]]
-    vect2 = [polygon[2][0] - polygon[0][0],
-             polygon[2][1] - polygon[0][1],
-             polygon[2][2] - polygon[0][2]]
-    vectProd = [vect1[1] * vect2[2] - vect1[2] * vect2[1],
-                vect1[2] * vect2[0] - vect1[0] * vect2[2],
-                vect1[0] * vect2[1] - vect1[1] * vect2[0]]
-    polygon2D = []
-    segments = list(range(len(polygon)))
-    segments.append(0)
+    Triangulates a 3D polygon given as a (n, 3) array with triangle
+    Returns a (m, 3, 3) array of triangles
+    """
+    vect1 = polygon[1] - polygon[0]
+    vect2 = polygon[2] - polygon[0]
+    vectProd = np.fabs(np.cross(vect1, vect2))
+    idx = np.arange(len(polygon))
+    segments = np.column_stack((idx, np.roll(idx, -1)))
     # triangulation of the polygon projected on planes (xy) (zx) or (yz)
-    if(math.fabs(vectProd[0]) > math.fabs(vectProd[1]) and math.fabs(vectProd[0]) > math.fabs(vectProd[2])):
+    if(vectProd[0] > vectProd[1] and vectProd[0] > vectProd[2]):
         # (yz) projection
-        for v in range(0,len(polygon)):
-            polygon2D.append([polygon[v][1], polygon[v][2]])
-    elif(math.fabs(vectProd[1]) > math.fabs(vectProd[2])):
+        axis = 0
+    elif(vectProd[1] > vectProd[2]):
         # (zx) projection
-        for v in range(0,len(polygon)):
-            polygon2D.append([polygon[v][0], polygon[v][2]])
+        axis = 1
     else:
         # (xy) projextion
-        for v in range(0,len(polygon)):
-            polygon2D.append([polygon[v][0], polygon[v][1]])
+        axis = 2
+    proj = _PROJECTIONS[axis]
+    polygon2D = polygon[:, proj]
 
-    triangulation = triangle.triangulate({'vertices': polygon2D, 'segments': segments})
+    triangulation = triangle.triangulate({'vertices': polygon2D, 'segments': segments}, 'p')
     if 'triangles' not in triangulation:    # if polygon is degenerate
-        return []
-    trianglesIdx = triangulation['triangles']
-    triangles = []
-
-    for t in trianglesIdx:
-        # triangulation may break triangle orientation, test it before adding triangles
-        if(t[0] > t[1] > t[2] or t[2] > t[0] > t[1] or t[1] > t[2] > t[0]):
-            triangles.append([polygon[t[1]], polygon[t[0]],polygon[t[2]]])
+        return np.empty((0, 3, 3))
+    t = triangulation['triangles']
+
+    # triangulation may break triangle orientation, test it before adding triangles
+    flip = (((t[:, 0] > t[:, 1]) & (t[:, 1] > t[:, 2]))
+            | ((t[:, 2] > t[:, 0]) & (t[:, 0] > t[:, 1]))
+            | ((t[:, 1] > t[:, 2]) & (t[:, 2] > t[:, 0])))
+    t[flip] = t[flip][:, [1, 0, 2]]
+
+    # self-intersecting rings get vertices at their crossings, which are
+    # lifted back on the plane of the first corner of the polygon
+    vertices = polygon
+    crossings = triangulation['vertices'][len(polygon):]
+    if len(crossings):
+        normal = np.cross(vect1, vect2)
+        if normal[axis] == 0:
+            t = t[(t < len(polygon)).all(axis=1)]
         else:
-            triangles.append([polygon[t[0]], polygon[t[1]],polygon[t[2]]])
+            lifted = np.empty((len(crossings), 3))
+            lifted[:, proj] = crossings
+            lifted[:, axis] = (polygon[0, axis]
+                               - np.dot(crossings - polygon[0, proj],
+                                        normal[proj]) / normal[axis])
+            vertices = np.concatenate((polygon, lifted))
 
-    return triangles
+    return vertices[t]
 
 
 def computeNormals(triangles):
-    normals = []
-    for t in triangles:
-        U = [t[1][0] - t[0][0],
-            t[1][1] - t[0][1],
-            t[1][2] - t[0][2]]
-        V = [t[2][0] - t[0][0],
-            t[2][1] - t[0][1],
-            t[2][2] - t[0][2]]
-        N = [U[1] * V[2] - V[1] * U[2],
-            U[2] * V[0] - V[2] * U[0],
-            U[0] * V[1] - V[0] * U[1]]
-        norm = (N[0] ** 2 + N[1] ** 2 + N[2] ** 2) ** 0.5
-        if norm == 0:
-            normals.append([1,0,0])
-        else:
-            normals.append([N[0] / norm,
-                N[1] / norm,
-                N[2] / norm])
-    return normals
+    """
+    Computes the unit normal of each triangle of a (n, 3, 3) array
+    Degenerate triangles get a (1, 0, 0) normal
+    """
+    N = np.cross(triangles[:, 1] - triangles[:, 0],
+                 triangles[:, 2] - triangles[:, 0])
+    norm = np.sqrt((N ** 2).sum(axis=1))
+    degenerate = norm == 0
+    N[degenerate] = [1, 0, 0]
+    norm[degenerate] = 1
+    return N / norm[:, np.newaxis]
 
 
 def parse(wkb):
     """
-    Expects Multipolygon Z
-    """
-    multiPolygon = []
-    #length = len(wkb)
-    #print length
-    #byteorder = struct.unpack('b', wkb[0:1])
-    #print byteorder
-    #geomtype = struct.unpack('I', wkb[1:5])    # 1006 (Multipolygon Z)
-    #print geomtype
-    geomNb = struct.unpack('I', wkb[5:9])[0]
-    #print geomNb
-    #print struct.unpack('b', wkb[9:10])[0]
-    #print struct.unpack('I', wkb[10:14])[0]   # 1003 (Polygon)
-    #print struct.unpack('I', wkb[14:18])[0]   # num lines
-    #print struct.unpack('I', wkb[18:22])[0]   # num points
-    offset = 9
+    Decodes a MultiPolygon Z or PolyhedralSurface Z in Well-Known Binary
+
+    Only ring headers are walked in Python, the coordinates of each ring are
+    read as a view on the buffer and all the views are copied at once. Both
+    byte orders are supported and the redundant closing point of each ring is
+    dropped.
+
+    Returns a (points, rings, polygons) tuple:
+        points : (n, 3) float64 array of coordinates
+        rings : start offset of each ring in points, plus the end offset
+        polygons : start offset of each polygon in rings, plus the end offset
+    """
+    wkb = memoryview(wkb)
+    (endian, geomType, geomNb, offset) = _header(wkb, 0)
+    if geomType == WKB_POLYGONZ:
+        # a single polygon, the header count is its number of rings
+        geomNb = 1
+        offset = 0
+    elif geomType not in (WKB_MULTIPOLYGONZ, WKB_POLYHEDRALSURFACEZ):
+        raise ValueError("Unsupported WKB geometry type {0}".format(geomType))
+
+    coordinates = []
+    rings = [0]
+    polygons = [0]
     for i in range(0, geomNb):
-        offset += 5#struct.unpack('bI', wkb[offset:offset+5])[0]  # 1 (byteorder), 1003 (Polygon)
-        lineNb = struct.unpack('I', wkb[offset:offset+4])[0]
-        offset += 4
-        polygon = []
+        # polygon header: byte order, type and number of rings
+        endian = '<' if wkb[offset] == 1 else '>'
+        unpack = _UINT32[endian].unpack_from
+        lineNb = unpack(wkb, offset + 5)[0]
+        offset += 9
         for j in range(0, lineNb):
-            pointNb = struct.unpack('I', wkb[offset:offset+4])[0]  # num points
-            offset += 4
-            line = []
-            for k in range(0, pointNb-1):
-                point = struct.unpack('ddd', wkb[offset:offset+24])
-                offset += 24
-                line.append(point)
-            offset += 24   # skip redundant point
-            polygon.append(line)
-        multiPolygon.append(polygon);
-    #print multiPolygon;
-    #print len(multiPolygon);
-    return multiPolygon;
+            pointNb = unpack(wkb, offset)[0]
+            if pointNb > 1:
+                # a view on the buffer, without the redundant closing point
+                coordinates.append(np.frombuffer(
+                    wkb, dtype=endian + 'f8', count=3 * (pointNb - 1),
+                    offset=offset + 4))
+            offset += 4 + 24 * pointNb
+            rings.append(rings[-1] + max(pointNb - 1, 0))
+        polygons.append(polygons[-1] + lineNb)
+
+    # the ring views are copied once, in the native byte order
+    points = np.empty((0, 3))
+    if coordinates:
+        points = np.concatenate(coordinates).astype(np.float64, copy=False)
+    return (points.reshape(-1, 3), np.array(rings), np.array(polygons))
+
+
+def _header(wkb, offset):
+    """
+    Reads the byte order, type and element count of a geometry header
+    EWKB Z flag is folded into the ISO type code
+    """
+    endian = '<' if wkb[offset] == 1 else '>'
+    (geomType, count) = struct.unpack_from(endian + 'II', wkb, offset + 1)
+    if geomType & 0x80000000:
+        geomType = (geomType & 0xffff) + 1000
+    return (endian, geomType, count, offset + 9)
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import io
+import hashlib
 import yaml
+import numpy as np
 
 
 class CitiesConfig(object):
 
     cities = {}
+    # digest of the configuration, which getCities is built from
+    version = None
+
+    # columns of every city table, processdb adds quadtile and weight
+    COLUMNS = ['gid', 'quadtile', 'weight']
 
     @classmethod
     def init(cls, cfgfile):
         content = io.open(cfgfile, 'r').read()
         cls.cities = yaml.load(content).get('cities', {})
+        cls.version = hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
 
     @classmethod
     def table(cls, city):
@@ -20,32 +28,78 @@ class CitiesConfig(object):
         else:
             return None
 
+    @classmethod
+    def attributes(cls, city):
+        """Returns the attributes which can be requested for the city
+        """
+        if city in cls.cities:
+            return cls.COLUMNS + (cls.cities[city].get('attributes') or [])
+        else:
+            return []
+
 
 class Box3D(object):
+    """
+    Bounding box parsed once from a 'BOX3D(x1 y1 z1,x2 y2 z2)' string or
+    built from its (x1, y1, z1, x2, y2, z2) values, as read from numeric
+    ST_XMin... ST_ZMax columns. Its JSON list is built on first use and
+    written as the database did for strings.
+    """
+
+    __slots__ = ('values', '_json')
+
+    def __init__(self, box):
+        if isinstance(box, str):
+            self._json = "[" + box[6:len(box)-1].replace(" ", ",") + "]"
+            self.values = tuple(map(float, self._json[1:-1].split(",")))
+        else:
+            self._json = None
+            self.values = tuple(map(float, box))
+
+    @staticmethod
+    def parse(boxes):
+        """Returns the values of a list of 'BOX3D(...)' strings as a (n, 6)
+        float array, parsed at once
+        """
+        values = ' '.join(b[6:len(b)-1].replace(',', ' ') for b in boxes)
+        return np.array(values.split(), dtype=np.float64).reshape(-1, 6)
 
-    def __init__(self, str):
-        self.str = str
+    @classmethod
+    def batch(cls, boxes):
+        """Returns the Box3D of a list of 'BOX3D(...)' strings
+        """
+        values = cls.parse(boxes).tolist()
+        batch = []
+        for (box, v) in zip(boxes, values):
+            b = cls.__new__(cls)
+            b.values = tuple(v)
+            b._json = "[" + box[6:len(box)-1].replace(" ", ",") + "]"
+            batch.append(b)
+        return batch
+
+    @staticmethod
+    def centroids(values):
+        """Returns the 2D centroids of the rows of a (n, 6) array of values
+        """
+        return (values[:, 0:2] + values[:, 3:5]) / 2.
 
     def aslist(self, bracket=True):
+        if self._json is None:
+            self._json = "[" + ",".join(map(repr, self.values)) + "]"
         if bracket:
-            return "[" + self.str[6:len(self.str)-1].replace(" ", ",") + "]"
+            return self._json
         else:
-            return self.str[6:len(self.str)-1].replace(" ", ",")
+            return self._json[1:-1]
 
     def centroid(self):
-        [p1, p2] = self.corners()
-        centroid = ((p2[0] + p1[0]) / 2., (p2[1] + p1[1]) / 2.)
-        return centroid
+        v = self.values
+        return ((v[3] + v[0]) / 2., (v[4] + v[1]) / 2.)
 
     def corners(self):
-        box = self.aslist(bracket=False).split(",")
-        c1 = [float(box[0]), float(box[1]), float(box[2])]
-        c2 = [float(box[3]), float(box[4]), float(box[5])]
-        return [c1, c2]
+        return [list(self.values[0:3]), list(self.values[3:6])]
 
     def geojson(self):
-        p = Property("bbox", self.aslist())
-        return p.geojson()
+        return '"bbox" : ' + self.aslist()
 
 
 class Property(object):
@@ -67,17 +121,8 @@ class PropertyCollection(object):
         self.properties.append(property)
 
     def geojson(self):
-        json = ""
-
-        for property in self.properties:
-            if json:
-                json = "{0}, {1}".format(json, property.geojson())
-            else:
-                json = property.geojson()
-
-        json = '"properties" : {{{0}}}'.format(json)
-
-        return json
+        json = ', '.join(property.geojson() for property in self.properties)
+        return '"properties" : {{{0}}}'.format(json)
 
 
 class Feature(object):
@@ -116,10 +161,18 @@ class FeatureCollection(object):
         self.features.append(feature)
 
     def geojson(self):
-        json = ('{{ {0}, {1}, {2} }}'
-                .format(self._geojson_type(), self._geojson_crs(),
-                        self._geojson_features()))
-        return json
+        return ''.join(self.chunks())
+
+    def chunks(self):
+        """Yields the same document as geojson, one feature at a time
+        """
+        yield ('{{ {0}, {1}, "features" : ['
+               .format(self._geojson_type(), self._geojson_crs()))
+        for (i, feature) in enumerate(self.features):
+            if i:
+                yield ', '
+            yield feature.geojson()
+        yield '] }'
 
     def _geojson_type(self):
         return '"type" : "FeatureCollection"'
@@ -131,14 +184,23 @@ class FeatureCollection(object):
         return json
 
     def _geojson_features(self):
-        json = ""
-
-        for feature in self.features:
-            if json:
-                json = "{0}, {1}".format(json, feature.geojson())
-            else:
-                json = feature.geojson()
-
-        json = '"features" : [{0}]'.format(json)
-
-        return json
+        json = ', '.join(feature.geojson() for feature in self.features)
+        return '"features" : [{0}]'.format(json)
+
+
+def buffered(chunks, size=1 << 16):
+    """Groups the strings or bytes yielded by chunks in pieces of at least
+    size items, so that a streamed response is not written to the client in
+    many small writes
+    """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield buffer[0][:0].join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield buffer[0][:0].join(buffer)
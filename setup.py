@@ -21,6 +21,14 @@ prod_requirements = (
     'uwsgi'
 )
 
+async_requirements = (
+    'uvicorn',
+)
+
+brotli_requirements = (
+    'brotli',
+)
+
 
 def find_version(*file_paths):
     """
@@ -57,5 +65,7 @@ setup(
     install_requires=requirements,
     extras_require={
         'prod': prod_requirements,
+        'async': async_requirements,
+        'brotli': brotli_requirements,
     }
 )
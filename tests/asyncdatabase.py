@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import asyncio
+import unittest
+from psycopg2.extensions import POLL_READ
+from building_server.asyncdatabase import AsyncConnectionPool, AsyncSession
+
+
+class MockCursor(object):
+
+    description = None
+
+    def execute(self, query, parameters=None):
+        pass
+
+
+class MockConnection(object):
+    """
+    Connection whose queries never complete
+    """
+
+    def __init__(self):
+        (self.socket, self.peer) = socket.socketpair()
+        self.closed = 0
+
+    def cursor(self):
+        return MockCursor()
+
+    def poll(self):
+        return POLL_READ
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.closed = 1
+        self.socket.close()
+        self.peer.close()
+
+
+class MockPool(AsyncConnectionPool):
+
+    async def connect(self):
+        self.conn = MockConnection()
+        return self.conn
+
+
+class TestAsyncSession(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = AsyncSession.pool
+
+    def tearDown(self):
+        AsyncSession.pool = self.pool
+
+    def test_cancel(self):
+        AsyncSession.pool = pool = MockPool(None, maxconn=1)
+
+        async def cancel():
+            query = asyncio.ensure_future(AsyncSession.query_asdict("SELECT 1"))
+            await asyncio.sleep(0.01)
+            query.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await query
+
+        asyncio.run(cancel())
+
+        # the connection was still running the query
+        self.assertEqual(pool.conn.closed, 1)
+        self.assertEqual(pool.stats()['used'], 0)
+        self.assertEqual(pool.stats()['free'], 0)
+        self.assertFalse(pool.slots.locked())
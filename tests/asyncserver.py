@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import unittest
+import json
+import gzip
+from building_server.asyncdatabase import AsyncSession
+from building_server.asyncserver import Application
+from building_server.cache import LRUCache, PrebuiltResponses, ResponseCache
+from building_server.compression import Compression
+from building_server.utils import CitiesConfig
+
+
+class MockApp(object):
+
+    def __init__(self):
+        self.config = {'PG_USER': 'user', 'PG_PASSWORD': '',
+                       'PG_HOST': 'localhost', 'PG_PORT': 5432,
+                       'PG_NAME': 'gml', 'URL_PREFIX': '/api'}
+
+
+class MockAsyncSession(object):
+
+    async def bbox_version(self, city):
+        return (1, 4, 0, 0)
+
+    async def tiles_for_level(self, city, level):
+        await asyncio.sleep(0)
+        return [{'quadtile': '0/0/0',
+                 'bbox': 'BOX3D(298814.346516 5041264.75924 43.595718,'
+                         '298870.831717 5041310.79423 43.595718)'}]
+
+    async def attributes_for_gids(self, city, gids, attributes):
+        if "height" in attributes:
+            raise ValueError("Unknown attribute 'height'")
+        return {gid: {a: str(gid * 10) for a in attributes} for gid in gids}
+
+
+class TestApplication(unittest.TestCase):
+
+    def setUp(self):
+        cfgfile = ("{0}/testcfg.yml"
+                   .format(os.path.dirname(os.path.abspath(__file__))))
+        CitiesConfig.init(cfgfile)
+        ResponseCache.memory = None
+        ResponseCache.disk = None
+        PrebuiltResponses.clear()
+
+        self.originals = dict(
+            (name, AsyncSession.__dict__[name]) for name in
+            ['tiles_for_level', 'bbox_version', 'attributes_for_gids'])
+        mockSession = MockAsyncSession()
+        AsyncSession.tiles_for_level = mockSession.tiles_for_level
+        AsyncSession.bbox_version = mockSession.bbox_version
+        AsyncSession.attributes_for_gids = mockSession.attributes_for_gids
+
+        self.app = Application(MockApp())
+
+    def tearDown(self):
+        for (name, method) in self.originals.items():
+            setattr(AsyncSession, name, method)
+
+    def get(self, path, query=b'', headers=[]):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': query, 'headers': headers}
+        asyncio.run(self.app(scope, receive, send))
+
+        headers = dict(messages[0]['headers'])
+        body = b''.join(m['body'] for m in messages[1:])
+        if b'content-length' in headers:
+            self.assertEqual(int(headers[b'content-length']), len(body))
+        return (messages[0]['status'], headers, body)
+
+    def test_getcity(self):
+        (status, headers, body) = self.get('/api/getCity', b'city=montreal')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+        self.assertEqual(json.loads(body)['tiles'][0]['id'], '0/0/0')
+
+    def test_getattribute(self):
+        (status, headers, body) = self.get(
+            '/api/getAttribute', b'city=montreal&gid=1,2&attribute=weight')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), [{'weight': '10'},
+                                            {'weight': '20'}])
+
+    def test_errors(self):
+        self.assertEqual(self.get('/api/getCity')[0], 400)
+        self.assertEqual(self.get('/getCity', b'city=montreal')[0], 404)
+        self.assertEqual(self.get('/api/getAttribute',
+                                  b'city=montreal&gid=1'
+                                  b'&attribute=height')[0], 400)
+        self.assertEqual(self.get('/api/getGeometry',
+                                  b'city=montreal&tile=0/0/0'
+                                  b'&merge=maybe')[0], 400)
+
+    def test_compression(self):
+        ResponseCache.memory = LRUCache(100000)
+        Compression.encodings = ['gzip']
+        Compression.minsize = 0
+        accept = [(b'accept-encoding', b'gzip')]
+        try:
+            for (path, query) in [('/api/getCity', b'city=montreal'),
+                                  ('/api/getAttribute',
+                                   b'city=montreal&gid=1&attribute=weight')]:
+                for i in range(0, 2):
+                    (status, headers, body) = self.get(path, query, accept)
+                    self.assertEqual(status, 200)
+                    self.assertEqual(headers[b'content-encoding'], b'gzip')
+                    json.loads(gzip.decompress(body))
+            self.assertEqual(ResponseCache.stats()['hits'], 1)
+        finally:
+            ResponseCache.memory = None
+            Compression.encodings = []
+            Compression.minsize = 1024
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from building_server.bboxindex import BboxIndex
+
+
+class TestBboxIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = BboxIndex([
+            ('0/0/0', 'BOX3D(0 0 0,4 4 10)'),
+            ('1/0/0', 'BOX3D(0 0 0,2 2 5.5)'),
+            ('1/1/0', 'BOX3D(0 2 1.25,2 4 10)'),
+            ('2/2/1', 'BOX3D(1 2 1.25,2 3 10)')])
+
+    def test_offset(self):
+        self.assertEqual(self.index.offset('1/1/0'), [0, 2, 1.25])
+        self.assertIsNone(self.index.offset('1/0/1'))
+
+    def test_levels(self):
+        self.assertEqual(self.index.tiles_for_level(0),
+                         [{'quadtile': '0/0/0',
+                           'bbox': 'BOX3D(0 0 0,4 4 10)'}])
+        self.assertEqual([t['quadtile'] for t in self.index.tiles_for_level(1)],
+                         ['1/0/0', '1/1/0'])
+        self.assertEqual(self.index.tiles_for_level(3), [])
+
+    def test_children(self):
+        self.assertEqual(self.index.children('0/0/0'), ['1/0/0', '1/1/0'])
+        self.assertEqual(self.index.children('1/1/0'), ['2/2/1'])
+        self.assertEqual(self.index.bbox_for_quadtiles(['2/2/0', '2/2/1']),
+                         [{'quadtile': '2/2/1',
+                           'bbox': 'BOX3D(1 2 1.25,2 3 10)'}])
+
+    def test_empty(self):
+        index = BboxIndex([])
+        self.assertEqual(index.corners.shape, (0, 6))
+        self.assertEqual(index.tiles_for_level(0), [])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+from building_server.cache import DiskCache, LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_budget(self):
+        cache = LRUCache(10)
+        cache.put(('getCity', 'lyon'), ('aaaa', 'text/plain'))
+        cache.put(('getCity', 'paris'), ('bbbb', 'text/plain'))
+        # lyon becomes the most recently used
+        cache.get(('getCity', 'lyon'))
+        cache.put(('getCity', 'rome'), ('cccc', 'text/plain'))
+
+        self.assertIsNone(cache.get(('getCity', 'paris')))
+        self.assertEqual(cache.get(('getCity', 'lyon')), ('aaaa', 'text/plain'))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1,
+                                         'evictions': 1, 'expirations': 0,
+                                         'entries': 2, 'bytes': 8})
+
+    def test_too_large(self):
+        cache = LRUCache(3)
+        cache.put(('getCity', 'lyon'), ('aaaa', 'text/plain'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_ttl(self):
+        cache = LRUCache(10, ttl=0.01)
+        cache.put(('getCity', 'lyon'), ('aaaa', 'text/plain'))
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get(('getCity', 'lyon')))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_invalidate(self):
+        cache = LRUCache(100)
+        cache.put(('getCity', 'lyon'), ('aaaa', 'text/plain'))
+        cache.put(('getGeometry', 'lyon', '0/0/0'), (b'glTF', 'text/plain'))
+        cache.put(('getCity', 'paris'), ('bbbb', 'text/plain'))
+        cache.invalidate('lyon')
+
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertIsNotNone(cache.get(('getCity', 'paris')))
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = DiskCache(self.root, 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def objects(self):
+        return [f for (d, n, files) in os.walk(self.root + '/objects')
+                for f in files]
+
+    def test_put(self):
+        self.cache.put(('getCity', 'lyon'), '{"tiles":[]}', 'text/plain')
+        self.cache.put(('getCity', 'paris'), b'{"tiles":[]}', 'text/plain')
+        self.assertIsNone(self.cache.get(('getCity', 'rome')))
+
+        (f, size, contentType) = self.cache.get(('getCity', 'lyon'))
+        with f:
+            self.assertEqual(f.read(), b'{"tiles":[]}')
+        self.assertEqual((size, contentType), (12, 'text/plain'))
+        # identical bodies are stored once
+        self.assertEqual(len(self.objects()), 1)
+        self.assertEqual(os.listdir(self.root + '/tmp'), [])
+
+    def test_clear(self):
+        self.cache.put(('getCity', 'lyon'), 'lyon', 'text/plain')
+        self.cache.put(('getCity', 'paris'), 'paris', 'text/plain')
+        self.cache.clear('lyon')
+
+        self.assertIsNone(self.cache.get(('getCity', 'lyon')))
+        (f, size, contentType) = self.cache.get(('getCity', 'paris'))
+        f.close()
+        self.assertEqual(size, 5)
+
+    def test_evict(self):
+        for i in range(0, 5):
+            body = str(i) * 30
+            self.cache.put(('getCity', 'city{0}'.format(i)), body,
+                           'text/plain')
+            digest = hashlib.sha1(body.encode()).hexdigest()
+            os.utime(self.cache._object(digest), (i, i))
+
+        # the oldest bodies were removed to stay under 90% of 100 bytes
+        self.assertEqual(len(self.objects()), 3)
+        self.assertIsNone(self.cache.get(('getCity', 'city1')))
+        self.cache.get(('getCity', 'city2'))[0].close()
+        self.assertEqual(self.cache.counters, {'hits': 1, 'misses': 1})
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import zlib
+import unittest
+from building_server.compression import Compression
+
+
+class MockApp(object):
+
+    def __init__(self, encodings):
+        self.config = {'COMPRESSION_ENCODINGS': encodings,
+                       'COMPRESSION_MIN_SIZE': 10}
+
+
+class TestCompression(unittest.TestCase):
+
+    def tearDown(self):
+        Compression.init_app(MockApp([]))
+
+    def test_negotiate(self):
+        Compression.init_app(MockApp(['gzip', 'deflate', 'compress']))
+
+        # unknown codings are not offered
+        self.assertEqual(Compression.encodings, ['gzip', 'deflate'])
+        self.assertEqual(Compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(Compression.negotiate('gzip;q=0.5, deflate'),
+                         'deflate')
+        self.assertIsNone(Compression.negotiate('gzip;q=0'))
+        self.assertIsNone(Compression.negotiate('identity'))
+        self.assertIsNone(Compression.negotiate(None))
+
+    def test_disabled(self):
+        Compression.init_app(MockApp(None))
+        self.assertIsNone(Compression.negotiate('gzip'))
+
+    def test_compress(self):
+        data = b'{"tiles":[]}' * 100
+        self.assertEqual(
+            gzip.decompress(Compression.compress(data, 'gzip')), data)
+        self.assertEqual(
+            zlib.decompress(Compression.compress(data, 'deflate')), data)
+
+        chunks = Compression.chunks(['{"tiles":[', ']}'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b'{"tiles":[]}')
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+import struct
+import threading
+from collections import namedtuple
+from psycopg2 import OperationalError
+from psycopg2.errors import UndefinedTable
+from psycopg2.pool import PoolError
+from building_server.database import (ConnectionPool, CopyBuffer, Session,
+                                      parse_copy)
+from building_server.utils import CitiesConfig
+
+
+Row = namedtuple('Row', ['query', 'parameters'])
+
+
+class MockCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def execute(self, query, parameters=None):
+        if self.conn.broken:
+            self.conn.closed = 1
+            raise OperationalError("server closed the connection")
+        self.conn.queries.append(query)
+        self.rows = [Row(query, parameters)]
+        self.rowcount = 1
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class MockConnection(object):
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.queries = []
+
+    def cursor(self):
+        return MockCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class MockPool(ConnectionPool):
+
+    def connect(self):
+        self.count('connects')
+        return MockConnection()
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = MockPool(None, maxconn=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+
+        self.assertIs(pool.getconn(), conn)
+        stats = pool.stats()
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual((stats['used'], stats['free']), (1, 0))
+
+    def test_exhausted(self):
+        pool = MockPool(None, maxconn=1, timeout=0.05)
+        conn = pool.getconn()
+        self.assertRaises(PoolError, pool.getconn)
+
+        # a released connection wakes up a waiting thread
+        timer = threading.Timer(0.01, pool.putconn, [conn])
+        pool.timeout = 5
+        timer.start()
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.stats()['waits'], 2)
+
+    def test_dead(self):
+        pool = MockPool(None, idle=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.broken = True
+
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['reconnects'], 1)
+
+
+def copy_field(value):
+    if value is None:
+        return struct.pack('>i', -1)
+    return struct.pack('>i', len(value)) + value
+
+
+class TestCopy(unittest.TestCase):
+
+    def test_parse(self):
+        data = CopyBuffer(capacity=16)
+        data.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+        for (kind, wkb) in [(0, None), (1, b'\x01\x02')]:
+            data.write(struct.pack('>h', 3)
+                       + copy_field(struct.pack('>h', kind))
+                       + copy_field(struct.pack('>d', 1.5)) + copy_field(wkb))
+        view = data.view()
+        data.write(struct.pack('>h', -1))
+
+        # growing the buffer leaves the previous views untouched
+        self.assertEqual(len(view), data.size - 2)
+        columns = [('kind', 'int2'), ('x', 'float8'), ('data', 'bytea')]
+        rows = parse_copy(data.view(), columns)
+        self.assertEqual(rows[0], {'kind': 0, 'x': 1.5, 'data': None})
+        self.assertEqual(bytes(rows[1]['data']), b'\x01\x02')
+
+    def test_signature(self):
+        self.assertRaises(ValueError, parse_copy, memoryview(b'COPY' * 8), [])
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        cfgfile = ("{0}/testcfg.yml"
+                   .format(os.path.dirname(os.path.abspath(__file__))))
+        CitiesConfig.init(cfgfile)
+
+        Session.release()
+        Session.pool = MockPool(None)
+
+    def tearDown(self):
+        Session.release()
+        Session.index_check = None
+        Session.indexes = {}
+        Session.version_check = None
+        Session.versions = {}
+        Session.mesh_tables = {}
+
+    def test_retry(self):
+        conn = Session.connection()
+        conn.broken = True
+
+        self.assertEqual(Session.query_aslist("SELECT 1"), ["SELECT 1", None])
+        self.assertIsNot(Session.connection(), conn)
+        self.assertEqual(Session.stats()['retries'], 1)
+
+    def test_release(self):
+        conn = Session.connection()
+        self.assertIs(Session.connection(), conn)
+
+        Session.release()
+        self.assertEqual(Session.stats()['free'], 1)
+
+    def test_prepared(self):
+        for tile in ["1/0/0", "1/0/1"]:
+            res = Session.query_prepared('offset', 'montreal',
+                                         'SELECT bbox from {0}_bbox'
+                                         ' WHERE quadtile = $1',
+                                         ['varchar'], [tile])
+            self.assertEqual(res[0]['parameters'], [tile])
+
+        self.assertEqual(Session.connection().queries, [
+            'PREPARE offset_montreal (varchar) AS'
+            ' SELECT bbox from montreal_bbox WHERE quadtile = $1',
+            'EXECUTE offset_montreal (%s)',
+            'EXECUTE offset_montreal (%s)'])
+        self.assertEqual(Session.statement_stats()['offset_montreal'],
+                         {'prepares': 1, 'executions': 2})
+
+    def test_tile_content(self):
+        rows = [{'kind': 2, 'gid': None, 'quadtile': '2/0/0',
+                 'bbox': 'BOX3D(0 0 0,1 1 1)', 'data': None},
+                {'kind': 1, 'gid': 12, 'quadtile': None,
+                 'bbox': 'BOX3D(1 2 3,4 5 6)', 'data': b'wkb'},
+                {'kind': 0, 'gid': None, 'quadtile': None,
+                 'bbox': 'BOX3D(1 2 3,8 8 8)', 'data': None}]
+        (offset, geoms, bboxes) = Session._tile_content(rows, 'box3d',
+                                                        'binary')
+
+        self.assertEqual(offset, [1, 2, 3])
+        self.assertEqual(geoms, [{'gid': 12, 'box3d': 'BOX3D(1 2 3,4 5 6)',
+                                  'binary': b'wkb'}])
+        self.assertEqual(bboxes, [{'quadtile': '2/0/0',
+                                   'bbox': 'BOX3D(0 0 0,1 1 1)'}])
+
+    def test_tiles_content(self):
+        children = {'1/0/0': ['2/0/0'], '1/1/0': []}
+        rows = [{'kind': 1, 'gid': 12, 'quadtile': '1/0/0',
+                 'bbox': 'BOX3D(1 2 3,4 5 6)', 'data': b'wkb'}]
+        bboxes = [{'quadtile': '2/0/0', 'bbox': 'BOX3D(0 0 0,1 1 1)'},
+                  {'quadtile': '1/0/0', 'bbox': 'BOX3D(1 2 3,8 8 8)'}]
+        content = Session._tiles_content(children, rows, bboxes, 'box3d',
+                                         'binary')
+
+        self.assertEqual(content['1/0/0'], (
+            [1, 2, 3],
+            [{'gid': 12, 'box3d': 'BOX3D(1 2 3,4 5 6)', 'binary': b'wkb'}],
+            [{'quadtile': '2/0/0', 'bbox': 'BOX3D(0 0 0,1 1 1)'}]))
+        # unknown tiles are empty
+        self.assertEqual(content['1/1/0'], (None, [], []))
+
+    def test_attributes(self):
+        self.assertRaises(ValueError, Session.attributes_for_gids,
+                          'montreal', [1], ['weight', 'gid; DROP TABLE x'])
+
+    def test_bbox_index(self):
+        versions = [(1, 4, 0, 0)]
+        loads = []
+
+        def query_asdict(cls, query, parameters=None, prepare=None):
+            loads.append(query)
+            return [{'quadtile': '0/0/0', 'bbox': 'BOX3D(1 2 3,4 5 6)'}]
+
+        originals = dict((name, Session.__dict__[name])
+                         for name in ['bbox_version', 'query_asdict'])
+        Session.index_check = 0
+        Session.bbox_version = classmethod(lambda cls, city: versions[0])
+        Session.query_asdict = classmethod(query_asdict)
+        try:
+            index = Session.bbox_index('montreal')
+            self.assertIs(Session.bbox_index('montreal'), index)
+            self.assertEqual(Session.offset('montreal', '0/0/0'), [1, 2, 3])
+            self.assertEqual(len(loads), 1)
+
+            # the table was written to since
+            versions[0] = (1, 8, 0, 0)
+            self.assertIsNot(Session.bbox_index('montreal'), index)
+            self.assertEqual(len(loads), 2)
+
+            # or dropped
+            versions[0] = None
+            self.assertIsNone(Session.bbox_index('montreal'))
+        finally:
+            for (name, method) in originals.items():
+                setattr(Session, name, method)
+
+    def test_dataset_version(self):
+        self.assertIsNone(Session.dataset_version('montreal'))
+
+        Session.version_check = 60
+        version = Session.dataset_version('montreal')
+        self.assertEqual(Session.dataset_version('montreal'), version)
+        # the version table is read once per delay
+        self.assertEqual(len(Session.connection().queries), 2)
+        self.assertIn('building_server_versions',
+                      Session.connection().queries[1])
+
+    def test_mesh_table(self):
+        versions = ['20170101']
+        found = [True]
+        names = []
+
+        def query_prepared(cls, name, city, sql, types, parameters):
+            names.append(name)
+            if 'mesh' in name:
+                raise UndefinedTable('relation "montreal_mesh" does not exist')
+            return []
+
+        originals = dict((name, Session.__dict__[name]) for name in
+                         ['dataset_version', 'query_aslist', 'query_prepared'])
+        Session.dataset_version = classmethod(lambda cls, city: versions[0])
+        Session.query_aslist = classmethod(lambda cls, sql: list(found))
+        Session.query_prepared = classmethod(query_prepared)
+        try:
+            self.assertTrue(Session.has_mesh_table('montreal'))
+
+            # the table was dropped since it was found
+            self.assertEqual(Session.tile_geom_binary('montreal', '0/0/0'), [])
+            self.assertEqual(names, ['tile_mesh_binary', 'tile_geom_binary'])
+            found[0] = False
+            self.assertFalse(Session.has_mesh_table('montreal'))
+
+            # and built again by a later processdb run
+            found[0] = True
+            self.assertFalse(Session.has_mesh_table('montreal'))
+            versions[0] = '20170102'
+            self.assertTrue(Session.has_mesh_table('montreal'))
+        finally:
+            for (name, method) in originals.items():
+                setattr(Session, name, method)
+
+    def test_tile_content_sql(self):
+        sql = Session._tile_content_sql("gid", "Box3D(geom)", "wkb",
+                                        "{0} where quadtile = $1",
+                                        metadata=False)
+        self.assertEqual(sql.count("SELECT"), 1)
+        self.assertNotIn("_bbox", sql)
+        self.assertIn("1::int2 as kind", sql)
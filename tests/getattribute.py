@@ -2,6 +2,7 @@
 
 import unittest
 import json
+from werkzeug.exceptions import BadRequest
 from building_server.database import Session
 from building_server.server import GetAttribute
 
@@ -21,13 +22,21 @@ class MockSession(object):
             elif attribute == "quadtile":
                 return "6/7/33"
 
+    def attributes_for_gids(self, city, gids, attributes):
+        if "height" in attributes:
+            raise ValueError("Unknown attribute 'height'")
+        return {gid: {a: self.attribute_for_gid(city, str(gid), a)
+                      for a in attributes}
+                for gid in gids}
+
 
 class TestGetAttribute(unittest.TestCase):
 
     def setUp(self):
         # init mock session
+        self.attributes_for_gids = Session.__dict__['attributes_for_gids']
         mockSession = MockSession()
-        Session.attribute_for_gid = mockSession.attribute_for_gid
+        Session.attributes_for_gids = mockSession.attributes_for_gids
 
         # build args
         self.args = {}
@@ -36,7 +45,7 @@ class TestGetAttribute(unittest.TestCase):
         self.args['attribute'] = "weight,quadtile"
 
     def tearDown(self):
-        pass
+        Session.attributes_for_gids = self.attributes_for_gids
 
     def test(self):
         # expected json
@@ -44,7 +53,7 @@ class TestGetAttribute(unittest.TestCase):
         # {"weight":509.653,"quadtile":6/7/33}]
 
         result = GetAttribute().run(self.args)
-        json_result = json.loads(result)
+        json_result = json.loads(result.get_data(as_text=True))
 
         json_gid0 = json_result[0]
         self.assertEqual(json_gid0["weight"], "131.418")
@@ -53,3 +62,17 @@ class TestGetAttribute(unittest.TestCase):
         json_gid1 = json_result[1]
         self.assertEqual(json_gid1["weight"], "509.653")
         self.assertEqual(json_gid1["quadtile"], "6/7/33")
+
+    def test_bytes(self):
+        result = GetAttribute().run(self.args)
+        self.assertEqual(result.get_data(as_text=True),
+                         '[{ "weight" : "131.418", "quadtile" : "5/15/12" }, '
+                         '{ "weight" : "509.653", "quadtile" : "6/7/33" }]')
+
+    def test_invalid(self):
+        self.args['attribute'] = "weight,height"
+        self.assertRaises(BadRequest, GetAttribute().run, self.args)
+
+        self.args['attribute'] = "weight"
+        self.args['gid'] = "1,1 or 1=1"
+        self.assertRaises(BadRequest, GetAttribute().run, self.args)
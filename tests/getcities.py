@@ -4,6 +4,7 @@ import unittest
 import json
 import os
 
+from building_server.cache import PrebuiltResponses
 from building_server.utils import CitiesConfig
 from building_server.server import GetCities
 
@@ -14,6 +15,7 @@ class TestGetCities(unittest.TestCase):
         cfgfile = ("{0}/testcfg.yml"
                    .format(os.path.dirname(os.path.abspath(__file__))))
         CitiesConfig.init(cfgfile)
+        PrebuiltResponses.clear()
 
     def tearDown(self):
         pass
@@ -27,7 +29,7 @@ class TestGetCities(unittest.TestCase):
         # [299337.78, 5042223.5]], "attributes": []}}
 
         str_result = GetCities().run()
-        json_result = json.loads(str_result)["montreal"]
+        json_result = json.loads(str_result.get_data(as_text=True))["montreal"]
 
         self.assertEqual(json_result["srs"], "EPSG:2950")
         self.assertEqual(json_result["featurespertile"], 2)
@@ -36,3 +38,16 @@ class TestGetCities(unittest.TestCase):
         self.assertEqual(json_result["extent"],
                          [[297949.75, 5040582.5], [299337.78, 5042223.5]])
         self.assertEqual(json_result["attributes"], [])
+
+    def test_json(self):
+        cities = CitiesConfig.cities
+        CitiesConfig.cities = {"montreal": {"attributes": ["l'annee"],
+                                            "srs": None}}
+        CitiesConfig.version = 'quotes'
+        try:
+            result = GetCities().run()
+            self.assertEqual(json.loads(result.get_data(as_text=True)),
+                             CitiesConfig.cities)
+            self.assertIn('ETag', result.headers)
+        finally:
+            CitiesConfig.cities = cities
@@ -2,12 +2,20 @@
 
 import unittest
 import json
+from building_server.cache import PrebuiltResponses
+from building_server.compression import Compression
 from building_server.database import Session
 from building_server.server import GetCity
 
 
 class MockSession(object):
 
+    def __init__(self):
+        self.bbox_versions = [(1, 4, 0, 0)]
+
+    def bbox_version(self, city):
+        return self.bbox_versions[0]
+
     def tiles_for_level(self, city, level):
         d0 = {}
         d0['quadtile'] = '6/22/28'
@@ -26,15 +34,21 @@ class TestGetCity(unittest.TestCase):
 
     def setUp(self):
         # init mock session
+        self.originals = dict((name, Session.__dict__[name])
+                              for name in ['tiles_for_level', 'bbox_version'])
         mockSession = MockSession()
         Session.tiles_for_level = mockSession.tiles_for_level
+        Session.bbox_version = mockSession.bbox_version
+        self.mockSession = mockSession
+        PrebuiltResponses.clear()
 
         # build args
         self.args = {}
         self.args['city'] = "montreal"
 
     def tearDown(self):
-        pass
+        for (name, method) in self.originals.items():
+            setattr(Session, name, method)
 
     def test(self):
         # expected json
@@ -47,7 +61,7 @@ class TestGetCity(unittest.TestCase):
         # 5041048.36555,59.574652]}]}
 
         result = GetCity().run(self.args)
-        json_result = json.loads(result)
+        json_result = json.loads(result.get_data(as_text=True))
 
         json_tile0 = json_result["tiles"][0]
         self.assertEqual(json_tile0["id"], "6/22/28")
@@ -60,3 +74,46 @@ class TestGetCity(unittest.TestCase):
         self.assertEqual(json_tile1["bbox"],
                          [298965.878429, 5041026.69609, 43.23579,
                          298980.783748, 5041048.36555, 59.574652])
+
+    def test_bytes(self):
+        result = GetCity().run(self.args)
+
+        self.assertFalse(result.is_streamed)
+        self.assertEqual(result.get_data(as_text=True),
+                         '{"tiles":[{ "id" : "6/22/28", "bbox" : '
+                         '[298814.346516,5041264.75924,43.595718,'
+                         '298870.831717,5041310.79423,43.595718] }, '
+                         '{ "id" : "8/58/131", "bbox" : '
+                         '[298965.878429,5041026.69609,43.23579,'
+                         '298980.783748,5041048.36555,59.574652] }]}')
+
+    def test_prebuilt(self):
+        Compression.encodings = ['gzip']
+        Compression.minsize = 0
+        dataset_version = Session.__dict__['dataset_version']
+        versions = ['20170101']
+        Session.dataset_version = classmethod(lambda cls, city: versions[0])
+        try:
+            expected = GetCity().run(self.args).get_data()
+
+            # the response is not built again, its variants are ready
+            tiles_for_level = Session.tiles_for_level
+            Session.tiles_for_level = None
+            self.assertEqual(GetCity().run(self.args).get_data(), expected)
+            variants = PrebuiltResponses.entries[('getCity', 'montreal')][1]
+            self.assertEqual(sorted(variants, key=str), [None, 'gzip'])
+
+            # until the dataset is rebuilt
+            versions[0] = '20170102'
+            self.assertRaises(TypeError, GetCity().run, self.args)
+            Session.tiles_for_level = tiles_for_level
+            self.assertEqual(GetCity().run(self.args).get_data(), expected)
+
+            # or the bbox table changes
+            Session.tiles_for_level = None
+            self.mockSession.bbox_versions[0] = (1, 8, 0, 0)
+            self.assertRaises(TypeError, GetCity().run, self.args)
+        finally:
+            Session.dataset_version = dataset_version
+            Compression.encodings = []
+            Compression.minsize = 1024
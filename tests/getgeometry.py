@@ -3,8 +3,15 @@
 import unittest
 import json
 import os
+import struct
+import gzip
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+from building_server.cache import HTTPCache, LRUCache, ResponseCache
+from building_server.compression import Compression
 from building_server.database import Session
-from building_server.server import GetGeometry
+from building_server.server import GetGeometries, GetGeometry
+from building_server.transcode import packMesh
 from building_server.utils import CitiesConfig
 
 
@@ -58,23 +65,72 @@ class MockSession(object):
             elif attribute == "quadtile":
                 return "8/58/131"
 
+    def attributes_for_gids(self, city, gids, attributes):
+        return {gid: {a: self.attribute_for_gid(city, str(gid), a)
+                      for a in attributes}
+                for gid in gids}
+
     def empty_tile_geom_binary(self, city, tile):
         return []
 
+    def tile_geom_binary(self, city, tile):
+        # MultiPolygon Z with a single triangle
+        wkb = struct.pack('<BII', 1, 1006, 1)
+        wkb += struct.pack('<BIII', 1, 1003, 1, 4)
+        wkb += struct.pack('<12d', 298814.346516, 5041264.75924, 43.595718,
+                           298815.346516, 5041264.75924, 43.595718,
+                           298815.346516, 5041265.75924, 43.595718,
+                           298814.346516, 5041264.75924, 43.595718)
+        d0 = {}
+        d0['gid'] = 1795
+        d0['binary'] = wkb
+        d0['box3d'] = ('BOX3D(298814.346516 5041264.75924 43.595718,'
+                       '298815.346516 5041265.75924 43.595718)')
+        return [d0]
+
+    def tile_mesh_binary(self, city, tile):
+        d0 = self.tile_geom_binary(city, tile)[0]
+        d0['mesh'] = packMesh(d0.pop('binary'), d0['box3d'])
+        return [d0]
+
+    def tile_content_geojson(self, city, tile, children):
+        offset = self.offset(city, tile)
+        return (offset, self.tile_geom_geojson(city, offset, tile),
+                self.bbox_for_quadtiles(city, children))
+
+    def tile_content(self, tile_geom_binary):
+        def tile_content_binary(city, tile, children):
+            return (self.offset(city, tile), tile_geom_binary(city, tile),
+                    self.bbox_for_quadtiles(city, children))
+        return tile_content_binary
+
+    def tiles_content(self, tile_geom_binary):
+        def tiles_content_binary(city, children):
+            return {tile: (self.offset(city, tile),
+                           tile_geom_binary(city, tile),
+                           self.bbox_for_quadtiles(city, quadtiles))
+                    for (tile, quadtiles) in children.items()}
+        return tiles_content_binary
+
 
 class TestGetGeometry(unittest.TestCase):
 
+    # Session methods replaced by the tests
+    MOCKED = ['tile_content_geojson', 'tile_content_binary',
+              'tiles_content_binary', 'attributes_for_gids']
+
     def setUp(self):
+        self.originals = dict((name, Session.__dict__[name])
+                              for name in self.MOCKED)
+
         # init mock session
         cfgfile = ("{0}/testcfg.yml"
                    .format(os.path.dirname(os.path.abspath(__file__))))
         CitiesConfig.init(cfgfile)
 
         self.mockSession = MockSession()
-        Session.offset = self.mockSession.offset
-        Session.tile_geom_geojson = self.mockSession.tile_geom_geojson
-        Session.bbox_for_quadtiles = self.mockSession.bbox_for_quadtiles
-        Session.attribute_for_gid = self.mockSession.attribute_for_gid
+        Session.tile_content_geojson = self.mockSession.tile_content_geojson
+        Session.attributes_for_gids = self.mockSession.attributes_for_gids
 
         # build args
         self.args = {}
@@ -83,7 +139,8 @@ class TestGetGeometry(unittest.TestCase):
         self.args['attributes'] = ""
 
     def tearDown(self):
-        pass
+        for (name, method) in self.originals.items():
+            setattr(Session, name, method)
 
     def test_format_geojson(self):
         # expected json format
@@ -111,7 +168,7 @@ class TestGetGeometry(unittest.TestCase):
         args['format'] = "geojson"
 
         result = GetGeometry().run(args)
-        json_result = json.loads(result)
+        json_result = json.loads(result.get_data(as_text=True))
 
         json_geom = json_result["geometries"]
         self.assertEqual(json_geom["type"], "FeatureCollection")
@@ -167,14 +224,109 @@ class TestGetGeometry(unittest.TestCase):
         # \x00\x00{"tiles":[]}'
         expected = bytearray(b'\x67\x6c\x54\x46\x01\x00\x00\x00\x14\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x7b\x22\x74\x69\x6c\x65\x73\x22\x3a\x5b\x5d\x7d')
 
-        Session.tile_geom_binary = self.mockSession.empty_tile_geom_binary
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.empty_tile_geom_binary)
 
         args = self.args
         args['format'] = ""
 
         result = GetGeometry().run(args)
-        self.assertEqual(result, expected.decode("utf-8"))
+        self.assertEqual(result.get_data(as_text=True),
+                         expected.decode("utf-8"))
+
 
+    def test_format_empty_glb2(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.empty_tile_geom_binary)
+
+        args = self.args
+        args['format'] = "glb2"
+
+        result = GetGeometry().run(args)
+        self.assertEqual(result.headers['Content-Type'], 'model/gltf-binary')
+
+        glb = result.get_data()
+        (magic, version, length, jsonLength, jsonType) = struct.unpack(
+            '<4sIII4s', glb[0:20])
+        self.assertEqual(magic, b'glTF')
+        self.assertEqual(version, 2)
+        self.assertEqual(length, len(glb))
+        self.assertEqual(jsonType, b'JSON')
+        self.assertEqual(length, 20 + jsonLength)
+
+        gltf = json.loads(glb[20:].decode('utf-8'))
+        self.assertEqual(gltf['asset']['version'], "2.0")
+        self.assertEqual(gltf['extras'], {"tiles": []})
+
+    def test_format_empty_glb2_merged(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.empty_tile_geom_binary)
+
+        args = self.args
+        args['format'] = "glb2"
+        args['merge'] = True
+
+        glb = GetGeometry().run(args).get_data()
+        gltf = json.loads(glb[20:].decode('utf-8'))
+        self.assertEqual(gltf['extras'], {"tiles": [], "gids": []})
+
+    def test_format_glb2(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.tile_geom_binary)
+
+        args = self.args
+        args['format'] = "glb2"
+
+        glb = GetGeometry().run(args).get_data()
+        (length, jsonLength) = struct.unpack('<II', glb[8:16])
+        gltf = json.loads(glb[20:20 + jsonLength].decode('utf-8'))
+        (binLength, binType) = struct.unpack('<I4s', glb[20 + jsonLength:
+                                                      28 + jsonLength])
+        self.assertEqual(binType, b'BIN\x00')
+        self.assertEqual(length, 28 + jsonLength + binLength)
+        self.assertEqual(gltf['buffers'][0]['byteLength'], 78)
+
+        self.assertEqual(gltf['meshes'][0]['name'], "M0")
+        position = gltf['accessors'][0]
+        self.assertEqual(position['count'], 3)
+        self.assertEqual(position['min'], [0, 0, 0])
+        self.assertEqual(position['max'], [1, 0, 1])
+
+        json_tile0 = gltf['extras']['tiles'][0]
+        self.assertEqual(json_tile0["id"], "6/22/28")
+        self.assertEqual(json_tile0["bbox"], [298814.346516, 5041264.75924,
+                         43.595718, 298870.831717, 5041310.79423, 43.595718])
+
+    def test_format_glb2_prebuilt(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.tile_geom_binary)
+        args = self.args
+        args['format'] = "glb2"
+        expected = GetGeometry().run(args).get_data()
+
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.tile_mesh_binary)
+        glb = GetGeometry().run(args).get_data()
+        self.assertEqual(glb, expected)
+
+    def test_format_glb2_merged(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.tile_geom_binary)
+
+        args = self.args
+        args['format'] = "glb2"
+        args['merge'] = True
+
+        glb = GetGeometry().run(args).get_data()
+        jsonLength = struct.unpack('<I', glb[12:16])[0]
+        gltf = json.loads(glb[20:20 + jsonLength].decode('utf-8'))
+
+        self.assertEqual(len(gltf['meshes']), 1)
+        attributes = gltf['meshes'][0]['primitives'][0]['attributes']
+        batchIds = gltf['accessors'][attributes['_BATCHID']]
+        self.assertEqual(batchIds['count'], 3)
+        self.assertEqual(batchIds['componentType'], 5126)
+        self.assertEqual(gltf['extras']['gids'], [1795])
 
     def test_with_attribute(self):
         # expected json format
@@ -187,7 +339,7 @@ class TestGetGeometry(unittest.TestCase):
         args['attributes'] = "quadtile,weight"
 
         result = GetGeometry().run(args)
-        json_result = json.loads(result)
+        json_result = json.loads(result.get_data(as_text=True))
 
         json_f0_prop = json_result["geometries"]["features"][0]["properties"]
         json_f1_prop = json_result["geometries"]["features"][1]["properties"]
@@ -200,3 +352,152 @@ class TestGetGeometry(unittest.TestCase):
 
         self.assertEqual(json_f0_prop["quadtile"], "6/22/28")
         self.assertEqual(json_f1_prop["quadtile"], "8/58/131")
+
+    def test_cache(self):
+        ResponseCache.memory = LRUCache(100000)
+        try:
+            Session.tile_content_binary = self.mockSession.tile_content(
+                self.mockSession.tile_geom_binary)
+            args = self.args
+            args['format'] = "glb2"
+            expected = GetGeometry().run(args).get_data()
+
+            Session.tile_content_binary = None
+            result = GetGeometry().run(args)
+            self.assertEqual(result.get_data(), expected)
+            self.assertEqual(result.headers['Content-Type'],
+                             'model/gltf-binary')
+            self.assertEqual(ResponseCache.stats()['hits'], 1)
+        finally:
+            ResponseCache.memory = None
+
+    def test_format_binary(self):
+        Session.tile_content_binary = self.mockSession.tile_content(
+            self.mockSession.tile_geom_binary)
+        args = self.args
+        args['format'] = ""
+
+        result = GetGeometry().run(args)
+        self.assertEqual(result.headers['Content-Type'],
+                         'application/octet-stream')
+
+        data = result.get_data()
+        (magic, version, length, sceneLength) = struct.unpack(
+            '<4sIII', data[0:16])
+        self.assertEqual(magic, b'glTF')
+        tail = json.loads('{' + data[length:].decode('utf-8')[1:])
+        self.assertEqual(tail['tiles'][0]['id'], "6/22/28")
+
+    def test_compression(self):
+        ResponseCache.memory = LRUCache(100000)
+        Compression.encodings = ['gzip']
+        Compression.cache = True
+        try:
+            Session.tile_content_binary = self.mockSession.tile_content(
+                self.mockSession.tile_geom_binary)
+            args = self.args
+            args['format'] = "glb2"
+            with Flask(__name__).test_request_context():
+                expected = GetGeometry().run(args).get_data()
+
+            headers = {'Accept-Encoding': 'deflate, gzip'}
+            for i in range(0, 2):
+                with Flask(__name__).test_request_context(headers=headers):
+                    result = GetGeometry().run(args)
+                self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(result.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(gzip.decompress(result.get_data()),
+                                 expected)
+
+            # the second request found the compressed body in the cache
+            self.assertEqual(ResponseCache.stats()['entries'], 2)
+            self.assertEqual(ResponseCache.stats()['hits'], 2)
+        finally:
+            ResponseCache.memory = None
+            Compression.encodings = []
+            Compression.cache = False
+
+    def test_etag(self):
+        dataset_version = Session.__dict__['dataset_version']
+        Session.dataset_version = classmethod(lambda cls, city: '20170101')
+        HTTPCache.maxages = {'getGeometry': 60}
+        try:
+            Session.tile_content_binary = self.mockSession.tile_content(
+                self.mockSession.tile_geom_binary)
+            args = self.args
+            args['format'] = "glb2"
+            with Flask(__name__).test_request_context():
+                result = GetGeometry().run(args)
+            etag = result.headers['ETag']
+            self.assertEqual(result.headers['Cache-Control'],
+                             'public, max-age=60')
+
+            # the tile is not built again
+            Session.tile_content_binary = None
+            headers = {'If-None-Match': etag}
+            with Flask(__name__).test_request_context(headers=headers):
+                result = GetGeometry().run(args)
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(result.headers['ETag'], etag)
+
+            # other tiles have other tags
+            args['tile'] = "6/22/29"
+            self.assertNotEqual(
+                HTTPCache.etag(GetGeometry()._key(args) + ('20170101',)),
+                etag.strip('"'))
+        finally:
+            Session.dataset_version = dataset_version
+            HTTPCache.maxages = {}
+
+    def parts(self, data):
+        parts = []
+        while data:
+            (length,) = struct.unpack('<H', data[0:2])
+            tile = data[2:2 + length].decode('utf-8')
+            data = data[2 + length:]
+            (length,) = struct.unpack('<I', data[0:4])
+            parts.append((tile, data[4:4 + length]))
+            data = data[4 + length:]
+        return parts
+
+    def test_getgeometries(self):
+        ResponseCache.memory = LRUCache(100000)
+        try:
+            Session.tile_content_binary = self.mockSession.tile_content(
+                self.mockSession.tile_geom_binary)
+            args = self.args
+            args['format'] = "glb2"
+            expected = {}
+            for tile in ["6/22/29", "6/22/28"]:
+                args['tile'] = tile
+                expected[tile] = GetGeometry().run(args).get_data()
+            ResponseCache.memory = LRUCache(100000)
+
+            # 6/22/28 comes from the cache, 6/22/29 from a batch query
+            args['tile'] = "6/22/28"
+            GetGeometry().run(args)
+            Session.tile_content_binary = None
+            Session.tiles_content_binary = self.mockSession.tiles_content(
+                self.mockSession.tile_geom_binary)
+            args['tiles'] = "6/22/29,6/22/28,6/22/29"
+            result = GetGeometries().run(args)
+            self.assertEqual(result.headers['Content-Type'],
+                             'application/octet-stream')
+            self.assertEqual(self.parts(result.get_data()),
+                             [("6/22/29", expected["6/22/29"]),
+                              ("6/22/28", expected["6/22/28"])])
+
+            # the tiles transcoded for getGeometries are cached as well
+            Session.tiles_content_binary = None
+            args['tile'] = "6/22/29"
+            self.assertEqual(GetGeometry().run(args).get_data(),
+                             expected["6/22/29"])
+        finally:
+            ResponseCache.memory = None
+
+    def test_getgeometries_invalid(self):
+        args = self.args
+        args['tiles'] = "6/22/28,6/22"
+        with self.assertRaises(HTTPException) as cm:
+            GetGeometries().run(args)
+        self.assertEqual(cm.exception.code, 400)
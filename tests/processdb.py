@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+import importlib.util
+from building_server.database import Session
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'building-server-processdb.py')
+spec = importlib.util.spec_from_file_location('processdb', path)
+processdb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(processdb)
+
+
+class MockSession(object):
+
+    def __init__(self, features):
+        self.features = features
+        self.quadtiles = {}
+        self.bboxes = {}
+
+    def score_for_polygon(self, city, poly, scoreFunction):
+        return self.features
+
+    def update_table(self, city, quadtile, score, gid):
+        self.quadtiles[gid] = quadtile
+
+    def insert_into_bbox_table(self, city, quadtile, bbox):
+        self.bboxes[quadtile] = bbox
+
+
+class TestInitDB(unittest.TestCase):
+
+    METHODS = ['score_for_polygon', 'update_table', 'insert_into_bbox_table',
+               'add_column', 'create_index', 'create_bbox_table']
+
+    def setUp(self):
+        self.originals = dict((name, Session.__dict__[name])
+                              for name in self.METHODS)
+        for name in ['add_column', 'create_index', 'create_bbox_table']:
+            setattr(Session, name, classmethod(lambda cls, *args: None))
+
+    def tearDown(self):
+        for (name, method) in self.originals.items():
+            setattr(Session, name, method)
+
+    def mock(self, features):
+        mockSession = MockSession(features)
+        Session.score_for_polygon = mockSession.score_for_polygon
+        Session.update_table = mockSession.update_table
+        Session.insert_into_bbox_table = mockSession.insert_into_bbox_table
+        return mockSession
+
+    def test_quadtiles(self):
+        # a building in each of the three tiles of the extent, and three in
+        # the first one which is divided
+        features = [
+            {'gid': 1, 'box3d': 'BOX3D(40 40 0,60 60 10)', 'score': 9},
+            {'gid': 2, 'box3d': 'BOX3D(140 40 0,160 60 10)', 'score': 9},
+            {'gid': 3, 'box3d': 'BOX3D(240 40 0,260 60 10)', 'score': 9},
+            {'gid': 4, 'box3d': 'BOX3D(10 10 0,20 20 5)', 'score': 1},
+            {'gid': 5, 'box3d': 'BOX3D(60 70 0,70 80 5)', 'score': 1}]
+        conf = {'extent': [[0, 0], [300, 100]], 'maxtilesize': 100,
+                'featurespertile': 1}
+        mockSession = self.mock(features)
+
+        processdb.initDB('montreal', conf, 'score')
+
+        self.assertEqual(mockSession.quadtiles, {
+            1: '0/0/0', 2: '0/0/1', 3: '0/0/2', 4: '1/0/0', 5: '1/1/1'})
+        self.assertEqual(sorted(mockSession.bboxes),
+                         ['0/0/0', '0/0/1', '0/0/2', '1/0/0', '1/1/1'])
+        self.assertEqual(mockSession.bboxes['0/0/1'],
+                         '140.0 40.0 0.0,160.0 60.0 10.0')
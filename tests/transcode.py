@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+import unittest
+import json
+import struct
+import numpy as np
+from building_server import transcode
+
+
+def wkb_polygon(rings, endian='<', geomtype=1003):
+    wkb = [struct.pack('B', 1 if endian == '<' else 0),
+           struct.pack(endian + 'II', geomtype, len(rings))]
+    for ring in rings:
+        ring = list(ring) + [ring[0]]
+        wkb.append(struct.pack(endian + 'I', len(ring)))
+        for point in ring:
+            wkb.append(struct.pack(endian + 'ddd', *point))
+    return b''.join(wkb)
+
+
+def wkb_multipolygon(polygons, endian='<', geomtype=1006):
+    wkb = [struct.pack('B', 1 if endian == '<' else 0),
+           struct.pack(endian + 'II', geomtype, len(polygons))]
+    for polygon in polygons:
+        wkb.append(wkb_polygon(polygon, endian))
+    return b''.join(wkb)
+
+
+# a 1x1x1 cube without its floor
+CUBE = [
+    [[(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)]],
+    [[(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)]],
+    [[(1, 0, 0), (1, 1, 0), (1, 1, 1), (1, 0, 1)]],
+    [[(1, 1, 0), (0, 1, 0), (0, 1, 1), (1, 1, 1)]],
+    [[(0, 1, 0), (0, 0, 0), (0, 0, 1), (0, 1, 1)]],
+    [[(0, 0, 1), (0.5, 0, 1.5), (1, 0, 1)]]
+]
+
+
+class TestParse(unittest.TestCase):
+
+    def test_multipolygon(self):
+        (points, rings, polygons) = transcode.parse(wkb_multipolygon(CUBE))
+
+        self.assertEqual(points.shape, (23, 3))
+        self.assertEqual(list(rings), [0, 4, 8, 12, 16, 20, 23])
+        self.assertEqual(list(polygons), [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(points[20]), [0, 0, 1])
+        self.assertEqual(list(points[21]), [0.5, 0, 1.5])
+
+    def test_byte_order(self):
+        little = transcode.parse(wkb_multipolygon(CUBE, '<'))
+        big = transcode.parse(wkb_multipolygon(CUBE, '>'))
+
+        for (l, b) in zip(little, big):
+            np.testing.assert_array_equal(l, b)
+
+    def test_polyhedralsurface(self):
+        multi = transcode.parse(wkb_multipolygon(CUBE))
+        surface = transcode.parse(wkb_multipolygon(CUBE, geomtype=1015))
+
+        for (m, s) in zip(multi, surface):
+            np.testing.assert_array_equal(m, s)
+
+    def test_inner_rings(self):
+        outer = [(0, 0, 0), (4, 0, 0), (4, 4, 0), (0, 4, 0)]
+        inner = [(1, 1, 0), (1, 2, 0), (2, 2, 0)]
+        wkb = wkb_polygon([outer, inner], '>')
+        (points, rings, polygons) = transcode.parse(wkb)
+
+        self.assertEqual(list(rings), [0, 4, 7])
+        self.assertEqual(list(polygons), [0, 2])
+
+    def test_unsupported(self):
+        wkb = struct.pack('<BIddd', 1, 1001, 0, 0, 0)
+        self.assertRaises(ValueError, transcode.parse, wkb)
+
+
+def area(triangles):
+    cross = np.cross(triangles[:, 1] - triangles[:, 0],
+                     triangles[:, 2] - triangles[:, 0])
+    return cross.sum(axis=0) / 2
+
+
+class TestTriangulate(unittest.TestCase):
+
+    def test_convex(self):
+        quad = np.array([(0, 0, 0), (2, 0, 0), (2, 0, 1), (0, 0, 1)],
+                        dtype=float)
+        triangles = transcode.triangulateRings(quad, np.array([0]),
+                                               np.array([4]))
+
+        self.assertEqual(triangles.shape, (2, 3, 3))
+        np.testing.assert_allclose(area(triangles), [0, -2, 0])
+
+    def test_concave(self):
+        # L-shaped roof, clockwise seen from above
+        roof = np.array([(0, 0, 3), (0, 2, 3), (1, 2, 3), (1, 1, 3),
+                         (2, 1, 3), (2, 0, 3)], dtype=float)
+        triangles = transcode.triangulateRings(roof, np.array([0]),
+                                               np.array([6]))
+
+        self.assertEqual(len(triangles), 4)
+        np.testing.assert_allclose(area(triangles), [0, 0, -3])
+
+    def test_ring_order(self):
+        (points, rings, polygons) = transcode.parse(wkb_multipolygon(CUBE))
+        triangles = transcode.triangulateRings(points, rings[:-1], rings[1:])
+
+        self.assertEqual(len(triangles), 11)
+        np.testing.assert_allclose(area(triangles[0:2]), [0, 0, 1])
+        np.testing.assert_allclose(area(triangles[10:]), [0, 0.25, 0])
+
+    def test_fallback(self):
+        # twice the same point, the ring is not convex
+        ring = np.array([(0, 0, 0), (1, 0, 0), (1, 0, 0), (1, 1, 0),
+                         (0, 1, 0)], dtype=float)
+        triangles = transcode.triangulateRings(ring, np.array([0]),
+                                               np.array([5]))
+
+        np.testing.assert_allclose(area(triangles), [0, 0, 1])
+
+    def test_self_intersecting(self):
+        # bowtie on the z = x plane, triangle adds a vertex at its crossing
+        ring = np.array([(0, 0, 0), (2, 2, 2), (2, 0, 2), (0, 2, 0)],
+                        dtype=float)
+        triangles = transcode.triangulateRings(ring, np.array([0]),
+                                               np.array([4]))
+
+        self.assertEqual(len(triangles), 2)
+        np.testing.assert_allclose(triangles[:, :, 2], triangles[:, :, 0])
+        self.assertIn([1, 1, 1], triangles.reshape(-1, 3).tolist())
+
+
+def scene(glTF):
+    sceneLength = struct.unpack('I', glTF[12:16])[0]
+    return json.loads(glTF[20:20 + sceneLength].decode('utf-8'))
+
+
+def glb2_scene(glb):
+    jsonLength = struct.unpack('<I', glb[12:16])[0]
+    return (json.loads(glb[20:20 + jsonLength].decode('utf-8')),
+            glb[28 + jsonLength:])
+
+
+class TestGLB2(unittest.TestCase):
+
+    def test_octencode(self):
+        normals = np.array([(0, 0, 1), (0, 0, -1), (1, 0, 0), (0, -1, 0),
+                            (0.6, 0, -0.8)])
+        octs = transcode.octEncode(normals)
+
+        self.assertEqual(octs.dtype, np.int8)
+        self.assertEqual(octs.tolist(), [[0, 0], [127, 127], [127, 0],
+                                         [0, -127], [127, 73]])
+
+    def test_quantize(self):
+        rows = [(wkb_multipolygon(CUBE), 'BOX3D(0 0 0,1 1 1.5)')]
+        (gltf, body) = glb2_scene(transcode.toGLB2(rows, [0, 0, 0],
+                                                   quantize=True))
+
+        self.assertEqual(gltf['extensionsRequired'], ['KHR_mesh_quantization'])
+        root = gltf['nodes'][gltf['scenes'][0]['nodes'][0]]
+        self.assertEqual(root['translation'], [0, 0, 0])
+        self.assertEqual(root['scale'], [1, 1.5, 1])
+
+        attributes = gltf['meshes'][0]['primitives'][0]['attributes']
+        position = gltf['accessors'][attributes['POSITION']]
+        normal = gltf['accessors'][attributes['_OCTNORMAL']]
+        self.assertEqual(position['componentType'], 5123)
+        self.assertTrue(position['normalized'])
+        self.assertEqual(position['max'], [65535, 65535, 65535])
+        self.assertEqual(normal['componentType'], 5120)
+        self.assertEqual(normal['type'], 'VEC2')
+        self.assertEqual(normal['byteOffset'], position['byteOffset'] + 8)
+
+        # glTF 2.0 aligns vertex attributes on 4 bytes
+        for accessor in gltf['accessors']:
+            view = gltf['bufferViews'][accessor['bufferView']]
+            if view.get('target') == 34962:
+                self.assertEqual(accessor['byteOffset'] % 4, 0)
+                self.assertEqual(view['byteStride'] % 4, 0)
+                self.assertEqual(view['byteOffset'] % 4, 0)
+
+        # top face vertices come first: y (up) is quantized to 1 / 1.5
+        vertices = np.frombuffer(body, dtype=np.uint16, count=4 * 6)
+        self.assertEqual(list(vertices.reshape(-1, 6)[:, 1]), [43690] * 4)
+
+
+class TestPrebuilt(unittest.TestCase):
+
+    def test_pack(self):
+        box3D = 'BOX3D(0 0 0,1 1 1.5)'
+        rows = [(wkb_multipolygon(CUBE), box3D)]
+        meshes = [(transcode.packMesh(rows[0][0], box3D), box3D)]
+        origin = [0.5, 0.25, 0]
+
+        (gltf, body) = glb2_scene(transcode.toGLB2(rows, origin))
+        (prebuiltGltf, prebuiltBody) = glb2_scene(
+            transcode.toGLB2(meshes, origin, prebuilt=True))
+
+        self.assertEqual(prebuiltGltf['accessors'], gltf['accessors'])
+        self.assertEqual(prebuiltBody, body)
+
+    def test_numeric_bbox(self):
+        box3D = 'BOX3D(0 0 0,1 1 1.5)'
+        mesh = transcode.packMesh(wkb_multipolygon(CUBE), box3D)
+        rows = [(mesh, box3D)]
+        numeric = [(memoryview(mesh), (0, 0, 0, 1, 1, 1.5))]
+
+        self.assertEqual(transcode.toGLB2(numeric, [0, 0, 0], prebuilt=True),
+                         transcode.toGLB2(rows, [0, 0, 0], prebuilt=True))
+
+
+class TestToglTF(unittest.TestCase):
+
+    def setUp(self):
+        # 25000 small triangles with distinct normals, 75000 vertices
+        polygons = []
+        for i in range(0, 25000):
+            (x, y) = (i % 200, i // 200)
+            polygons.append([[(x, y, 0), (x + 1, y, 0), (x, y + 1, i + 1)]])
+        self.large = [(wkb_multipolygon(CUBE), 'BOX3D(0 0 0,1 1 1.5)'),
+                      (wkb_multipolygon(polygons), 'BOX3D(0 0 0,200 126 25000)')]
+
+    def test_binary(self):
+        rows = [(wkb_multipolygon(CUBE), 'BOX3D(0 0 0,1 1 1.5)')]
+        glTF = transcode.toglTF(rows, True, [0, 0, 0])
+
+        (magic, version, length) = struct.unpack('4sII', glTF[0:12])
+        self.assertEqual(magic, b'glTF')
+        self.assertEqual(version, 1)
+        self.assertEqual(length, len(glTF))
+
+    def test_merge(self):
+        rows = [(wkb_multipolygon(CUBE), 'BOX3D(0 0 0,1 1 1.5)'),
+                (wkb_multipolygon(CUBE[0:1]), 'BOX3D(0 0 1,1 1 1)')]
+        glTF = transcode.toglTF(rows, True, [0, 0, 0], merge=True)
+        gltfScene = scene(glTF)
+        accessors = gltfScene['accessors']
+
+        self.assertEqual(list(gltfScene['meshes']), ['M0'])
+        primitive = gltfScene['meshes']['M0']['primitives'][0]
+        self.assertEqual(primitive['attributes']['_BATCHID'], 'AB_0')
+        self.assertEqual(accessors['AB_0']['count'],
+                         accessors['AV_0']['count'])
+
+        # batch ids follow the vertices and normals in the body
+        view = gltfScene['bufferViews']['BV_batchids']
+        body = glTF[20 + struct.unpack('I', glTF[12:16])[0]:]
+        batchIds = np.frombuffer(body, dtype=np.float32,
+                                 count=accessors['AB_0']['count'],
+                                 offset=view['byteOffset'])
+        self.assertEqual(list(np.unique(batchIds, return_counts=True)[1]),
+                         [accessors['AV_0']['count'] - 4, 4])
+
+    def test_merge_empty(self):
+        glTF = transcode.toglTF([], True, [0, 0, 0], merge=True)
+        self.assertEqual(scene(glTF)['meshes'], {})
+
+        (gltfScene, body) = glb2_scene(transcode.toGLB2([], merge=True))
+        self.assertEqual(gltfScene.get('meshes', []), [])
+
+    def test_uint32_indices(self):
+        glTF = transcode.toglTF(self.large, True, [0, 0, 0])
+        accessors = scene(glTF)['accessors']
+
+        self.assertEqual(accessors['AI_0']['componentType'], 5123)
+        self.assertEqual(accessors['AI_1']['componentType'], 5125)
+        self.assertEqual(accessors['AI_1']['byteStride'], 4)
+        self.assertEqual(accessors['AI_1']['byteOffset'] % 4, 0)
+        self.assertEqual(accessors['AV_1']['count'], 75000)
+
+    def test_split_meshes(self):
+        glTF = transcode.toglTF(self.large, True, [0, 0, 0], True)
+        gltfScene = scene(glTF)
+        accessors = gltfScene['accessors']
+        primitives = gltfScene['meshes']['M1']['primitives']
+
+        self.assertEqual(len(gltfScene['meshes']), 2)
+        self.assertEqual(len(primitives), 2)
+        vertices = 0
+        indices = 0
+        for primitive in primitives:
+            indexAccessor = accessors[primitive['indices']]
+            vertexAccessor = accessors[primitive['attributes']['POSITION']]
+            self.assertEqual(indexAccessor['componentType'], 5123)
+            self.assertLessEqual(vertexAccessor['count'], 65535)
+            vertices += vertexAccessor['count']
+            indices += indexAccessor['count']
+        self.assertEqual(vertices, 75000)
+        self.assertEqual(indices, 75000)
+
+    def test_pool(self):
+        inProcess = transcode.toglTF(self.large, True, [0, 0, 0])
+        transcode.TranscodePool.size = 2
+        transcode.TranscodePool.threshold = 0
+        try:
+            pooled = transcode.toglTF(self.large, True, [0, 0, 0])
+            self.assertIsNotNone(transcode.TranscodePool.executor)
+        finally:
+            transcode.TranscodePool.size = 0
+            transcode.TranscodePool.threshold = None
+
+        self.assertEqual(pooled, inProcess)
+
+    def test_pool_threads(self):
+        transcode.TranscodePool.size = 1
+        pools = []
+        try:
+            threads = [threading.Thread(
+                target=lambda: pools.append(transcode.TranscodePool.pool()))
+                for i in range(0, 8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(set(map(id, pools))), 1)
+        finally:
+            transcode.TranscodePool.size = 0
+
+    def test_broken_pool(self):
+        inProcess = transcode.toglTF(self.large, True, [0, 0, 0])
+        transcode.TranscodePool.size = 2
+        transcode.TranscodePool.threshold = 0
+        try:
+            # a worker is killed while transcoding
+            pool = transcode.TranscodePool.pool()
+            pool.submit(os._exit, 1)
+            time.sleep(0.5)
+            self.assertEqual(transcode.toglTF(self.large, True, [0, 0, 0]),
+                             inProcess)
+            self.assertIsNone(transcode.TranscodePool.executor)
+
+            # the next tile starts a new pool
+            transcode.toglTF(self.large, True, [0, 0, 0])
+            self.assertIsNot(transcode.TranscodePool.executor, pool)
+        finally:
+            transcode.TranscodePool.size = 0
+            transcode.TranscodePool.threshold = None
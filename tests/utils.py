@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+from building_server.utils import Box3D
+
+
+class TestBox3D(unittest.TestCase):
+
+    def test_text(self):
+        b = Box3D('BOX3D(1 2 3,5 6.5 7)')
+        self.assertEqual(b.values, (1, 2, 3, 5, 6.5, 7))
+        self.assertEqual(b.corners(), [[1, 2, 3], [5, 6.5, 7]])
+        self.assertEqual(b.centroid(), (3, 4.25))
+        # the JSON list is written as the database wrote the box
+        self.assertEqual(b.aslist(), '[1,2,3,5,6.5,7]')
+        self.assertEqual(b.aslist(bracket=False), '1,2,3,5,6.5,7')
+        self.assertEqual(b.geojson(), '"bbox" : [1,2,3,5,6.5,7]')
+
+    def test_values(self):
+        b = Box3D((1, 2, 3, 5, 6.5, 7))
+        self.assertEqual(b.corners(), [[1, 2, 3], [5, 6.5, 7]])
+        self.assertEqual(b.aslist(), '[1.0,2.0,3.0,5.0,6.5,7.0]')
+
+    def test_batch(self):
+        boxes = ['BOX3D(1 2 3,5 6.5 7)', 'BOX3D(0 0 0,1 1 1)']
+        values = Box3D.parse(boxes)
+        self.assertEqual(values.shape, (2, 6))
+        self.assertEqual(Box3D.centroids(values).tolist(),
+                         [[3, 4.25], [0.5, 0.5]])
+        self.assertEqual(Box3D.parse([]).shape, (0, 6))
+
+        for (box, b) in zip(boxes, Box3D.batch(boxes)):
+            self.assertEqual(b.values, Box3D(box).values)
+            self.assertEqual(b.geojson(), Box3D(box).geojson())
+        np.testing.assert_array_equal(
+            values, [Box3D(box).values for box in boxes])